@@ -0,0 +1,18 @@
+"""
+ASGI config for holvi project, Python 3.5+ only.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+serve it with any ASGI 3 server, e.g. ``uvicorn app.asgi:application``.
+See ``issuer.asgi`` for what it serves on the event loop.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "app.settings")
+django.setup(set_prefix=False)
+
+from issuer.asgi import ASGIHandler  # noqa: E402
+
+application = ASGIHandler()
@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'issuer.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,11 +79,114 @@ WSGI_APPLICATION = 'app.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'ft_exec.sqlite3'),
+# SQLite is the development database, set FT_EXEC_DB_ENGINE=postgresql and
+# the FT_EXEC_DB_* variables below to run on PostgreSQL.
+DATABASE_ENGINE = os.environ.get('FT_EXEC_DB_ENGINE', 'sqlite3')
+# Seconds a connection is kept open for the next requests of its thread
+CONN_MAX_AGE = int(os.environ.get('FT_EXEC_DB_CONN_MAX_AGE', 60))
+
+if DATABASE_ENGINE == 'postgresql':
+    from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+
+    def postgresql_database(host):
+        return {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('FT_EXEC_DB_NAME', 'ft_exec'),
+            'USER': os.environ.get('FT_EXEC_DB_USER', ''),
+            'PASSWORD': os.environ.get('FT_EXEC_DB_PASSWORD', ''),
+            'HOST': host,
+            'PORT': os.environ.get('FT_EXEC_DB_PORT', ''),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            # PgBouncer in transaction pooling mode hands every transaction a
+            # different server connection, server-side cursors cannot outlive one.
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('FT_EXEC_DB_PGBOUNCER') == '1',
+            'OPTIONS': {
+                # The ledger locks the rows it changes and guards balances in the
+                # UPDATE itself, which needs to see the latest committed balance.
+                # Under REPEATABLE READ those updates would fail with serialisation errors.
+                'isolation_level': ISOLATION_LEVEL_READ_COMMITTED,
+                'connect_timeout': 5,
+            },
+        }
+
+    DATABASES = {
+        'default': postgresql_database(os.environ.get('FT_EXEC_DB_HOST', '')),
     }
+    if os.environ.get('FT_EXEC_DB_REPLICA_HOST'):
+        DATABASES['replica'] = dict(postgresql_database(os.environ['FT_EXEC_DB_REPLICA_HOST']),
+                                    TEST={'MIRROR': 'default'})
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'ft_exec.sqlite3'),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            # The default shared in-memory test database locks whole tables and
+            # never waits, which the multi-threaded ledger tests cannot live with.
+            'TEST': {
+                'NAME': os.path.join(BASE_DIR, 'test_ft_exec.sqlite3'),
+            },
+        },
+        # Read-only copy serving the balance, statement and account listing reads
+        # (see issuer.routers). Locally simply a second connection to the same file.
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'ft_exec.sqlite3'),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'TEST': {
+                'MIRROR': 'default',
+            },
+        },
+    }
+
+# Applied to every new SQLite connection (issuer.database). WAL lets the
+# replica connection and the webhooks read while the ledger writes.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),
+    ('temp_store', 'MEMORY'),
+)
+
+DATABASE_ROUTERS = ['issuer.routers.ReplicaRouter']
+REPLICA_DATABASES = tuple(alias for alias in DATABASES if alias != 'default')
+# Seconds an account's reads stay on the primary after it was written. The
+# cache has to be shared by all workers to give read-your-writes between them.
+REPLICA_STICKINESS = 5
+REPLICA_STICKINESS_CACHE = 'default'
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Original responses to processed scheme messages. Local memory is per worker
+    # process and empty after a restart: a retry reaching another worker, or
+    # coming after a restart, takes the full path and is rejected by the
+    # duplicate checks instead of getting the original response. Switch it to a
+    # database or memcached backend to share the responses between workers and
+    # keep them across restarts.
+    'idempotency': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'idempotency',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    # Balance responses (issuer.balance_cache). Local memory only sees the
+    # invalidations of its own process, with several worker processes use a
+    # shared backend (file based on one host, memcached) to not serve balances
+    # older than BALANCE_CACHE_TTL.
+    'balances': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'balances',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
 }
 
 
@@ -141,11 +245,66 @@ REST_FRAMEWORK = {
 
 
 API_URL = 'http://127.0.0.1:8000'
+IDEMPOTENCY_CACHE = 'idempotency'
+IDEMPOTENCY_TTL = 60 * 60 * 24
+BALANCE_CACHE = 'balances'
+BALANCE_CACHE_TTL = 60
+# JSON renderer and parser of the operations endpoints and the accounts API.
+# The fast ones encode with orjson when it is installed and simplejson otherwise,
+# 'rest_framework.renderers.JSONRenderer' / 'rest_framework.parsers.JSONParser' are the stock ones.
+API_JSON_RENDERER = 'issuer.renderers.FastJSONRenderer'
+API_JSON_PARSER = 'issuer.parsers.FastJSONParser'
+# Presentments settled per DB transaction by the clearing worker
+CLEARING_CHUNK_SIZE = 1000
+# Days after which an authorisation hold nobody presented is released by the
+# expire_holds command, longer for merchants which present late (by MCC:
+# hotels, car rental, cruise lines).
+HOLD_EXPIRY_DAYS = 7
+HOLD_EXPIRY_DAYS_BY_MCC = {
+    7011: 31,
+    7512: 31,
+    4411: 31,
+}
+# Holds released per DB transaction by expire_holds
+HOLD_EXPIRY_CHUNK_SIZE = 1000
+# Months of history which closed this many days ago may be moved to the
+# archive tables by archive_history (see issuer.archive), in chunks of rows
+# moved per DB transaction. Keep it longer than any hold expiry.
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_CHUNK_SIZE = 500
+
+# audit_ledger (see issuer.audit) checks ranges of this many transfer and
+# account ids per task, on AUDIT_PROCESSES processes.
+AUDIT_CHUNK_SIZE = 100000
+AUDIT_PROCESSES = 4
+
+# Threads of the ASGI application (app/asgi.py, see issuer.asgi) doing the
+# database work of the requests, which bounds its database connections too.
+ASGI_THREADS = 10
+
+# Maximum SQL queries per request of a view, exceeding it is logged or, with
+# QUERY_BUDGET_STRICT (the test mode), raises QueryBudgetExceeded. Set to the
+# counts bench_webhooks measures once the account cache is warm, the first
+# requests of a worker also look up the accounts.
+QUERY_BUDGETS = {
+    'AuthorisationMessageView': 11,
+    'PresentmentMessageView': 13,
+    'ClearingView': 3,
+    'ClearingJobView': 1,
+    'CardholderBalanceView': 7,
+}
+QUERY_BUDGET_STRICT = False
+METRICS_ALLOWED_IPS = ('127.0.0.1', )
 API_AUTH_HEADER = 'API_AUTH_KEY'
 API_CONSUMERS_AUTH_HEADERS = {
     'issuer': 'lZ400y5AcQLukN6BI5qZCIMhiGHWJmup',
 }
 
+# Seconds an account lookup (card id or system account -> account) stays cached
+# in a process. Account save/delete signals drop the cache of the process that
+# changed it, other processes pick the change up when their entry expires.
+ACCOUNT_CACHE_TTL = 300
+
 ACCOUNTS_MAPPING = {
     'card_id': {
         '4321LOBO': 'Lora [Liability]',
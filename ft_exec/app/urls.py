@@ -3,6 +3,7 @@ from django.contrib import admin
 from rest_framework import routers, renderers
 
 from issuer import views
+from issuer.instrumentation import metrics_view
 
 
 router = routers.DefaultRouter()
@@ -19,12 +20,20 @@ urlpatterns = [
 
     url(r'^api/v1/operations/clearing/$', views.ClearingView.as_view(),
         name='clearing'),
+    url(r'^api/v1/operations/clearing/(?P<pk>[0-9]+)/$', views.ClearingJobView.as_view(),
+        name='clearing-job'),
     url(r'^api/v1/operations/auth/$', views.AuthorisationMessageView.as_view(),
         name='auth'),
+    url(r'^api/v1/operations/auth/batch/$', views.AuthorisationBatchView.as_view(),
+        name='auth-batch'),
     url(r'^api/v1/operations/presentment/$', views.PresentmentMessageView.as_view(),
         name='presentment'),
     url(r'^api/v1/operations/balance/$', views.CardholderBalanceView.as_view(),
         name='balance'),
+    url(r'^api/v1/operations/statement/$', views.StatementView.as_view(),
+        name='statement'),
+
+    url(r'^metrics/$', metrics_view, name='metrics'),
 
     url(r'^v(?P<version>[0-9]+\.[0-9]+)', include('drf_openapi.urls'))
     ]
@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 
-from .models import Account, Transfer, Transaction
+from .models import Account, Transfer, Transaction, ArchivedPeriod
 
 
 @admin.register(Account)
@@ -20,3 +20,8 @@ class TransferAdmin(admin.ModelAdmin):
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(ArchivedPeriod)
+class ArchivedPeriodAdmin(admin.ModelAdmin):
+    list_display = ('month', 'transactions', 'transfers', 'messages', 'archived_at')
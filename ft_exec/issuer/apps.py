@@ -6,3 +6,21 @@ from django.apps import AppConfig
 
 class CardIssuingConfig(AppConfig):
     name = 'issuer'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_save, post_delete
+        from issuer.balance_cache import invalidate_account
+        from issuer.database import configure_sqlite
+        from issuer.instrumentation import install_query_timing
+        from issuer.models import Account
+        from issuer.routers import mark_account_written
+        from issuer.utils import invalidate_account_cache
+
+        connection_created.connect(configure_sqlite, dispatch_uid='configure_sqlite')
+        connection_created.connect(install_query_timing, dispatch_uid='install_query_timing')
+
+        post_save.connect(invalidate_account_cache, sender=Account, dispatch_uid='invalidate_account_cache')
+        post_delete.connect(invalidate_account_cache, sender=Account, dispatch_uid='invalidate_account_cache')
+        post_save.connect(mark_account_written, sender=Account, dispatch_uid='mark_account_written')
+        post_save.connect(invalidate_account, sender=Account, dispatch_uid='invalidate_balance_cache')
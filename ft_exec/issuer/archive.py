@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Archive of closed months of ledger history.
+
+``archive_month`` moves the transactions, transfers and scheme messages of a
+month that closed more than ``ARCHIVE_AFTER_DAYS`` ago into the ``Archived*``
+tables, chunk by chunk, each chunk copied and deleted in one DB transaction.
+Rows the running system may still need stay in the hot tables: open holds and
+the transfers of their transactions, presentments not cleared yet.
+
+The archived month is recorded (``ArchivedPeriod``) before its first chunk
+moves, so ``needs_archive`` is true for every date the archive may cover and
+the ledger queries (``Account.get_balance``, ``Account.get_statement``) union
+the archive for those dates only. Dates within ``ARCHIVE_AFTER_DAYS`` never
+query the archive at all.
+
+The checks of incoming scheme messages against earlier ones
+(``messages.known_messages``) and ``balance_checkpoints`` always read the
+archive too: a retried authorisation or a late presentment may come for any
+archived message.
+"""
+from __future__ import unicode_literals
+
+import heapq
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+
+from issuer.constants import MESSAGE_TYPES
+from issuer.models import ArchivedPeriod, ArchivedSchemeMessage, ArchivedTransaction, ArchivedTransfer, \
+    SchemeMessage, Transaction, Transfer
+
+
+def month_start(value):
+    return timezone.make_aware(datetime(value.year, value.month, 1))
+
+
+def next_month(value):
+    return month_start(value.replace(day=28) + timedelta(days=4))
+
+
+def archivable_until():
+    """
+    Start of the first month which may not be archived yet
+    """
+    return month_start(timezone.localtime(timezone.now() - timedelta(days=settings.ARCHIVE_AFTER_DAYS)))
+
+
+def horizon():
+    """
+    End of the last archived month or None, nothing newer is in the archive
+    """
+    month = ArchivedPeriod.objects.aggregate(month=Max('month'))['month']
+    return next_month(month) if month is not None else None
+
+
+def needs_archive(since):
+    """
+    Whether history from ``since`` (a datetime, its string or None for all of it) reaches into the archive
+    """
+    if isinstance(since, six.string_types):
+        since = parse_datetime(since)
+    if since is not None and timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    if since is not None and since >= archivable_until():
+        return False
+    end = horizon()
+    return end is not None and (since is None or since < end)
+
+
+def merge(*querysets):
+    """
+    Iterate over querysets ordered on (created_at, id) as one
+    """
+    iterators = [(((row.created_at, row.id), row) for row in queryset.iterator()) for queryset in querysets]
+    return (row for _, row in heapq.merge(*iterators))
+
+
+def _copy(source, target, where, params):
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in source._meta.concrete_fields)
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s' % (
+            connection.ops.quote_name(target._meta.db_table), columns, columns,
+            connection.ops.quote_name(source._meta.db_table), where), params)
+
+
+def _delete(source, where, params):
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE %s' % (connection.ops.quote_name(source._meta.db_table), where),
+                       params)
+        return cursor.rowcount
+
+
+def _in(column, values):
+    return '%s IN (%s)' % (connection.ops.quote_name(column), ', '.join(['%s'] * len(values)))
+
+
+def closed_transactions(start, end):
+    return Transaction.objects.filter(created_at__gte=start, created_at__lt=end, expires_at__isnull=True).exclude(
+        # Their transfers must not end up on both sides of the month boundary
+        transfers__created_at__gte=end,
+    )
+
+
+def closed_messages(start, end):
+    open_holds = Transaction.objects.filter(expires_at__isnull=False).values('external_transaction_id')
+    return SchemeMessage.objects.filter(created_at__gte=start, created_at__lt=end).exclude(
+        type=MESSAGE_TYPES.PRESENTMENT, clearing__isnull=True,
+    ).exclude(
+        # A presentment may still come for them
+        type=MESSAGE_TYPES.AUTHORISATION, transaction_id__in=open_holds,
+    )
+
+
+def archive_month(month, chunk_size):
+    """
+    Move the closed history of the month of ``month`` to the archive, returns its ArchivedPeriod
+    """
+    start, end = month_start(month), next_month(month)
+    if end > archivable_until():
+        raise ValueError('%s is not closed for %s days yet' % (start.strftime('%Y-%m'),
+                                                               settings.ARCHIVE_AFTER_DAYS))
+    period, _ = ArchivedPeriod.objects.get_or_create(month=start.date())
+
+    while True:
+        with transaction.atomic():
+            ids = list(closed_transactions(start, end).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not ids:
+                break
+            _copy(Transaction, ArchivedTransaction, _in('id', ids), ids)
+            _copy(Transfer, ArchivedTransfer, _in('transaction_id', ids), ids)
+            transfers = _delete(Transfer, _in('transaction_id', ids), ids)
+            _delete(Transaction, _in('id', ids), ids)
+        period.transactions += len(ids)
+        period.transfers += transfers
+        period.save(update_fields=['transactions', 'transfers'])
+
+    while True:
+        with transaction.atomic():
+            ids = list(closed_messages(start, end).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not ids:
+                break
+            _copy(SchemeMessage, ArchivedSchemeMessage, _in('id', ids), ids)
+            _delete(SchemeMessage, _in('id', ids), ids)
+        period.messages += len(ids)
+        period.save(update_fields=['messages'])
+    return period
+
+
+def archivable_months():
+    """
+    Starts of the months with history in the hot tables which may be archived, oldest first
+    """
+    until = archivable_until()
+    oldest = [value for value in (
+        Transaction.objects.filter(created_at__lt=until).aggregate(oldest=Min('created_at'))['oldest'],
+        SchemeMessage.objects.filter(created_at__lt=until).aggregate(oldest=Min('created_at'))['oldest'],
+    ) if value is not None]
+
+    months = []
+    month = month_start(timezone.localtime(min(oldest))) if oldest else until
+    while month < until:
+        months.append(month)
+        month = next_month(month)
+    return months
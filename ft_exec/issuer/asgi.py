@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI application serving the scheme webhooks without a worker per request.
+
+Django 1.11 has no ASGI support of its own, so ``ASGIHandler`` is a plain
+ASGI 3 callable (Python 3.5+ only, served through ``app/asgi.py``). The
+authorisation, presentment and balance requests are read, parsed, validated
+and rendered on the event loop; only their database work (``issuer.webhooks``)
+runs in a thread pool of ``ASGI_THREADS`` threads, which also bounds the
+database connections of the process. Thousands of scheme connections can be
+open at once, waiting on the loop for a thread instead of each holding one.
+
+Every other request is served by Django's WSGI handler, middleware included,
+in the same pool. Its response is streamed back from the thread serving it.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import close_old_connections
+from django.http import QueryDict
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.exceptions import ParseError, PermissionDenied, ValidationError
+
+from issuer import idempotency, instrumentation, messages, routers, webhooks
+from issuer.constants import BALANCE_TYPES
+from issuer.serializers import BalanceSerializer
+from issuer.views import HasHeaderPermission
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRequest(object):
+    """
+    A request served on the event loop, ``META`` is its WSGI environ
+    """
+
+    def __init__(self, scope, body):
+        self.body = body
+        self.META = environ(scope, body)
+
+
+def environ(scope, body):
+    """
+    WSGI environ of an ASGI HTTP request
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    result = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI strings are bytes decoded as latin-1
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else 'HTTP_' + name
+        result[key] = '%s,%s' % (result[key], value) if key in result else value
+    return result
+
+
+class ASGIHandler(object):
+
+    def __init__(self, threads=None):
+        self.executor = ThreadPoolExecutor(threads or settings.ASGI_THREADS)
+        self.wsgi = WSGIHandler()
+        self.parser = import_string(settings.API_JSON_PARSER)()
+        self.renderer = import_string(settings.API_JSON_RENDERER)()
+        self.permission = HasHeaderPermission()
+        # (method, path): (view, its name in the metrics and QUERY_BUDGETS)
+        self.views = {
+            ('POST', reverse('auth')): (self.authorise, 'AuthorisationMessageView'),
+            ('POST', reverse('presentment')): (self.present, 'PresentmentMessageView'),
+            ('GET', reverse('balance')): (self.balance, 'CardholderBalanceView'),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type %s' % scope['type'])
+
+        body = await self.read_body(receive)
+        if body is None:
+            return await self.respond(send, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                      {'detail': 'Request body exceeded DATA_UPLOAD_MAX_MEMORY_SIZE.'})
+        request = AsyncRequest(scope, body)
+        view = self.views.get((scope['method'], scope['path']))
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if view is None or (body and not content_type.startswith(self.parser.media_type)):
+            return await self.forward(request, send)
+
+        view, view_name = view
+        started = default_timer()
+        try:
+            if not self.permission.has_permission(request, None):
+                raise PermissionDenied()
+            response_status, payload, headers, metrics = await view(request)
+        except (ParseError, PermissionDenied) as e:
+            return await self.respond(send, e.status_code, {'detail': e.detail})
+        except Exception:
+            logger.exception('Internal Server Error: %s', scope['path'])
+            return await self.respond(send, status.HTTP_500_INTERNAL_SERVER_ERROR, {'detail': 'Server Error'})
+
+        duration = default_timer() - started
+        instrumentation.registry.observe(view_name, metrics, duration)
+        headers['Server-Timing'] = instrumentation.server_timing(metrics, duration)
+        instrumentation.check_query_budget(view_name, metrics)
+        await self.respond(send, response_status, payload, headers)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        """
+        The request body, None when it is over DATA_UPLOAD_MAX_MEMORY_SIZE
+        """
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            size += len(chunks[-1])
+            if settings.DATA_UPLOAD_MAX_MEMORY_SIZE is not None and size > settings.DATA_UPLOAD_MAX_MEMORY_SIZE:
+                return None
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def respond(self, send, response_status, payload, headers=None):
+        body = self.renderer.render(payload) if payload is not None else b''
+        headers = dict(headers or {}, **{'Content-Length': str(len(body))})
+        if payload is not None:
+            headers['Content-Type'] = self.renderer.media_type
+        await send({
+            'type': 'http.response.start',
+            'status': response_status,
+            'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def run(self, function, *args):
+        """
+        ``function(*args)`` and its RequestMetrics, run in the thread pool
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.measured, function, args)
+
+    def measured(self, function, args):
+        # A thread keeps its connections across requests, like a WSGI worker
+        close_old_connections()
+        try:
+            with instrumentation.measured() as metrics:
+                result = function(*args)
+            return result, metrics
+        finally:
+            close_old_connections()
+
+    def parse(self, request):
+        return self.parser.parse(BytesIO(request.body), self.parser.media_type)
+
+    async def authorise(self, request):
+        return await self.message(request, messages.AUTHORISATION, webhooks.authorise)
+
+    async def present(self, request):
+        return await self.message(request, messages.PRESENTMENT, webhooks.present)
+
+    async def message(self, request, schema, process):
+        started = default_timer()
+        # An empty body is an empty message, like DRF's request.data
+        data = self.parse(request) if request.body else {}
+        try:
+            message = schema.validate(data, check_database=False)
+        except ValidationError as e:
+            message, errors = None, e.detail
+        validated = default_timer() - started
+
+        if message is None:
+            metrics = instrumentation.RequestMetrics()
+            response_status, payload = status.HTTP_400_BAD_REQUEST, self.errors(errors)
+        else:
+            (payload, response_status), metrics = await self.run(self.process_message, schema, process, message)
+        metrics.phases['serializer'] += validated
+        return response_status, payload, {}, metrics
+
+    def process_message(self, schema, process, message):
+        original = idempotency.get_response(schema.message_type, message['transaction_id'])
+        if original is not None:
+            return original
+        try:
+            with instrumentation.timed('serializer'):
+                schema.check_database(message)
+        except ValidationError as e:
+            return self.errors(e.detail), status.HTTP_400_BAD_REQUEST
+        return process(message)
+
+    def errors(self, detail):
+        return {'success': False,
+                'status_code': status.HTTP_400_BAD_REQUEST,
+                'detail': detail}
+
+    async def balance(self, request):
+        started = default_timer()
+        serializer = BalanceSerializer(data=QueryDict(request.META['QUERY_STRING']))
+        is_valid = serializer.is_valid()
+        validated = default_timer() - started
+        if not is_valid:
+            metrics = instrumentation.RequestMetrics()
+            metrics.phases['serializer'] += validated
+            return status.HTTP_400_BAD_REQUEST, self.errors(serializer.errors), {}, metrics
+
+        data = serializer.initial_data
+        (payload, response_status, etag), metrics = await self.run(
+            self.read_balance, data['card_id'], data.get('balance_type', BALANCE_TYPES.AVAILABLE),
+            serializer.validated_data.get('date_time'), request.META.get('HTTP_IF_NONE_MATCH'))
+        metrics.phases['serializer'] += validated
+        return response_status, payload, {'ETag': etag}, metrics
+
+    def read_balance(self, *args):
+        with routers.replica_reads():
+            return webhooks.balance(*args)
+
+    async def forward(self, request, send):
+        """
+        Serve the request with the WSGI handler, streaming the response from its thread
+        """
+        loop = asyncio.get_event_loop()
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def serve():
+            started = {}
+
+            def start_response(status_line, headers, exc_info=None):
+                started['status'], started['headers'] = int(status_line.split(' ', 1)[0]), headers
+
+            chunks = self.wsgi(request.META, start_response)
+            try:
+                send_from_thread({
+                    'type': 'http.response.start',
+                    'status': started['status'],
+                    'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                                for name, value in started['headers']],
+                })
+                for chunk in chunks:
+                    if chunk:
+                        send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                send_from_thread({'type': 'http.response.body', 'body': b''})
+            finally:
+                # request_finished, Django closes the connections it should here
+                chunks.close()
+
+        await loop.run_in_executor(self.executor, serve)
+
+
+async def call(application, method, path, body=b'', headers=()):
+    """
+    Serve one request with ``application`` in this process, (status, headers, body) of the response
+    """
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'root_path': '',
+        'path': path.split('?', 1)[0], 'query_string': path.split('?', 1)[1].encode('latin-1') if '?' in path else b'',
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    }
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        sent.append(message)
+
+    await application(scope, receive, send)
+    response_headers = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                            for name, value in sent[0]['headers'])
+    return sent[0]['status'], response_headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def replay(application, clients):
+    """
+    Send the requests of every client (lists of (method, path, body, headers)) to ``application``,
+    each client one request at a time and all clients at once on one event loop.
+
+    Returns (client index, request index, status, headers, latency) of every response.
+    """
+    samples = []
+
+    async def client(index, requests):
+        for request_index, request in enumerate(requests):
+            started = default_timer()
+            response_status, headers, _ = await call(application, *request)
+            samples.append((index, request_index, response_status, headers, default_timer() - started))
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.gather(*[client(index, requests) for index, requests in enumerate(clients)],
+                                               loop=loop))
+    finally:
+        loop.close()
+    return samples
+
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Ledger integrity checks behind the ``audit_ledger`` command.
+
+Every check is one aggregate query over a range of ids, so the work can be
+split into tasks and run on several processes:
+
+- unbalanced transactions, per range of transfer ids: the transactions those
+  transfers belong to must have exactly two transfers netting to zero;
+- balance drift, per range of account ids: the stored balances of an account
+  must equal its opening balances plus the sum of its transfers, archived
+  ones included. The opening balances are those of its earliest checkpoint
+  (see ``balance_checkpoints``), and only the transfers made since are
+  summed. Balances changed without transfers (the accounts API, the admin)
+  show up here. Accounts without checkpoints open at zero; when that does
+  not add up they are reported as missing a checkpoint rather than as drift,
+  their opening balance (e.g. seeded by a fixture) is unknown. Run
+  ``balance_checkpoints`` once before the first audit;
+- the trial balance, per range of account ids: debits and credits per
+  account, debits and credits of the whole ledger must net to zero.
+
+Incremental audits only check the transfers after the last audited one and
+the accounts they touched. Archived transactions are not checked again, their
+transfers were audited before they were archived and do not change.
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+from django.db.models import Case, Count, DateTimeField, DecimalField, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils.timezone import utc
+
+from issuer.constants import BALANCE_TYPES, TRANSACTION_BALANCE_MAPPING
+from issuer.models import Account, ArchivedTransfer, BalanceCheckpoint, Transfer
+
+
+Task = namedtuple('Task', ['check', 'first_id', 'last_id', 'since_transfer_id'])
+Problem = namedtuple('Problem', ['check', 'object_id', 'detail'])
+
+# Opening balances of accounts without checkpoints are zero since then
+BEGINNING = datetime(1970, 1, 1, tzinfo=utc)
+
+UNBALANCED_TRANSACTIONS = 'transactions'
+BALANCE_DRIFT = 'balances'
+NO_CHECKPOINT = 'no checkpoint'
+TRIAL_BALANCE = 'trial balance'
+
+
+def _ranges(first_id, last_id, chunk_size):
+    """
+    (first, last] id ranges covering (first_id, last_id]
+    """
+    while first_id < last_id:
+        yield first_id, min(first_id + chunk_size, last_id)
+        first_id += chunk_size
+
+
+def tasks(since_transfer_id, last_transfer_id, last_account_id, chunk_size, trial_balance=False):
+    for first_id, last_id in _ranges(since_transfer_id, last_transfer_id, chunk_size):
+        yield Task(UNBALANCED_TRANSACTIONS, first_id, last_id, since_transfer_id)
+    checks = (BALANCE_DRIFT, TRIAL_BALANCE) if trial_balance else (BALANCE_DRIFT, )
+    for first_id, last_id in _ranges(0, last_account_id, chunk_size):
+        for check in checks:
+            yield Task(check, first_id, last_id, since_transfer_id)
+
+
+def run(task):
+    """
+    Problems and trial balance lines (check, account id, (debit, credit)) found by one task
+    """
+    return list(CHECKS[task.check](task))
+
+
+def unbalanced_transactions(task):
+    touched = Transfer.objects.filter(pk__gt=task.first_id, pk__lte=task.last_id).values('transaction_id')
+    rows = Transfer.objects.filter(transaction_id__in=touched).order_by().values('transaction_id').annotate(
+        transfers=Count('pk'), total=Sum('amount'),
+    ).exclude(transfers=2, total=0)
+    for row in rows:
+        yield Problem(UNBALANCED_TRANSACTIONS, row['transaction_id'], '%s transfers netting to %s' % (
+            row['transfers'], row['total']))
+
+
+def balance_drift(task):
+    amount = DecimalField(max_digits=24, decimal_places=2)
+    opening = BalanceCheckpoint.objects.filter(account=OuterRef('pk')).order_by('balance_at')
+
+    def opening_balance(balance_type):
+        return Coalesce(Subquery(opening.values('amount_%s' % balance_type)[:1], output_field=amount), Value(0),
+                        output_field=amount)
+
+    def transfers_sum(model, balance_type):
+        return Coalesce(Subquery(model.objects.filter(
+            account=OuterRef('pk'), created_at__gte=OuterRef('opening_at'),
+            transaction__status__in=TRANSACTION_BALANCE_MAPPING[balance_type],
+        ).order_by().values('account').annotate(summ=Sum('amount')).values('summ'), output_field=amount), Value(0),
+            output_field=amount)
+
+    accounts = Account.objects.filter(pk__gt=task.first_id, pk__lte=task.last_id)
+    if task.since_transfer_id:
+        accounts = accounts.filter(pk__in=Transfer.objects.filter(pk__gt=task.since_transfer_id)
+                                   .values('account_id'))
+    rows = accounts.annotate(
+        checkpointed_at=Subquery(opening.values('balance_at')[:1], output_field=DateTimeField()),
+        opening_at=Coalesce(F('checkpointed_at'), Value(BEGINNING, output_field=DateTimeField())),
+        opening_available=opening_balance(BALANCE_TYPES.AVAILABLE),
+        opening_ledger=opening_balance(BALANCE_TYPES.LEDGER),
+        available_sum=transfers_sum(Transfer, BALANCE_TYPES.AVAILABLE),
+        ledger_sum=transfers_sum(Transfer, BALANCE_TYPES.LEDGER),
+        archived_available_sum=transfers_sum(ArchivedTransfer, BALANCE_TYPES.AVAILABLE),
+        archived_ledger_sum=transfers_sum(ArchivedTransfer, BALANCE_TYPES.LEDGER),
+    ).values_list('pk', 'checkpointed_at', 'amount_available', 'amount_ledger', 'opening_available',
+                  'opening_ledger', 'available_sum', 'ledger_sum', 'archived_available_sum', 'archived_ledger_sum')
+    for pk, checkpointed_at, available, ledger, opening_available, opening_ledger, available_sum, ledger_sum, \
+            archived_available_sum, archived_ledger_sum in rows:
+        expected_available = Decimal(opening_available) + Decimal(available_sum) + Decimal(archived_available_sum)
+        expected_ledger = Decimal(opening_ledger) + Decimal(ledger_sum) + Decimal(archived_ledger_sum)
+        if (Decimal(available), Decimal(ledger)) != (expected_available, expected_ledger):
+            yield Problem(BALANCE_DRIFT if checkpointed_at is not None else NO_CHECKPOINT, pk,
+                          'stored %s/%s, transfers %s/%s (available/ledger)' % (
+                              available, ledger, expected_available, expected_ledger))
+
+
+def trial_balance(task):
+    amount = DecimalField(max_digits=24, decimal_places=2)
+    rows = Transfer.objects.filter(account_id__gt=task.first_id, account_id__lte=task.last_id).order_by().values(
+        'account_id'
+    ).annotate(
+        debit=Sum(Case(When(amount__lt=0, then=F('amount')), default=0, output_field=amount)),
+        credit=Sum(Case(When(amount__gt=0, then=F('amount')), default=0, output_field=amount)),
+    )
+    for row in rows:
+        yield TRIAL_BALANCE, row['account_id'], (Decimal(row['debit']), Decimal(row['credit']))
+
+
+CHECKS = {
+    UNBALANCED_TRANSACTIONS: unbalanced_transactions,
+    BALANCE_DRIFT: balance_drift,
+    TRIAL_BALANCE: trial_balance,
+}
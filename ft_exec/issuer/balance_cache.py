@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Cached balance responses, keyed on (account, balance type, point in time).
+
+Every account has a version token in the cache. The ledger replaces the
+tokens of the accounts it posts to (``invalidate``), which orphans all the
+cached balances of those accounts at once. The version token is also the
+ETag of a balance, so a client repeating a request with ``If-None-Match``
+can be answered 304 without computing the balance or touching the database.
+
+The cache alias is configurable. Local memory only sees the invalidations
+made by its own process, a shared cache keeps several workers consistent.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+CachedBalance = namedtuple('CachedBalance', ['version', 'etag', 'data'])
+
+
+def _cache():
+    return caches[settings.BALANCE_CACHE]
+
+
+def _version_key(account_id):
+    return 'balance-version:%s' % account_id
+
+
+def _key(account_id, balance_type, point_in_time):
+    return 'balance:%s:%s:%s' % (account_id, balance_type, point_in_time)
+
+
+def lookup(account_id, balance_type, point_in_time):
+    """
+    CachedBalance of the current version of a balance, ``data`` is None when it has not been cached yet
+    """
+    cache = _cache()
+    version_key, key = _version_key(account_id), _key(account_id, balance_type, point_in_time)
+    values = cache.get_many([version_key, key])
+    version = values.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+
+    etag = '"%s"' % hashlib.md5(('%s:%s' % (key, version)).encode('utf-8')).hexdigest()
+    entry = values.get(key)
+    data = entry[1] if entry is not None and entry[0] == version else None
+    return CachedBalance(version, etag, data)
+
+
+def store(account_id, balance_type, point_in_time, version, data):
+    _cache().set(_key(account_id, balance_type, point_in_time), (version, data), settings.BALANCE_CACHE_TTL)
+
+
+def _replace_versions(account_ids):
+    _cache().set_many(dict((_version_key(account_id), uuid.uuid4().hex) for account_id in account_ids), None)
+
+
+def invalidate(account_ids):
+    """
+    Orphan the cached balances of accounts whose balances are changed
+    """
+    account_ids = list(account_ids)
+    _replace_versions(account_ids)
+    # Balances read between now and the commit are still the old ones and
+    # may have been cached under the versions just made, replace them again.
+    transaction.on_commit(lambda: _replace_versions(account_ids))
+
+
+def invalidate_account(sender, instance, **kwargs):
+    """
+    post_save receiver for accounts changed outside the ledger (admin, accounts API)
+    """
+    invalidate([instance.pk])
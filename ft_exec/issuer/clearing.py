@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Background clearing of presentments.
+
+``enqueue`` records a clearing job for the presentments received so far and
+the ``clearing_worker`` command runs it. Every chunk of presentments is
+claimed, summed and posted to the ledger in its own DB transaction together
+with the job's cursor, so a run never holds one giant transaction and a job
+that dies half way resumes after its last committed chunk.
+"""
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from issuer import ledger
+from issuer.constants import CLEARING_STATUSES, MESSAGE_TYPES, TRANSACTION_STATUSES
+from issuer.ledger import Posting
+from issuer.models import ClearingBatch, SchemeMessage
+from issuer.utils import get_bank_acount, get_equity_account, get_scheme_account
+
+
+def uncleared_presentments():
+    return SchemeMessage.objects.filter(type=MESSAGE_TYPES.PRESENTMENT, clearing__isnull=True)
+
+
+def enqueue():
+    """
+    Create a pending job for every presentment not cleared yet
+    """
+    pending = uncleared_presentments().aggregate(until=Max('pk'), total=Count('pk'))
+    return ClearingBatch.objects.create(until_message_id=pending['until'] or 0, total_messages=pending['total'])
+
+
+def next_job():
+    """
+    Oldest job waiting to run, interrupted runs included
+    """
+    return ClearingBatch.objects.filter(
+        status__in=(CLEARING_STATUSES.PENDING, CLEARING_STATUSES.RUNNING)
+    ).order_by('id').first()
+
+
+def run(job, chunk_size):
+    """
+    Clear all presentments of ``job``, chunk by chunk.
+
+    A failing chunk is rolled back, the job is marked failed and the error re-raised.
+    """
+    ClearingBatch.objects.filter(pk=job.pk).exclude(status=CLEARING_STATUSES.DONE).update(
+        status=CLEARING_STATUSES.RUNNING, started_at=job.started_at or timezone.now(), error='')
+    try:
+        while process_chunk(job.pk, chunk_size):
+            pass
+    except Exception as e:
+        ClearingBatch.objects.filter(pk=job.pk).update(status=CLEARING_STATUSES.FAILED, error=repr(e))
+        raise
+    job.refresh_from_db()
+    return job
+
+
+def process_chunk(job_id, chunk_size):
+    """
+    Clear the next ``chunk_size`` presentments of a job in one DB transaction.
+
+    Returns False once the job is done.
+    """
+    with transaction.atomic():
+        # Serialises workers on the same job and re-reads its cursor
+        job = ClearingBatch.objects.select_for_update().get(pk=job_id)
+        if job.status == CLEARING_STATUSES.DONE:
+            return False
+
+        chunk_ids = list(uncleared_presentments().filter(
+            pk__gt=job.last_message_id, pk__lte=job.until_message_id
+        ).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not chunk_ids:
+            job.status = CLEARING_STATUSES.DONE
+            job.finished_at = timezone.now()
+            job.save(update_fields=['status', 'finished_at'])
+            return False
+
+        chunk = SchemeMessage.objects.filter(pk__gt=job.last_message_id, pk__lte=chunk_ids[-1])
+        claimed = chunk.filter(type=MESSAGE_TYPES.PRESENTMENT, clearing__isnull=True).update(clearing=job)
+        sums = chunk.filter(clearing=job).aggregate(billing_sum=Sum('billing_amount'),
+                                                    settlement_sum=Sum('settlement_amount'))
+        billing_amount = sums['billing_sum'] or Decimal('0.00')
+        settlement_amount = sums['settlement_sum'] or Decimal('0.00')
+
+        if claimed:
+            bank = get_bank_acount()
+            ledger.post([
+                Posting(bank, get_scheme_account(), settlement_amount, TRANSACTION_STATUSES.PROCESSED,
+                        job.external_transaction_id),
+                Posting(bank, get_equity_account(), billing_amount - settlement_amount,
+                        TRANSACTION_STATUSES.PROCESSED, job.external_transaction_id),
+            ])
+
+        job.billing_amount += billing_amount
+        job.settlement_amount += settlement_amount
+        job.cleared_messages += claimed
+        job.last_message_id = chunk_ids[-1]
+        job.save(update_fields=['billing_amount', 'settlement_amount', 'cleared_messages', 'last_message_id'])
+    return True
@@ -34,7 +34,15 @@ class MESSAGE_TYPES(object):
     PRESENTMENT = 'presentment'
 
 
+class CLEARING_STATUSES(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+# Statuses of the transactions moving each balance type
 TRANSACTION_BALANCE_MAPPING = {
-    BALANCE_TYPES.LEDGER: TRANSACTION_STATUSES.PROCESSED,
-    BALANCE_TYPES.AVAILABLE: TRANSACTION_STATUSES.HOLD
+    BALANCE_TYPES.LEDGER: (TRANSACTION_STATUSES.PROCESSED, ),
+    BALANCE_TYPES.AVAILABLE: (TRANSACTION_STATUSES.CANCELED, TRANSACTION_STATUSES.HOLD, TRANSACTION_STATUSES.PROCESSED),
 }
\ No newline at end of file
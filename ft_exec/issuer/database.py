@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    connection_created receiver applying settings.SQLITE_PRAGMAS to new SQLite connections
+    """
+    if connection.vendor != 'sqlite':
+        return
+    # On the raw connection, the pragmas are no queries of the request that opened it
+    for name, value in settings.SQLITE_PRAGMAS:
+        connection.connection.execute('PRAGMA %s = %s' % (name, value))
@@ -2,6 +2,18 @@
 from rest_framework.views import exception_handler
 
 
+class InsufficientFunds(Exception):
+    """
+    A guarded posting would take the balance of an account to zero or below
+    """
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    A view issued more SQL queries than its QUERY_BUDGETS entry allows
+    """
+
+
 def simple_exception_handler(exc, context):
     response = exception_handler(exc, context)
 
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoding and decoding behind the fast API renderer and parser.
+
+Uses orjson when it is installed and otherwise the C encoder of the json
+module with one prebuilt encoder. Decimals are written as strings so amounts never pass through
+float; every other type is encoded the way DRF's own JSONEncoder does it.
+"""
+from __future__ import unicode_literals
+
+import json
+from decimal import Decimal
+
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class DecimalSafeJSONEncoder(JSONEncoder):
+
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return str(obj)
+        return super(DecimalSafeJSONEncoder, self).default(obj)
+
+
+_default = DecimalSafeJSONEncoder().default
+
+if orjson is not None:
+    backend = 'orjson'
+
+    def dumps(data):
+        # DRF's encoder trims datetimes to milliseconds, keep that rather than orjson's format
+        return orjson.dumps(data, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+    def loads(content):
+        return orjson.loads(content)
+
+else:
+    backend = 'json'
+    # One encoder for all calls instead of one per response, it still takes the C path
+    _encoder = DecimalSafeJSONEncoder(ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+
+    def _reject_constant(constant):
+        raise ValueError('%s is not valid JSON' % constant)
+
+    def dumps(data):
+        return _encoder.encode(data).encode('utf-8')
+
+    def loads(content):
+        return json.loads(content.decode('utf-8'), parse_constant=_reject_constant)
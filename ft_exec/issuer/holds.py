@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Expiry of authorisation holds.
+
+An authorisation hold is a ``HOLD`` transaction moving the amount out of the
+card's available balance. It carries ``expires_at`` (``HOLD_EXPIRY_DAYS``,
+per MCC in ``HOLD_EXPIRY_DAYS_BY_MCC``) for as long as it is open. The
+presentment of the transaction settles the hold and clears ``expires_at``.
+Otherwise the ``expire_holds`` command releases it once it expired.
+
+A hold is released with a ``CANCELED`` posting of the held amount (see
+``held_amounts``) from the bank back to the card, whether its presentment or
+its expiry releases it.
+
+Only open holds have ``expires_at``, so the sweeper finds the expired ones on
+the index of that column and its work grows with the number of expired holds,
+not with the history of transactions.
+"""
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from issuer import ledger
+from issuer.constants import TRANSACTION_STATUSES
+from issuer.ledger import Posting
+from issuer.models import Account, Transaction, Transfer
+from issuer.utils import get_bank_acount
+
+
+def expires_at(merchant_mcc, now=None):
+    """
+    Expiry of a hold authorised now for a merchant of ``merchant_mcc``
+    """
+    days = settings.HOLD_EXPIRY_DAYS_BY_MCC.get(merchant_mcc, settings.HOLD_EXPIRY_DAYS)
+    return (now or timezone.now()) + timedelta(days=days)
+
+
+def held_amounts(transfers):
+    """
+    {(scheme transaction id, account id): amount held} of the holds among ``transfers``
+
+    The card side of a hold carries the change of the card's available
+    balance, the amount held is its opposite. Pass the transfers of the
+    card accounts only.
+    """
+    amounts = {}
+    for transaction_id, account_id, amount in transfers.filter(transaction__status=TRANSACTION_STATUSES.HOLD).order_by(
+            '-created_at').values_list('transaction__external_transaction_id', 'account_id', 'amount'):
+        amounts.setdefault((transaction_id, account_id), -amount)
+    return amounts
+
+
+def open_holds(transaction_ids):
+    return Transaction.objects.filter(external_transaction_id__in=transaction_ids,
+                                      status=TRANSACTION_STATUSES.HOLD, expires_at__isnull=False)
+
+
+def settle(transaction_ids):
+    """
+    Take the holds of presented scheme transactions out of expiry.
+
+    Call it in the DB transaction posting the presentments. Returns the ids
+    whose hold has already been released by ``expire_holds``, their
+    presentments must not release it again.
+    """
+    transaction_ids = list(transaction_ids)
+    settled = open_holds(transaction_ids).update(expires_at=None)
+    if settled >= len(transaction_ids):
+        return set()
+    return set(Transaction.objects.filter(
+        external_transaction_id__in=transaction_ids, status=TRANSACTION_STATUSES.CANCELED
+    ).values_list('external_transaction_id', flat=True))
+
+
+def expired_holds(now=None):
+    return Transaction.objects.filter(status=TRANSACTION_STATUSES.HOLD, expires_at__lte=now or timezone.now())
+
+
+def release_expired(chunk_size, now=None):
+    """
+    Release up to ``chunk_size`` expired holds in one DB transaction, returns how many
+    """
+    bank = get_bank_acount()
+    with transaction.atomic():
+        hold_ids = list(expired_holds(now).select_for_update().order_by('expires_at', 'pk').values_list(
+            'pk', flat=True)[:chunk_size])
+        if not hold_ids:
+            return 0
+
+        amounts = held_amounts(Transfer.objects.filter(transaction_id__in=hold_ids).exclude(account_id=bank.pk))
+        accounts = Account.objects.only('id', 'type').in_bulk(set(account_id for _, account_id in amounts))
+
+        postings = []
+        for (external_transaction_id, account_id), amount in sorted(amounts.items()):
+            postings.append(Posting(bank, accounts[account_id], amount, TRANSACTION_STATUSES.CANCELED,
+                                    external_transaction_id))
+        Transaction.objects.filter(pk__in=hold_ids).update(expires_at=None)
+        ledger.post(postings)
+    return len(hold_ids)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Responses to scheme messages already processed, keyed on (type, transaction_id).
+
+Scheme retries of such a message are answered from here without validating
+the message again or touching the ledger. The cache alias is configurable,
+the default local-memory cache is per process, a database or shared cache
+lets all workers answer each other's retries.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def _cache():
+    return caches[settings.IDEMPOTENCY_CACHE]
+
+
+def _key(message_type, transaction_id):
+    return 'scheme-message:%s:%s' % (message_type, transaction_id)
+
+
+def get_response(message_type, transaction_id):
+    """
+    (data, status_code) of the original response or None
+    """
+    return _cache().get(_key(message_type, transaction_id))
+
+
+def remember_response(message_type, transaction_id, data, status_code):
+    _cache().set(_key(message_type, transaction_id), (data, status_code), settings.IDEMPOTENCY_TTL)
+
+
+def remember_responses(message_type, responses):
+    """
+    Store several responses at once, ``responses`` maps transaction id to (data, status_code)
+    """
+    _cache().set_many(dict((_key(message_type, transaction_id), response)
+                           for transaction_id, response in responses.items()),
+                      settings.IDEMPOTENCY_TTL)
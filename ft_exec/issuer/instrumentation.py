@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request instrumentation of the webhook views.
+
+Every request records its query count, DB time and the time spent in the
+named phases wrapped with ``timed()`` (serializer validation, ledger
+posting). The numbers go out as a ``Server-Timing`` header and are added up
+per view in a process-local registry that ``metrics_view`` exposes in the
+Prometheus text format.
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.conf import settings
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+from django.http import HttpResponse, HttpResponseForbidden
+
+from issuer.exceptions import QueryBudgetExceeded
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_local = threading.local()
+
+
+class RequestMetrics(object):
+
+    def __init__(self):
+        self.queries = 0
+        self.phases = defaultdict(float)
+
+
+def _current():
+    return getattr(_local, 'metrics', None)
+
+
+@contextmanager
+def timed(phase):
+    """
+    Add the time spent in the block to ``phase`` of the current request
+    """
+    started = default_timer()
+    try:
+        yield
+    finally:
+        metrics = _current()
+        if metrics is not None:
+            metrics.phases[phase] += default_timer() - started
+
+
+@contextmanager
+def measured():
+    """
+    RequestMetrics of the block, for requests served outside the middleware (``issuer.asgi``)
+    """
+    _local.metrics = metrics = RequestMetrics()
+    try:
+        yield metrics
+    finally:
+        _local.metrics = None
+
+
+class QueryTimingMixin(object):
+
+    def execute(self, sql, params=None):
+        started = default_timer()
+        try:
+            return super(QueryTimingMixin, self).execute(sql, params)
+        finally:
+            self._record(default_timer() - started)
+
+    def executemany(self, sql, param_list):
+        started = default_timer()
+        try:
+            return super(QueryTimingMixin, self).executemany(sql, param_list)
+        finally:
+            self._record(default_timer() - started)
+
+    def _record(self, duration):
+        metrics = _current()
+        if metrics is not None:
+            metrics.queries += 1
+            metrics.phases['db'] += duration
+
+
+class TimingCursorWrapper(QueryTimingMixin, CursorWrapper):
+    pass
+
+
+class TimingCursorDebugWrapper(QueryTimingMixin, CursorDebugWrapper):
+    pass
+
+
+def install_query_timing(sender, connection, **kwargs):
+    """
+    connection_created receiver wrapping every cursor of the connection with timing
+    """
+    connection.make_cursor = lambda cursor: TimingCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: TimingCursorDebugWrapper(cursor, connection)
+
+
+class MetricsRegistry(object):
+    """
+    Totals per view since the process started
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = defaultdict(int)
+            self.queries = defaultdict(int)
+            self.phase_seconds = defaultdict(float)
+            self.duration_buckets = defaultdict(int)
+            self.duration_sum = defaultdict(float)
+
+    def observe(self, view_name, metrics, duration):
+        with self._lock:
+            self.requests[view_name] += 1
+            self.queries[view_name] += metrics.queries
+            for phase, seconds in metrics.phases.items():
+                self.phase_seconds[(view_name, phase)] += seconds
+            for bucket in DURATION_BUCKETS:
+                if duration <= bucket:
+                    self.duration_buckets[(view_name, bucket)] += 1
+            self.duration_sum[view_name] += duration
+
+    def render(self):
+        with self._lock:
+            lines = [
+                '# HELP ft_exec_requests_total Requests handled per view.',
+                '# TYPE ft_exec_requests_total counter',
+            ]
+            lines += ['ft_exec_requests_total{view="%s"} %d' % (view, count)
+                      for view, count in sorted(self.requests.items())]
+            lines += [
+                '# HELP ft_exec_db_queries_total SQL queries issued per view.',
+                '# TYPE ft_exec_db_queries_total counter',
+            ]
+            lines += ['ft_exec_db_queries_total{view="%s"} %d' % (view, count)
+                      for view, count in sorted(self.queries.items())]
+            lines += [
+                '# HELP ft_exec_phase_seconds_total Time spent per view in db, serializer and ledger phases.',
+                '# TYPE ft_exec_phase_seconds_total counter',
+            ]
+            lines += ['ft_exec_phase_seconds_total{view="%s",phase="%s"} %.6f' % (view, phase, seconds)
+                      for (view, phase), seconds in sorted(self.phase_seconds.items())]
+            lines += [
+                '# HELP ft_exec_request_duration_seconds Request duration per view.',
+                '# TYPE ft_exec_request_duration_seconds histogram',
+            ]
+            for view, count in sorted(self.requests.items()):
+                for bucket in DURATION_BUCKETS:
+                    lines.append('ft_exec_request_duration_seconds_bucket{view="%s",le="%s"} %d' % (
+                        view, bucket, self.duration_buckets[(view, bucket)]))
+                lines.append('ft_exec_request_duration_seconds_bucket{view="%s",le="+Inf"} %d' % (view, count))
+                lines.append('ft_exec_request_duration_seconds_sum{view="%s"} %.6f' % (
+                    view, self.duration_sum[view]))
+                lines.append('ft_exec_request_duration_seconds_count{view="%s"} %d' % (view, count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class InstrumentationMiddleware(object):
+    """
+    Measures every request routed to a view and reports it through
+    ``Server-Timing`` and the metrics registry. Views over their entry in
+    ``QUERY_BUDGETS`` are logged, or fail with ``QueryBudgetExceeded`` when
+    ``QUERY_BUDGET_STRICT`` is on (test mode).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.instrumented_view = None
+        started = default_timer()
+        with measured() as metrics:
+            response = self.get_response(request)
+        duration = default_timer() - started
+
+        view_name = request.instrumented_view
+        if view_name is None:
+            return response
+
+        registry.observe(view_name, metrics, duration)
+        response['Server-Timing'] = server_timing(metrics, duration)
+        check_query_budget(view_name, metrics)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+        request.instrumented_view = (view_class or view_func).__name__
+
+
+def server_timing(metrics, duration):
+    timings = ['db;dur=%.2f;desc="%d queries"' % (metrics.phases['db'] * 1000, metrics.queries)]
+    timings += ['%s;dur=%.2f' % (phase, seconds * 1000)
+                for phase, seconds in sorted(metrics.phases.items()) if phase != 'db']
+    timings.append('total;dur=%.2f' % (duration * 1000))
+    return ', '.join(timings)
+
+
+def check_query_budget(view_name, metrics):
+    budget = settings.QUERY_BUDGETS.get(view_name)
+    if budget is None or metrics.queries <= budget:
+        return
+    message = '%s issued %d queries, its budget is %d' % (view_name, metrics.queries, budget)
+    if settings.QUERY_BUDGET_STRICT:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, only served to METRICS_ALLOWED_IPS
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Double-entry posting engine.
+
+A posting moves ``amount`` from one account to another the way
+``Account.transfer_to`` always did, but a whole batch of postings is written
+with two ``bulk_create`` calls (transactions, then transfers) and one
+``F()``-expression UPDATE per affected account. Every transfer carries the
+running balances of its account right after it, read back in one query
+after all the UPDATEs hold their row locks. The amount of a transaction
+is the gross amount moved, computed here once instead of being aggregated
+back from its transfers on every save.
+
+A posting may carry a ``guard`` naming the balance type (see ``BALANCE_TYPES``)
+of its source account that has to stay above zero. Guarded accounts are
+updated first with a conditional ``UPDATE ... WHERE amount_<guard> > x``, so
+funds are checked and taken in one statement under the row lock and
+concurrent postings against the same card cannot lose updates.
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple, OrderedDict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+
+from issuer import balance_cache, instrumentation, routers
+from issuer.constants import TRANSACTION_STATUSES, BALANCE_TYPES
+from issuer.exceptions import InsufficientFunds
+from issuer.models import Account, Transaction, Transfer
+
+
+Posting = namedtuple('Posting', ['from_account', 'to_account', 'amount', 'status', 'external_transaction_id',
+                                 'guard', 'expires_at'])
+Posting.__new__.__defaults__ = (None, None)
+
+
+def post(postings):
+    """
+    Write a batch of postings in one DB transaction.
+
+    Returns the created transactions in the order of ``postings``. Raises
+    ``InsufficientFunds`` and writes nothing when a guard does not hold.
+    """
+    postings = list(postings)
+    if not postings:
+        return []
+
+    deltas = balance_deltas(postings)
+    account_ids = list(deltas)
+    guards = {}
+    for posting in postings:
+        if posting.guard:
+            guards.setdefault(posting.from_account.pk, set()).add(posting.guard)
+
+    with instrumentation.timed('ledger'), transaction.atomic():
+        # In account id order, so concurrent batches lock the accounts they
+        # share in the same order and cannot deadlock on each other.
+        for account_id in sorted(account_ids):
+            available_delta, ledger_delta = deltas[account_id]
+            balance_types = guards.get(account_id, ())
+            if not apply_balance_delta(account_id, available_delta, ledger_delta, guards=balance_types) \
+                    and balance_types:
+                raise InsufficientFunds(account_id)
+
+        # Every affected row is locked by now (accounts whose balances do not
+        # change too), so these are the balances after the whole batch and
+        # nobody else can move them before we commit.
+        balances = dict((account_id, [available, ledger]) for account_id, available, ledger in
+                        Account.objects.filter(pk__in=account_ids)
+                        .values_list('pk', 'amount_available', 'amount_ledger'))
+        running_balances = _running_balances(postings, balances)
+
+        transactions = _bulk_create(Transaction, [
+            Transaction(status=posting.status,
+                        external_transaction_id=posting.external_transaction_id,
+                        amount=abs(posting.amount),
+                        expires_at=posting.expires_at)
+            for posting in postings
+        ])
+
+        transfers = []
+        for posting, posted_transaction, posting_balances in zip(postings, transactions, running_balances):
+            from_balance, to_balance = posting_balances
+            from_amount, to_amount = transfer_amounts(posting)
+            transfers.append(Transfer(transaction=posted_transaction, account_id=posting.from_account.pk,
+                                      amount=from_amount,
+                                      balance_available=from_balance[0], balance_ledger=from_balance[1]))
+            transfers.append(Transfer(transaction=posted_transaction, account_id=posting.to_account.pk,
+                                      amount=to_amount,
+                                      balance_available=to_balance[0], balance_ledger=to_balance[1]))
+        Transfer.objects.bulk_create(transfers)
+
+    routers.mark_written(account_ids)
+    balance_cache.invalidate(account_ids)
+    return transactions
+
+
+def transfer_amounts(posting):
+    """
+    Signed amounts of the (from, to) transfers of a posting.
+
+    A transfer carries the change of its account's balances, so the transfers
+    of a transaction net to zero and the balance of an account moved by the
+    transfers in any period is their plain sum.
+    """
+    return -posting.amount, posting.amount
+
+
+def balance_deltas(postings):
+    """
+    Net (available, ledger) change per account id for a batch of postings.
+    """
+    deltas = OrderedDict()
+    for posting in postings:
+        for account_id, available_change, ledger_change in _posting_deltas(posting):
+            available_delta, ledger_delta = deltas.get(account_id, (Decimal('0'), Decimal('0')))
+            deltas[account_id] = (available_delta + available_change, ledger_delta + ledger_change)
+    return deltas
+
+
+def _posting_deltas(posting):
+    """
+    (account id, available change, ledger change) of the from and to side of a posting
+    """
+    affects_ledger = posting.status in (TRANSACTION_STATUSES.PROCESSED, )
+    for account, sign in ((posting.from_account, -1), (posting.to_account, 1)):
+        change = sign * posting.amount
+        yield account.pk, change, change if affects_ledger else Decimal('0')
+
+
+def _running_balances(postings, balances):
+    """
+    ((available, ledger) of the from account, the same of the to account) right
+    after each posting, walking back from the balances after the whole batch.
+    """
+    running_balances = []
+    for posting in reversed(postings):
+        posting_balances = []
+        for account_id, available_change, ledger_change in reversed(list(_posting_deltas(posting))):
+            balance = balances[account_id]
+            posting_balances.insert(0, tuple(balance))
+            balance[0] -= available_change
+            balance[1] -= ledger_change
+        running_balances.insert(0, posting_balances)
+    return running_balances
+
+
+def apply_balance_delta(account_id, available_delta, ledger_delta, guards=()):
+    """
+    Shift the stored balances of one account in a single UPDATE.
+
+    ``guards`` lists balance types which must stay above zero after the change;
+    returns False and leaves the row untouched when one of them would not.
+    A row with nothing to change is still locked for the rest of the DB transaction.
+    """
+    queryset = Account.objects.filter(pk=account_id)
+    for balance_type in guards:
+        delta = available_delta if balance_type == BALANCE_TYPES.AVAILABLE else ledger_delta
+        queryset = queryset.filter(**{'amount_%s__gt' % balance_type: -delta})
+
+    changes = {}
+    if available_delta:
+        changes['amount_available'] = F('amount_available') + available_delta
+    if ledger_delta:
+        changes['amount_ledger'] = F('amount_ledger') + ledger_delta
+    if not changes:
+        return queryset.select_for_update().exists() or not guards
+    return queryset.update(**changes) > 0
+
+
+def _bulk_create(model, objs):
+    objs = model.objects.bulk_create(objs)
+    if objs and objs[0].pk is None:
+        # Backends that cannot return ids from a bulk insert (SQLite) hold the
+        # write lock until the surrounding transaction ends, so the rows we just
+        # inserted are the ones with the highest ids, in insertion order.
+        pks = sorted(model.objects.order_by('-pk').values_list('pk', flat=True)[:len(objs)])
+        for obj, pk in zip(objs, pks):
+            obj.pk = pk
+    return objs
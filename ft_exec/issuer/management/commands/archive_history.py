@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from issuer import archive
+
+
+class Command(BaseCommand):
+    help = "Move the transactions, transfers and scheme messages of months closed more than " \
+           "ARCHIVE_AFTER_DAYS days ago to the archive tables. Balances and statements still " \
+           "include them, reading the archive only for the dates it covers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='Only archive this month (YYYY-MM)')
+        parser.add_argument('--chunk-size', type=int, default=settings.ARCHIVE_CHUNK_SIZE,
+                            help='Rows moved per DB transaction')
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try:
+                months = [datetime.strptime(options['month'], '%Y-%m')]
+            except ValueError:
+                raise CommandError('%r is not a month (YYYY-MM)' % options['month'])
+        else:
+            months = archive.archivable_months()
+
+        for month in months:
+            try:
+                period = archive.archive_month(month, options['chunk_size'])
+            except ValueError as e:
+                raise CommandError(e)
+            self.stdout.write('%s: %s transactions, %s transfers, %s scheme messages archived' % (
+                month.strftime('%Y-%m'), period.transactions, period.transfers, period.messages))
+
+        self.stdout.write(self.style.SUCCESS('Successfully archived %s months' % len(months)))
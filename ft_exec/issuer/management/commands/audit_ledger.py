@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from decimal import Decimal
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+
+from issuer import audit
+from issuer.models import Account, LedgerAudit, Transfer
+
+
+class Command(BaseCommand):
+    help = "Check the integrity of the ledger: every transaction has two transfers netting to zero, the " \
+           "stored balances of every account equal its earliest checkpoint plus the sum of its transfers " \
+           "since and, with --trial-balance, debits and credits net to zero. Exits with an error if " \
+           "problems are found. Run balance_checkpoints before the first audit: accounts without a " \
+           "checkpoint which do not add up from zero are only reported as missing one."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.AUDIT_PROCESSES,
+                            help='Processes running the checks, 1 runs them in this process')
+        parser.add_argument('--chunk-size', type=int, default=settings.AUDIT_CHUNK_SIZE,
+                            help='Transfer or account ids checked per task')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only check the transfers after the last audit without problems '
+                                 'and their accounts')
+        parser.add_argument('--trial-balance', action='store_true',
+                            help='Also print the debits and credits of every account')
+
+    def handle(self, *args, **options):
+        since_transfer_id = 0
+        if options['incremental']:
+            last_audit = LedgerAudit.objects.filter(finished_at__isnull=False, problems=0).first()
+            since_transfer_id = last_audit.last_transfer_id if last_audit is not None else 0
+
+        ledger_audit = LedgerAudit.objects.create(
+            incremental=options['incremental'], since_transfer_id=since_transfer_id,
+            last_transfer_id=Transfer.objects.aggregate(last=Max('pk'))['last'] or 0,
+        )
+        tasks = audit.tasks(since_transfer_id, ledger_audit.last_transfer_id,
+                            Account.objects.aggregate(last=Max('pk'))['last'] or 0,
+                            options['chunk_size'], trial_balance=options['trial_balance'])
+
+        problems, debit, credit = set(), Decimal('0'), Decimal('0')
+        for check, object_id, detail in self.run(tasks, options['processes']):
+            if check == audit.TRIAL_BALANCE:
+                debit, credit = debit + detail[0], credit + detail[1]
+                self.stdout.write('Account %s: debit %s, credit %s' % (object_id, detail[0], detail[1]))
+            elif check == audit.NO_CHECKPOINT:
+                # Not a problem, its opening balance is unknown until balance_checkpoints runs
+                self.stdout.write(self.style.WARNING('%s %s: %s, run balance_checkpoints' % (
+                    check, object_id, detail)))
+            elif (check, object_id) not in problems:
+                # A transaction with transfers in two chunks is reported by both
+                problems.add((check, object_id))
+                self.stdout.write(self.style.ERROR('%s %s: %s' % (check, object_id, detail)))
+
+        if options['trial_balance']:
+            self.stdout.write('Total: debit %s, credit %s' % (debit, credit))
+            if debit + credit:
+                problems.add((audit.TRIAL_BALANCE, None))
+                self.stdout.write(self.style.ERROR('%s: debits and credits net to %s' % (
+                    audit.TRIAL_BALANCE, debit + credit)))
+
+        ledger_audit.problems = len(problems)
+        ledger_audit.finished_at = timezone.now()
+        ledger_audit.save(update_fields=['problems', 'finished_at'])
+        if problems:
+            raise CommandError('%s problems found up to transfer %s' % (len(problems),
+                                                                        ledger_audit.last_transfer_id))
+        self.stdout.write(self.style.SUCCESS('Successfully audited the ledger up to transfer %s' %
+                                             ledger_audit.last_transfer_id))
+
+    def run(self, tasks, processes):
+        """
+        Lines found by the tasks, streamed as the tasks finish
+        """
+        if processes <= 1:
+            for task in tasks:
+                for line in audit.run(task):
+                    yield line
+            return
+
+        # Forked workers must open connections of their own
+        connections.close_all()
+        pool = Pool(processes)
+        try:
+            for lines in pool.imap_unordered(audit.run, tasks):
+                for line in lines:
+                    yield line
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from issuer.models import Transaction, Transfer
+
+
+class Command(BaseCommand):
+    help = "Recompute the amount of existing transactions from their transfers, " \
+           "one UPDATE per chunk of transaction ids. Safe to re-run and to resume with --from-id."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Transactions per UPDATE')
+        parser.add_argument('--from-id', type=int, default=0, help='Start at this transaction id')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = Transaction.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+
+        amount_field = Transaction._meta.get_field('amount')
+        # Transactions without transfers moved nothing
+        gross_amount = Coalesce(Subquery(
+            Transfer.objects.filter(transaction=OuterRef('pk')).order_by().values('transaction')
+            .annotate(gross=Transaction.gross_amount_expression()).values('gross'), output_field=amount_field
+        ), Value(0), output_field=amount_field)
+
+        updated = 0
+        for start in range(options['from_id'], last_id + 1, chunk_size):
+            with transaction.atomic():
+                updated += Transaction.objects.filter(
+                    pk__gte=start, pk__lt=start + chunk_size
+                ).update(amount=gross_amount)
+            self.stdout.write('Transactions up to id %s: %s updated' % (start + chunk_size - 1, updated))
+
+        self.stdout.write(self.style.SUCCESS('%s transactions back-filled' % updated))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+
+from issuer.constants import BALANCE_TYPES, TRANSACTION_BALANCE_MAPPING
+from issuer.models import Account, BalanceCheckpoint
+
+
+class Command(BaseCommand):
+    help = "Build today's balance checkpoints and back-fill the missing daily ones. " \
+           "Meant to be run once a day."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Back-fill at most that many days (default: the whole history)')
+        parser.add_argument('--account', dest='account_ids', nargs='+', type=int,
+                            help='Only build checkpoints for these account ids')
+
+    def handle(self, *args, **options):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        since = today - timedelta(days=options['days']) if options['days'] is not None else None
+
+        account_ids = Account.objects.values_list('pk', flat=True)
+        if options['account_ids']:
+            account_ids = account_ids.filter(pk__in=options['account_ids'])
+
+        for account_id in account_ids:
+            created = self._build_checkpoints(account_id, today, since)
+            self.stdout.write(self.style.SUCCESS('Account %s: %s new checkpoints' % (account_id, created)))
+
+    def _build_checkpoints(self, account_id, today, since):
+        with transaction.atomic():
+            account = Account.objects.select_for_update().get(pk=account_id)
+
+            # {day: {balance type: sum of the transfers made that day}}, archived ones included
+            daily_sums = {}
+            statuses = set(status for balance_statuses in TRANSACTION_BALANCE_MAPPING.values()
+                           for status in balance_statuses)
+            for transfers in (account.transfers, account.archived_transfers):
+                rows = transfers.filter(
+                    transaction__status__in=statuses
+                ).annotate(
+                    day=TruncDay('created_at')
+                ).order_by().values('day', 'transaction__status').annotate(summ=Sum('amount'))
+                for row in rows:
+                    for balance_type, balance_statuses in TRANSACTION_BALANCE_MAPPING.items():
+                        if row['transaction__status'] in balance_statuses:
+                            sums = daily_sums.setdefault(row['day'], {})
+                            sums[balance_type] = sums.get(balance_type, 0) + row['summ']
+
+            boundaries = [today]
+            if daily_sums:
+                boundary = min(daily_sums) + timedelta(days=1)
+                while boundary < today:
+                    boundaries.append(boundary)
+                    boundary += timedelta(days=1)
+            if since is not None:
+                boundaries = [boundary for boundary in boundaries if boundary >= since]
+
+            existing = set(account.checkpoints.filter(balance_at__in=boundaries)
+                           .values_list('balance_at', flat=True))
+
+            # Walk back from today, undoing each day's transfers like get_balance does
+            balances = dict((balance_type, getattr(account, 'amount_%s' % balance_type))
+                            for balance_type in TRANSACTION_BALANCE_MAPPING)
+            days = sorted(daily_sums, reverse=True)
+            checkpoints = []
+            for boundary in sorted(boundaries, reverse=True):
+                while days and days[0] >= boundary:
+                    for balance_type, summ in daily_sums.pop(days.pop(0)).items():
+                        balances[balance_type] -= summ
+                if boundary not in existing:
+                    checkpoints.append(BalanceCheckpoint(account=account, balance_at=boundary,
+                                                         amount_available=balances[BALANCE_TYPES.AVAILABLE],
+                                                         amount_ledger=balances[BALANCE_TYPES.LEDGER]))
+            BalanceCheckpoint.objects.bulk_create(checkpoints)
+        return len(checkpoints)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import timeit
+from decimal import Decimal
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from issuer import fastjson
+from issuer.constants import MESSAGE_TYPES
+from issuer.models import SchemeMessage
+from issuer.parsers import FastJSONParser
+from issuer.renderers import FastJSONRenderer
+from issuer.serializers import AuthMessageSerializer, PresentmentMessageSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare DRF's JSONRenderer/JSONParser with the fast ones on scheme message payloads. " \
+           "Needs no database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000, help='Calls per measurement')
+        parser.add_argument('--repeat', type=int, default=3, help='Measurements per case, the best one counts')
+
+    def handle(self, *args, **options):
+        self.stdout.write('fast JSON backend: %s' % fastjson.backend)
+        self.stdout.write('%-24s %7s %12s %12s %8s %12s %12s %8s' % (
+            'payload', 'bytes', 'render us', 'fast us', 'x', 'parse us', 'fast us', 'x'))
+
+        for name, payload in self.payloads():
+            stock = JSONRenderer().render(payload)
+            fast = FastJSONRenderer().render(payload)
+            if json.loads(stock.decode('utf-8')) != json.loads(fast.decode('utf-8')):
+                self.stdout.write(self.style.ERROR('%s: renderers disagree' % name))
+
+            timings = [
+                self.measure(lambda: JSONRenderer().render(payload), options),
+                self.measure(lambda: FastJSONRenderer().render(payload), options),
+                self.measure(lambda: JSONParser().parse(io.BytesIO(stock)), options),
+                self.measure(lambda: FastJSONParser().parse(io.BytesIO(stock)), options),
+            ]
+            self.stdout.write('%-24s %7d %12.2f %12.2f %8.2f %12.2f %12.2f %8.2f' % (
+                name, len(stock), timings[0], timings[1], timings[0] / timings[1],
+                timings[2], timings[3], timings[2] / timings[3]))
+
+    def measure(self, func, options):
+        """
+        Best time of one call, in microseconds
+        """
+        best = min(timeit.repeat(func, number=options['iterations'], repeat=options['repeat']))
+        return best / options['iterations'] * 1000000
+
+    def payloads(self):
+        authorisation = self.message(1, MESSAGE_TYPES.AUTHORISATION)
+        presentments = [self.message(i, MESSAGE_TYPES.PRESENTMENT) for i in range(100)]
+        return [
+            ('webhook response', {'success': True, 'status_code': 200, 'detail': 'Authorization success'}),
+            ('authorisation', AuthMessageSerializer(authorisation).data),
+            ('presentment', PresentmentMessageSerializer(presentments[0]).data),
+            ('100 presentments', PresentmentMessageSerializer(presentments, many=True).data),
+            ('100 batch results', {'success': True, 'status_code': 200, 'detail': [
+                {'transaction_id': message.transaction_id, 'success': True, 'status_code': 200,
+                 'detail': 'Authorization success'} for message in presentments]}),
+        ]
+
+    def message(self, number, message_type):
+        message = SchemeMessage(
+            id=number, type=message_type, card_id='4321LOBO', transaction_id='BN%010d' % number,
+            merchant_name='SNEAKERS R US', merchant_country='US', merchant_mcc=5139,
+            billing_amount=Decimal('90.00') + number, billing_currency='EUR',
+            transaction_amount=Decimal('100.00') + number, transaction_currency='USD',
+            created_at=timezone.now(),
+        )
+        if message_type == MESSAGE_TYPES.PRESENTMENT:
+            message.merchant_city = 'New York'
+            message.settlement_amount = Decimal('88.20') + number
+            message.settlement_currency = 'EUR'
+        return message
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import timeit
+
+from django.core.management import BaseCommand
+
+from issuer import messages
+from issuer.serializers import AuthMessageBatchSerializer, PresentmentMessageSerializer
+
+
+class PresentmentWithoutLookupsSerializer(PresentmentMessageSerializer):
+    """
+    The presentment serializer minus its queries, so both sides only measure validation
+    """
+
+    class Meta(PresentmentMessageSerializer.Meta):
+        validators = []
+
+    def validate_transaction_id(self, value):
+        return value
+
+
+class Command(BaseCommand):
+    help = "Compare validating scheme messages with the DRF serializers and with issuer.messages. " \
+           "Database lookups are left out on both sides, so it needs no database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000, help='Messages per measurement')
+        parser.add_argument('--repeat', type=int, default=3, help='Measurements per case, the best one counts')
+
+    def handle(self, *args, **options):
+        authorisation = {
+            'type': 'authorisation', 'card_id': '4321LOBO', 'transaction_id': 'BN0000000001',
+            'merchant_name': 'SNEAKERS R US', 'merchant_country': 'US', 'merchant_mcc': '5139',
+            'billing_amount': '90.00', 'billing_currency': 'EUR',
+            'transaction_amount': '100.00', 'transaction_currency': 'USD',
+        }
+        presentment = dict(authorisation, type='presentment', merchant_city='New York',
+                           settlement_amount='88.20', settlement_currency='EUR')
+        cases = [
+            ('authorisation', authorisation, AuthMessageBatchSerializer, messages.AUTHORISATION),
+            ('presentment', presentment, PresentmentWithoutLookupsSerializer, messages.PRESENTMENT),
+        ]
+
+        self.stdout.write('%-16s %14s %14s %8s' % ('message', 'serializer us', 'compiled us', 'x'))
+        for name, data, serializer_class, schema in cases:
+            serializer = serializer_class(data=data)
+            serializer.is_valid(raise_exception=True)
+            if dict(serializer.validated_data) != schema.validate(data, check_database=False):
+                self.stdout.write(self.style.ERROR('%s: validators disagree' % name))
+
+            stock = self.measure(lambda: serializer_class(data=data).is_valid(), options)
+            compiled = self.measure(lambda: schema.validate(data, check_database=False), options)
+            self.stdout.write('%-16s %14.2f %14.2f %8.2f' % (name, stock, compiled, stock / compiled))
+
+    def measure(self, func, options):
+        """
+        Best time of one call, in microseconds
+        """
+        best = min(timeit.repeat(func, number=options['iterations'], repeat=options['repeat']))
+        return best / options['iterations'] * 1000000
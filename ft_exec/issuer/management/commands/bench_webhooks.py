@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+import re
+import threading
+from collections import defaultdict
+from decimal import Decimal
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import BaseCommand, call_command
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment, \
+    teardown_test_environment
+from django.urls import reverse
+
+from issuer.constants import ACCOUNT_TYPES, MESSAGE_TYPES
+from issuer.models import Account
+from issuer.utils import invalidate_account_cache
+
+
+class Command(BaseCommand):
+    help = "Replay synthetic authorisation -> presentment -> clearing flows for many cards " \
+           "against a throwaway copy of the configured database. Reports throughput, " \
+           "p50/p99 latency and queries per request for every webhook, and how long " \
+           "the queued clearing job takes. --server asgi sends the same requests to the ASGI " \
+           "application (app/asgi.py) in process, --server both compares it with WSGI."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cards', type=int, default=50, help='Number of synthetic cards')
+        parser.add_argument('--transactions', type=int, default=20, help='Card transactions per card')
+        parser.add_argument('--concurrency', type=int, default=8, help='Parallel scheme clients')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random amounts')
+        parser.add_argument('--json', dest='json_path', help='Also write the report as JSON to this file')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database between runs')
+        parser.add_argument('--server', choices=('wsgi', 'asgi', 'both'), default='wsgi',
+                            help='Serve the requests with the WSGI handler, the ASGI application (Python 3) or '
+                                 'both one after the other')
+
+    def handle(self, *args, **options):
+        servers = ('wsgi', 'asgi') if options['server'] == 'both' else (options['server'], )
+        reports = []
+        for server in servers:
+            setup_test_environment(debug=False)
+            old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+            try:
+                reports.append(self.run_benchmark(options, server))
+            finally:
+                teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+                teardown_test_environment()
+
+        for report in reports:
+            self.write_report(report)
+        if len(reports) == 2:
+            self.stdout.write('asgi/wsgi throughput: %.2f' % (reports[1]['throughput'] / reports[0]['throughput']))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as report_file:
+                json.dump(reports if len(reports) > 1 else reports[0], report_file, indent=2, sort_keys=True)
+
+    def run_benchmark(self, options, server):
+        # Nothing cached by an earlier run in this process may answer for the new database
+        caches['idempotency'].clear()
+        caches[settings.BALANCE_CACHE].clear()
+        invalidate_account_cache()
+        call_command('loaddata', 'initial_data.json', verbosity=0)
+        card_ids = self.create_cards(options['cards'])
+        rng = random.Random(options['seed'])
+
+        # Every client works through its own cards, each card transaction is
+        # authorised and then presented, so holds and captures interleave.
+        flows = [[] for _ in range(options['concurrency'])]
+        for number in range(options['transactions']):
+            for index, card_id in enumerate(card_ids):
+                transaction_id = 'BN%010d' % (number * len(card_ids) + index)
+                billing_amount = Decimal('%d.%02d' % (rng.randint(1, 50), rng.randint(0, 99)))
+                flows[index % len(flows)].append((card_id, transaction_id, billing_amount))
+
+        samples = []
+        started = default_timer()
+        if server == 'asgi':
+            self.run_asgi_flows(flows, samples)
+        else:
+            threads = [threading.Thread(target=self.run_flows, args=(flow, samples)) for flow in flows]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = default_timer() - started
+
+        clearing_samples = []
+        self.run_flows([None], clearing_samples)
+        clearing_started = default_timer()
+        call_command('clearing_worker', once=True, stdout=self.stdout)
+        clearing_elapsed = default_timer() - clearing_started
+
+        report = {
+            'server': server,
+            'database': connection.vendor,
+            'cards': options['cards'],
+            'transactions': options['transactions'],
+            'concurrency': options['concurrency'],
+            'elapsed': elapsed,
+            'throughput': len(samples) / elapsed,
+            'clearing_job_seconds': clearing_elapsed,
+            'endpoints': {},
+        }
+        for endpoint, endpoint_samples in self.group(samples + clearing_samples).items():
+            latencies = sorted(sample['latency'] for sample in endpoint_samples)
+            queries = [sample['queries'] for sample in endpoint_samples]
+            report['endpoints'][endpoint] = {
+                'requests': len(endpoint_samples),
+                'errors': len([sample for sample in endpoint_samples if sample['status_code'] >= 400]),
+                'throughput': len(endpoint_samples) / elapsed if endpoint != 'clearing' else None,
+                'p50_ms': self.percentile(latencies, 50) * 1000,
+                'p99_ms': self.percentile(latencies, 99) * 1000,
+                'queries_per_request': float(sum(queries)) / len(queries),
+                'max_queries': max(queries),
+            }
+        return report
+
+    def create_cards(self, count):
+        accounts = [Account(name='BENCH %06d [Liability]' % index, type=ACCOUNT_TYPES.LIABILITY,
+                            amount_available=Decimal('100000.00'), amount_ledger=Decimal('100000.00'))
+                    for index in range(count)]
+        Account.objects.bulk_create(accounts)
+
+        card_ids = []
+        for index, account in enumerate(accounts):
+            card_id = 'B%07d' % index
+            settings.ACCOUNTS_MAPPING['card_id'][card_id] = account.name
+            card_ids.append(card_id)
+        return card_ids
+
+    def requests(self, flow):
+        """
+        (endpoint, JSON body) of the webhook requests of a flow
+        """
+        for item in flow:
+            if item is None:
+                yield 'clearing', b'{}'
+                continue
+            card_id, transaction_id, billing_amount = item
+            message = self.build_message(card_id, transaction_id, billing_amount)
+            yield 'auth', json.dumps(message).encode('utf-8')
+            message.update({
+                'type': MESSAGE_TYPES.PRESENTMENT,
+                'merchant_city': 'Helsinki',
+                'settlement_amount': str((billing_amount * Decimal('0.98')).quantize(Decimal('0.01'))),
+                'settlement_currency': 'EUR',
+            })
+            yield 'presentment', json.dumps(message).encode('utf-8')
+
+    def run_flows(self, flow, samples):
+        client = Client()
+        headers = {
+            'HTTP_' + settings.API_AUTH_HEADER: settings.API_CONSUMERS_AUTH_HEADERS['issuer'],
+        }
+        try:
+            for endpoint, body in self.requests(flow):
+                started = default_timer()
+                response = client.post(reverse(endpoint), body, content_type='application/json', **headers)
+                samples.append(self.sample(endpoint, default_timer() - started, response.status_code,
+                                           response['Server-Timing']))
+        finally:
+            connection.close()
+
+    def run_asgi_flows(self, flows, samples):
+        from issuer.asgi import ASGIHandler, replay
+
+        application = ASGIHandler()
+        headers = [
+            (settings.API_AUTH_HEADER.replace('_', '-'), settings.API_CONSUMERS_AUTH_HEADERS['issuer']),
+            ('Host', 'testserver'),
+            ('Content-Type', 'application/json'),
+        ]
+        endpoints = [[endpoint for endpoint, _ in self.requests(flow)] for flow in flows]
+        clients = [[('POST', reverse(endpoint), body, headers) for endpoint, body in self.requests(flow)]
+                   for flow in flows]
+        try:
+            for client, request, status_code, response_headers, latency in replay(application, clients):
+                samples.append(self.sample(endpoints[client][request], latency, status_code,
+                                           response_headers['server-timing']))
+        finally:
+            # One task per thread, so every thread of the pool closes its connections
+            threads = settings.ASGI_THREADS
+            barrier = threading.Barrier(threads)
+            for future in [application.executor.submit(self.close_connections, barrier) for _ in range(threads)]:
+                future.result()
+            application.executor.shutdown()
+
+    def close_connections(self, barrier):
+        barrier.wait()
+        connections.close_all()
+
+    def sample(self, endpoint, latency, status_code, server_timing):
+        return {
+            'endpoint': endpoint,
+            'latency': latency,
+            'queries': int(re.search(r'desc="(\d+) queries"', server_timing).group(1)),
+            'status_code': status_code,
+        }
+
+    def build_message(self, card_id, transaction_id, billing_amount):
+        return {
+            'type': MESSAGE_TYPES.AUTHORISATION,
+            'card_id': card_id,
+            'transaction_id': transaction_id,
+            'merchant_name': 'BENCHMARK SHOP',
+            'merchant_country': 'FI',
+            'merchant_mcc': 5411,
+            'billing_amount': str(billing_amount),
+            'billing_currency': 'EUR',
+            'transaction_amount': str(billing_amount),
+            'transaction_currency': 'EUR',
+        }
+
+    def group(self, samples):
+        grouped = defaultdict(list)
+        for sample in samples:
+            grouped[sample['endpoint']].append(sample)
+        return grouped
+
+    def percentile(self, ordered, percent):
+        index = int(round(percent / 100.0 * (len(ordered) - 1)))
+        return ordered[index]
+
+    def write_report(self, report):
+        self.stdout.write('%(server)s, %(database)s: %(cards)s cards x %(transactions)s transactions, '
+                          '%(concurrency)s clients, %(elapsed).2fs, %(throughput).1f req/s' % report)
+        self.stdout.write('%-12s %9s %7s %9s %9s %9s %10s' % (
+            'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'queries'))
+        for endpoint in ('auth', 'presentment', 'clearing'):
+            stats = report['endpoints'].get(endpoint)
+            if stats is None:
+                continue
+            throughput = '%.1f' % stats['throughput'] if stats['throughput'] is not None else '-'
+            line = '%-12s %9d %7d %9s %9.2f %9.2f %10.1f' % (
+                endpoint, stats['requests'], stats['errors'], throughput,
+                stats['p50_ms'], stats['p99_ms'], stats['queries_per_request'])
+            self.stdout.write(self.style.ERROR(line) if stats['errors'] else line)
+        self.stdout.write('clearing job: %(clearing_job_seconds).2fs' % report)
@@ -1,34 +1,28 @@
 # -*- coding: utf-8 -*-
-import requests
-
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.urls import reverse_lazy
+
+from issuer import clearing
 
 
 class Command(BaseCommand):
-    help = "Simulate Scheme's clearing process"
+    help = "Simulate Scheme's clearing process. Clears the presentments received so far " \
+           "right away, or only queues the job for clearing_worker with --queue."
 
     def add_arguments(self, parser):
-        parser.add_argument('-t, --transfer_ids', nargs='+', dest='ids',
-                            type=list, help='Make transactions for transfer ids')
+        parser.add_argument('--queue', action='store_true', help='Only queue the clearing job')
+        parser.add_argument('--chunk-size', type=int, default=settings.CLEARING_CHUNK_SIZE,
+                            help='Presentments settled per DB transaction')
 
     def handle(self, *args, **options):
-
-        url = '{API_URL}{clearing_endpoint}'.format(**{
-            'API_URL': settings.API_URL,
-            'clearing_endpoint': reverse_lazy('clearing')
-        })
-
-        headers = self._build_headers()
-        response = requests.post(url, data={}, headers=headers)
-
-        self.stdout.write(self.style.SUCCESS('Successfully made clearing operation: \n %s' % response.json()))
-
-    def _build_headers(self, consumer_name='issuer'):
-        auth_header_name = settings.API_AUTH_HEADER.replace('_', '-')
-        auht_header_value = settings.API_CONSUMERS_AUTH_HEADERS[consumer_name]
-        headers = {
-            auth_header_name: auht_header_value
-        }
-        return headers
+        job = clearing.enqueue()
+        if options['queue']:
+            self.stdout.write(self.style.SUCCESS('Queued clearing %s of %s presentments' % (
+                job.pk, job.total_messages)))
+            return
+
+        job = clearing.run(job, options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Successfully made clearing operation: \n %s' % [
+            'liability: %s EUR' % job.settlement_amount,
+            'equity: %s EUR' % (job.billing_amount - job.settlement_amount),
+        ]))
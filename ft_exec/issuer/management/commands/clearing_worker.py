@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from issuer import clearing
+from issuer.models import ClearingBatch
+
+
+class Command(BaseCommand):
+    help = "Run the queued clearing jobs. Presentments are settled in chunks, each committed " \
+           "on its own, so an interrupted job resumes where it stopped."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.CLEARING_CHUNK_SIZE,
+                            help='Presentments settled per DB transaction')
+        parser.add_argument('--once', action='store_true', help='Exit when no job is waiting')
+        parser.add_argument('--poll', type=float, default=5, help='Seconds between looks for new jobs')
+        parser.add_argument('--job', dest='job_id', type=int,
+                            help='Only run (or resume, even a failed one) this job and exit')
+
+    def handle(self, *args, **options):
+        if options['job_id']:
+            self.run_job(ClearingBatch.objects.get(pk=options['job_id']), options['chunk_size'])
+            return
+
+        while True:
+            job = clearing.next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll'])
+                continue
+            self.run_job(job, options['chunk_size'])
+
+    def run_job(self, job, chunk_size):
+        try:
+            job = clearing.run(job, chunk_size)
+        except Exception as e:
+            self.stderr.write(self.style.ERROR('Clearing %s failed: %r' % (job.pk, e)))
+            return
+        self.stdout.write(self.style.SUCCESS('Clearing %s: %s presentments, liability: %s EUR, equity: %s EUR' % (
+            job.pk, job.cleared_messages, job.settlement_amount, job.billing_amount - job.settlement_amount)))
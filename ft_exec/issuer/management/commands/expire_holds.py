@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from issuer import holds
+
+
+class Command(BaseCommand):
+    help = "Release the authorisation holds which expired without a presentment (see HOLD_EXPIRY_DAYS), " \
+           "in chunks of holds released in one DB transaction each."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.HOLD_EXPIRY_CHUNK_SIZE,
+                            help='Holds released per DB transaction')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        released = 0
+        while True:
+            chunk_released = holds.release_expired(options['chunk_size'], now)
+            if not chunk_released:
+                break
+            released += chunk_released
+            self.stdout.write('%s holds released' % released)
+
+        self.stdout.write(self.style.SUCCESS('Successfully released %s expired holds' % released))
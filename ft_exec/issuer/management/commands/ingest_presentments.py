@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+from itertools import islice
+
+from django.core.management import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from rest_framework.exceptions import ValidationError
+
+from issuer import holds, idempotency, ledger, messages
+from issuer.constants import BALANCE_TYPES, MESSAGE_TYPES, TRANSACTION_STATUSES
+from issuer.exceptions import InsufficientFunds
+from issuer.ledger import Posting
+from issuer.models import SchemeMessage, Transfer
+from issuer.utils import get_accounts_by_card_ids, get_bank_acount
+
+
+class Command(BaseCommand):
+    help = "Ingest a scheme file of presentments (CSV with a header row, or JSONL) without going " \
+           "through the webhook. Every chunk of the file is checked against its authorisations " \
+           "and holds with a couple of queries and posted in one DB transaction."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Presentment file')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Format of the file, guessed from its extension by default')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Presentments per DB transaction')
+
+    def handle(self, *args, **options):
+        self.presented = set()
+        accepted = rejected = 0
+
+        rows = self.read_rows(options['path'], options['format'])
+        for chunk in self.chunks(self.validate(rows), options['chunk_size']):
+            chunk_accepted, chunk_rejected = self.ingest_chunk(chunk)
+            accepted, rejected = accepted + chunk_accepted, rejected + chunk_rejected
+            self.stdout.write('%s presentments ingested, %s rejected' % (accepted, rejected))
+
+        self.stdout.write(self.style.SUCCESS('Successfully ingested %s presentments, %s rejected' % (
+            accepted, rejected)))
+
+    def read_rows(self, path, file_format):
+        """
+        (line number, raw message) of every message in the file
+        """
+        file_format = file_format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        try:
+            presentments_file = io.open(path, encoding='utf-8')
+        except IOError as e:
+            raise CommandError('Cannot read %s: %s' % (path, e))
+        with presentments_file:
+            if file_format == 'jsonl':
+                for line_number, line in enumerate(presentments_file, 1):
+                    if line.strip():
+                        yield line_number, json.loads(line)
+            else:
+                reader = csv.DictReader(presentments_file)
+                for row in reader:
+                    yield reader.line_num, row
+
+    def validate(self, rows):
+        """
+        (line number, validated message or None, errors) of every row
+        """
+        for line_number, row in rows:
+            try:
+                yield line_number, messages.PRESENTMENT.validate(row, check_database=False), None
+            except ValidationError as e:
+                yield line_number, None, e.detail
+
+    def chunks(self, iterable, size):
+        iterator = iter(iterable)
+        chunk = list(islice(iterator, size))
+        while chunk:
+            yield chunk
+            chunk = list(islice(iterator, size))
+
+    def ingest_chunk(self, chunk):
+        """
+        Post the captures of a chunk and store its messages, returns (accepted, rejected)
+        """
+        rejected = 0
+        valid_messages = []
+        for line_number, message, errors in chunk:
+            if errors:
+                self.reject(line_number, errors)
+                rejected += 1
+            else:
+                valid_messages.append((line_number, message))
+        if not valid_messages:
+            return 0, rejected
+
+        transaction_ids = set(message['transaction_id'] for _, message in valid_messages)
+        known = {}
+        for message_type, transaction_id in messages.known_messages(transaction_id__in=transaction_ids):
+            known.setdefault(message_type, set()).add(transaction_id)
+        authorised = known.get(MESSAGE_TYPES.AUTHORISATION, set())
+        presented = self.presented | known.get(MESSAGE_TYPES.PRESENTMENT, set())
+
+        bank = get_bank_acount()
+        accepted = []
+        try:
+            with transaction.atomic():
+                accounts = get_accounts_by_card_ids(set(message['card_id'] for _, message in valid_messages),
+                                                    for_update=True)
+                ledger_balances = dict((account.pk, account.amount_ledger) for account in accounts.values())
+
+                for line_number, message in valid_messages:
+                    transaction_id = message['transaction_id']
+                    account = accounts[message['card_id']]
+                    billing_amount = message['billing_amount']
+
+                    if transaction_id not in authorised:
+                        self.reject(line_number, 'Wrong transaction_id')
+                        continue
+                    if transaction_id in presented:
+                        self.reject(line_number, 'Duplicated data')
+                        continue
+                    # The same check the ledger guard makes, so one short card does not fail the chunk
+                    if billing_amount >= ledger_balances[account.pk]:
+                        self.reject(line_number, 'Need more gold')
+                        continue
+                    presented.add(transaction_id)
+                    ledger_balances[account.pk] -= billing_amount
+                    accepted.append((message, account))
+
+                # Only the accepted presentments settle their holds, rejected ones stay open to expire
+                accepted_ids = set(message['transaction_id'] for message, _ in accepted)
+                released = holds.settle(accepted_ids)
+                hold_amounts = holds.held_amounts(Transfer.objects.filter(
+                    account_id__in=ledger_balances, transaction__external_transaction_id__in=accepted_ids - released))
+
+                postings = []
+                accepted_messages = []
+                for message, account in accepted:
+                    transaction_id = message['transaction_id']
+                    postings.append(Posting(bank, account, hold_amounts.get((transaction_id, account.pk), 0),
+                                            TRANSACTION_STATUSES.CANCELED, transaction_id))
+                    postings.append(Posting(account, bank, message['billing_amount'], TRANSACTION_STATUSES.PROCESSED,
+                                            transaction_id, guard=BALANCE_TYPES.LEDGER))
+                    accepted_messages.append(SchemeMessage(**message))
+
+                ledger.post(postings)
+                SchemeMessage.objects.bulk_create(accepted_messages)
+        except (IntegrityError, InsufficientFunds) as e:
+            # A webhook got in between for one of the cards or transaction ids, the file can be re-run
+            self.stderr.write(self.style.ERROR('Chunk of lines %s-%s rolled back: %r' % (
+                valid_messages[0][0], valid_messages[-1][0], e)))
+            return 0, len(chunk)
+
+        self.presented.update(message.transaction_id for message in accepted_messages)
+        idempotency.remember_responses(MESSAGE_TYPES.PRESENTMENT, dict(
+            (message.transaction_id, ({'success': True, 'status_code': 200, 'detail': 'Authorization success'}, 200))
+            for message in accepted_messages
+        ))
+        return len(accepted_messages), len(chunk) - len(accepted_messages)
+
+    def reject(self, line_number, errors):
+        self.stderr.write('Line %s rejected: %s' % (line_number, errors))
@@ -1,63 +1,107 @@
 # -*- coding: utf-8 -*-
-import requests
-from decimal import Decimal
+import csv
+import io
+import json
+from decimal import Decimal, InvalidOperation
+
 from django.conf import settings
-from django.core.management import BaseCommand
-from rest_framework.reverse import reverse_lazy
+from django.core.management import BaseCommand, CommandError
 
+from issuer import ledger
+from issuer.constants import TRANSACTION_STATUSES
+from issuer.ledger import Posting
 from issuer.models import Account
 from issuer.utils import get_account_by_cardholder_name, get_bank_acount
 
 
 class Command(BaseCommand):
-    help = "Load money to account of cardholder name. Cardholder names are %s" % \
-           settings.ACCOUNTS_MAPPING['card_id'].values()
+    help = "Load money to account of cardholder name. Cardholder names are %s. " \
+           "Loads are posted from the bank account to the card's, bulk loads from --file are posted in " \
+           "batches, one DB transaction per batch." % settings.ACCOUNTS_MAPPING['card_id'].values()
 
     def add_arguments(self, parser):
-        parser.add_argument('cardholder', nargs='+', type=str, help='cardholder name')
-        parser.add_argument('amount', nargs=1, type=Decimal, help='amount of money')
-        parser.add_argument('currency', nargs='?', type=str, help='Currency', default='EUR')
+        parser.add_argument('cardholder', nargs='*', type=str,
+                            help='cardholder names, then the amount of money and optionally the currency (EUR)')
+        parser.add_argument('--file', dest='path',
+                            help='CSV (cardholder,amount[,currency]) or JSONL '
+                                 '({"cardholder": ..., "amount": ..., "currency": ...}) file of loads')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Format of --file, guessed from its extension by default')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Loads per DB transaction')
 
     def handle(self, *args, **options):
-        for cardholder in options['cardholder']:
+        if options['path']:
+            loads = self._read_file(options['path'], options['format'])
+        elif options['cardholder']:
+            loads = self._parse_arguments(options['cardholder'])
+        else:
+            raise CommandError('Give the cardholders and the amount, or a --file of loads')
+
+        loaded = rejected = 0
+        batch = []
+        for load in loads:
+            batch.append(load)
+            if len(batch) >= options['batch_size']:
+                batch_loaded, batch_rejected = self._load_batch(batch)
+                loaded, rejected = loaded + batch_loaded, rejected + batch_rejected
+                batch = []
+        if batch:
+            batch_loaded, batch_rejected = self._load_batch(batch)
+            loaded, rejected = loaded + batch_loaded, rejected + batch_rejected
+
+        self.stdout.write(self.style.SUCCESS('Successfully loaded money: %s loads, %s rejected' % (loaded, rejected)))
+
+    def _parse_arguments(self, values):
+        values = list(values)
+        currency = 'EUR'
+        if len(values) > 2 and not values[-1].replace('.', '', 1).isdigit():
+            currency = values.pop()
+        amount = self._parse_amount(values.pop())
+        if not values:
+            raise CommandError('Give at least one cardholder before the amount')
+        return [(cardholder, amount, currency) for cardholder in values]
+
+    def _read_file(self, path, file_format):
+        file_format = file_format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        with io.open(path, encoding='utf-8') as loads_file:
+            if file_format == 'jsonl':
+                for line in loads_file:
+                    if line.strip():
+                        row = json.loads(line)
+                        yield (row['cardholder'], self._parse_amount(row['amount']),
+                               row.get('currency') or 'EUR')
+            else:
+                for row in csv.reader(loads_file):
+                    if not row or row[0] == 'cardholder':
+                        continue
+                    yield row[0], self._parse_amount(row[1]), row[2] if len(row) > 2 and row[2] else 'EUR'
+
+    def _parse_amount(self, value):
+        try:
+            return Decimal(value)
+        except (InvalidOperation, TypeError):
+            raise CommandError('%r is not an amount of money' % (value, ))
+
+    def _load_batch(self, batch):
+        """
+        Post every load from the bank to its cardholder's account in one DB transaction
+        """
+        bank = get_bank_acount()
+        postings = []
+        rejected = 0
+        for cardholder, amount, currency in batch:
             try:
                 account = get_account_by_cardholder_name(cardholder)
             except Account.DoesNotExist:
-                self.stdout.write(self.style.ERROR('Account for this cardholder does not exist'))
+                self.stdout.write(self.style.ERROR('Account for cardholder %s does not exist' % cardholder))
+                rejected += 1
+                continue
+            if currency != account.currency:
+                self.stdout.write(self.style.ERROR('Account for cardholder %s is in %s, not %s' % (
+                    cardholder, account.currency, currency)))
+                rejected += 1
+                continue
+            postings.append(Posting(bank, account, amount, TRANSACTION_STATUSES.PROCESSED, None))
 
-            else:
-                amount = options['amount'][0]
-                response, current_amount = self._increase_amount_on_account(account, amount)
-                self.stdout.write(self.style.SUCCESS('Successfully update account for cardholder'))
-                if response.ok:
-                    bank = get_bank_acount()
-                    response, current_amount = self._increase_amount_on_account(bank, amount)
-                self.stdout.write(self.style.SUCCESS('Successfully update account for the Bank'))
-
-    def _build_headers(self, consumer_name='issuer'):
-        auth_header_name = settings.API_AUTH_HEADER.replace('_', '-')
-        auht_header_value = settings.API_CONSUMERS_AUTH_HEADERS[consumer_name]
-        headers = {
-            auth_header_name: auht_header_value
-        }
-        return headers
-
-    def _increase_amount_on_account(self, account, amount):
-
-        url = '{API_URL}{account_endpoint}'.format(**{
-            'API_URL': settings.API_URL,
-            'account_endpoint': reverse_lazy('api:accounts-detail', kwargs={'pk': account.id})
-        })
-
-        headers = self._build_headers()
-        response = requests.get(url, headers=headers)
-        primary_amount_available = Decimal(response.json()['amount_available'])
-        primary_amount_ledger = Decimal(response.json()['amount_ledger'])
-        current_amount_available = primary_amount_available + amount
-        current_amount_ledger = primary_amount_ledger + amount
-
-        response = requests.patch(url, data={'amount_available': current_amount_available,
-                                             'amount_ledger': current_amount_ledger
-                                             },
-                                  headers=headers)
-        return response, current_amount_available
+        ledger.post(postings)
+        return len(batch) - rejected, rejected
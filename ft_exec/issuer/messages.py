@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled validation of scheme messages.
+
+The webhooks used to validate through ``ModelSerializer`` classes, which
+rebuild their fields on every request. ``MessageSchema`` reads the
+``SchemeMessage`` fields once at import time and compiles them into plain
+converter functions. Validating a message is then a loop over those
+functions. It returns typed values (``Decimal`` amounts, ``int`` MCC) and
+reports errors in the same ``{field: [message]}`` shape and wording as the
+serializers.
+"""
+from __future__ import unicode_literals
+
+import decimal
+import re
+from collections import OrderedDict
+
+from django.db import models
+from django.utils import six
+from rest_framework.exceptions import ValidationError
+
+from issuer.constants import MESSAGE_TYPES
+from issuer.models import ArchivedSchemeMessage, SchemeMessage
+from app.settings import ACCOUNTS_MAPPING
+
+
+REQUIRED = 'This field is required.'
+NOT_NULL = 'This field may not be null.'
+NOT_BLANK = 'This field may not be blank.'
+NOT_UNIQUE = 'The fields type, transaction_id must make a unique set.'
+NOT_A_DICT = 'Invalid data. Expected a dictionary, but got %s.'
+
+_INTEGER = re.compile(r'\.0*\s*$')
+
+
+class _Invalid(Exception):
+    pass
+
+
+def _char_converter(model_field):
+    max_length = model_field.max_length
+
+    def convert(value):
+        if isinstance(value, (bool, dict, list)):
+            raise _Invalid('Not a valid string.')
+        value = six.text_type(value).strip()
+        if not value:
+            raise _Invalid(NOT_BLANK)
+        if max_length is not None and len(value) > max_length:
+            raise _Invalid('Ensure this field has no more than %d characters.' % max_length)
+        return value
+    return convert
+
+
+def _text(value):
+    return six.text_type(value).strip()
+
+
+def _decimal_converter(model_field):
+    max_digits, decimal_places = model_field.max_digits, model_field.decimal_places
+    max_whole_digits = max_digits - decimal_places
+    context = decimal.Context(prec=max_digits, rounding=decimal.ROUND_HALF_UP)
+    exponent = decimal.Decimal('.1') ** decimal_places
+
+    def convert(value):
+        try:
+            value = decimal.Decimal(six.text_type(value).strip())
+        except decimal.DecimalException:
+            raise _Invalid('A valid number is required.')
+        if not value.is_finite():
+            raise _Invalid('A valid number is required.')
+
+        sign, digittuple, value_exponent = value.as_tuple()
+        places = max(-value_exponent, 0)
+        total_digits = max(len(digittuple) + max(value_exponent, 0), places)
+        whole_digits = total_digits - places
+        if total_digits > max_digits:
+            raise _Invalid('Ensure that there are no more than %d digits in total.' % max_digits)
+        if places > decimal_places:
+            raise _Invalid('Ensure that there are no more than %d decimal places.' % decimal_places)
+        if whole_digits > max_whole_digits:
+            raise _Invalid('Ensure that there are no more than %d digits before the decimal point.' %
+                           max_whole_digits)
+        return value.quantize(exponent, context=context)
+    return convert
+
+
+def _integer_converter(model_field):
+    min_value, max_value = -32768, 32767
+
+    def convert(value):
+        if isinstance(value, bool):
+            raise _Invalid('A valid integer is required.')
+        try:
+            value = int(_INTEGER.sub('', six.text_type(value)))
+        except (ValueError, TypeError):
+            raise _Invalid('A valid integer is required.')
+        if value < min_value:
+            raise _Invalid('Ensure this value is greater than or equal to %d.' % min_value)
+        if value > max_value:
+            raise _Invalid('Ensure this value is less than or equal to %d.' % max_value)
+        return value
+    return convert
+
+
+_CONVERTERS = (
+    (models.CharField, _char_converter),
+    (models.DecimalField, _decimal_converter),
+    (models.SmallIntegerField, _integer_converter),
+)
+
+
+def _compile(model_field):
+    for field_class, factory in _CONVERTERS:
+        if isinstance(model_field, field_class):
+            return factory(model_field)
+    raise TypeError('No converter for %r' % model_field)
+
+
+class MessageSchema(object):
+    """
+    Validator of one scheme message type, built once from the ``SchemeMessage`` fields
+    """
+
+    # Checked against the message type instead, 'authorisation' is longer than the type column
+    converters = {'type': _text}
+
+    def __init__(self, message_type, exclude=(), required=()):
+        self.message_type = message_type
+        self.fields = [
+            (model_field.name, self.converters.get(model_field.name) or _compile(model_field),
+             model_field.null and model_field.name not in required)
+            for model_field in SchemeMessage._meta.concrete_fields
+            if model_field.editable and not model_field.is_relation and not model_field.primary_key
+            and model_field.name not in exclude and not getattr(model_field, 'auto_now_add', False)
+        ]
+
+    def validate(self, data, check_database=True):
+        """
+        Typed message from ``data`` (a dict or QueryDict), raises ValidationError.
+
+        ``check_database`` also rejects duplicates like the serializers did,
+        callers checking a whole batch at once switch it off.
+        """
+        if not isinstance(data, dict):
+            raise ValidationError({'non_field_errors': [NOT_A_DICT % type(data).__name__]})
+        message = {}
+        errors = OrderedDict()
+        for name, convert, optional in self.fields:
+            value = data.get(name)
+            if value is None:
+                if not optional:
+                    errors[name] = [REQUIRED if name not in data else NOT_NULL]
+                continue
+            try:
+                message[name] = convert(value)
+            except _Invalid as e:
+                errors[name] = [six.text_type(e)]
+
+        self.validate_message(message, errors)
+        if errors:
+            raise ValidationError(errors)
+        if check_database:
+            self.check_database(message)
+        return message
+
+    def validate_message(self, message, errors):
+        if 'type' in message and message['type'] != self.message_type:
+            errors['type'] = ['Wrong type']
+        if 'card_id' in message and not ACCOUNTS_MAPPING['card_id'].get(message['card_id'], ''):
+            errors['card_id'] = ["That card isn't supported our company"]
+
+    def check_database(self, message):
+        if list(known_messages(type=self.message_type, transaction_id=message['transaction_id'])):
+            raise ValidationError({'non_field_errors': [NOT_UNIQUE]})
+
+
+class PresentmentSchema(MessageSchema):
+
+    def check_database(self, message):
+        # The authorisation it presents and an earlier presentment in one query
+        seen_types = set(message_type for message_type, _ in known_messages(
+            type__in=(MESSAGE_TYPES.AUTHORISATION, MESSAGE_TYPES.PRESENTMENT),
+            transaction_id=message['transaction_id'],
+        ))
+        if MESSAGE_TYPES.AUTHORISATION not in seen_types:
+            raise ValidationError({'transaction_id': ['Wrong transaction_id']})
+        if MESSAGE_TYPES.PRESENTMENT in seen_types:
+            raise ValidationError({'non_field_errors': [NOT_UNIQUE]})
+
+
+def known_messages(**filters):
+    """
+    (type, transaction_id) of the scheme messages matching ``filters``, archived ones included, in one query
+    """
+    fields = ('type', 'transaction_id')
+    return SchemeMessage.objects.filter(**filters).order_by().values_list(*fields).union(
+        ArchivedSchemeMessage.objects.filter(**filters).order_by().values_list(*fields))
+
+
+AUTHORISATION = MessageSchema(MESSAGE_TYPES.AUTHORISATION,
+                              exclude=('merchant_city', 'settlement_amount', 'settlement_currency'))
+PRESENTMENT = PresentmentSchema(MESSAGE_TYPES.PRESENTMENT,
+                                required=('merchant_city', 'settlement_amount', 'settlement_currency'))
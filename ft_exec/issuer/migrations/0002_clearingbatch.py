@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 20:07
+from __future__ import unicode_literals
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClearingBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('billing_amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12, verbose_name='Billing amount')),
+                ('settlement_amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12, verbose_name='Settlement amount')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'verbose_name': 'Clearing Batch',
+                'verbose_name_plural': 'Clearing Batches',
+            },
+        ),
+        migrations.AddField(
+            model_name='schememessage',
+            name='clearing',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='issuer.ClearingBatch', verbose_name='Clearing batch'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 20:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0002_clearingbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance_at', models.DateTimeField(verbose_name='Balance at')),
+                ('amount_available', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Available Amount')),
+                ('amount_ledger', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Ledger Amount')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='issuer.Account')),
+            ],
+            options={
+                'ordering': ['-balance_at'],
+                'verbose_name': 'Balance Checkpoint',
+                'verbose_name_plural': 'Balance Checkpoints',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='balancecheckpoint',
+            unique_together=set([('account', 'balance_at')]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 20:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0003_balancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['external_transaction_id', 'status'], name='issuer_tran_externa_217680_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['status', 'created_at'], name='issuer_tran_status_d7cefc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['account', 'transaction'], name='issuer_tran_account_fd336b_idx'),
+        ),
+        # Clearing only ever looks for presentments nobody has cleared yet,
+        # a partial index keeps that lookup independent of the cleared history.
+        migrations.RunSQL(
+            ['CREATE INDEX issuer_schememessage_uncleared_idx ON issuer_schememessage (type) '
+             'WHERE clearing_id IS NULL'],
+            ['DROP INDEX issuer_schememessage_uncleared_idx'],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 20:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0005_transfer_statement_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transfer',
+            name='balance_available',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True, verbose_name='Available balance after'),
+        ),
+        migrations.AddField(
+            model_name='transfer',
+            name='balance_ledger',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True, verbose_name='Ledger balance after'),
+        ),
+    ]
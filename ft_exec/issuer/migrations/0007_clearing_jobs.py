@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 20:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0006_transfer_running_balance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clearingbatch',
+            name='cleared_messages',
+            field=models.PositiveIntegerField(default=0, verbose_name='Presentments cleared'),
+        ),
+        migrations.AddField(
+            model_name='clearingbatch',
+            name='error',
+            field=models.TextField(blank=True, default='', verbose_name='Error'),
+        ),
+        migrations.AddField(
+            model_name='clearingbatch',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Finished at'),
+        ),
+        migrations.AddField(
+            model_name='clearingbatch',
+            name='last_message_id',
+            field=models.PositiveIntegerField(default=0, verbose_name='Last presentment processed'),
+        ),
+        migrations.AddField(
+            model_name='clearingbatch',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Started at'),
+        ),
+        migrations.AddField(
+            model_name='clearingbatch',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=12, verbose_name='Status'),
+        ),
+        migrations.AddField(
+            model_name='clearingbatch',
+            name='total_messages',
+            field=models.PositiveIntegerField(default=0, verbose_name='Presentments to clear'),
+        ),
+        migrations.AddField(
+            model_name='clearingbatch',
+            name='until_message_id',
+            field=models.PositiveIntegerField(default=0, verbose_name='Last presentment to clear'),
+        ),
+        migrations.AddIndex(
+            model_name='clearingbatch',
+            index=models.Index(fields=['status', 'id'], name='issuer_clea_status_217e94_idx'),
+        ),
+        # Batches cleared before jobs existed were settled synchronously
+        migrations.RunSQL(["UPDATE issuer_clearingbatch SET status = 'done', finished_at = created_at"],
+                          reverse_sql=migrations.RunSQL.noop),
+    ]
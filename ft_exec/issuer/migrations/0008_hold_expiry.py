@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 20:39
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+HOLD = 0
+CANCELED = -1
+
+
+def expire_open_holds(apps, schema_editor):
+    """
+    Holds made before expiry existed expire the default number of days after
+    they were made, unless a presentment (or anything else) already released them
+    """
+    Transaction = apps.get_model('issuer', 'Transaction')
+    released = Transaction.objects.filter(status=CANCELED, external_transaction_id__isnull=False)
+    Transaction.objects.filter(status=HOLD, external_transaction_id__isnull=False).exclude(
+        external_transaction_id__in=released.values('external_transaction_id')
+    ).update(expires_at=models.F('created_at') + timedelta(days=settings.HOLD_EXPIRY_DAYS))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0007_clearing_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Expires at'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['expires_at'], name='issuer_tran_expires_c8e93d_idx'),
+        ),
+        migrations.RunPython(expire_open_holds, migrations.RunPython.noop),
+    ]
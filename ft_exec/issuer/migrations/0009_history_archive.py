@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 20:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0008_hold_expiry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPeriod',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True, verbose_name='Month')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='Archived at')),
+                ('transactions', models.PositiveIntegerField(default=0, verbose_name='Transactions')),
+                ('transfers', models.PositiveIntegerField(default=0, verbose_name='Transfers')),
+                ('messages', models.PositiveIntegerField(default=0, verbose_name='Scheme messages')),
+            ],
+            options={
+                'verbose_name': 'Archived Period',
+                'verbose_name_plural': 'Archived Periods',
+                'ordering': ['-month'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedSchemeMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('authorisation', 'authorisation'), ('presentment', 'presentment')], max_length=12, verbose_name='Message_types')),
+                ('card_id', models.CharField(max_length=8, verbose_name='Card ID')),
+                ('transaction_id', models.CharField(max_length=12, verbose_name='Scheme Ttransaction ID')),
+                ('merchant_name', models.CharField(max_length=128, verbose_name='Merchant Name')),
+                ('merchant_country', models.CharField(max_length=4, verbose_name='Merchant Country')),
+                ('merchant_mcc', models.SmallIntegerField(verbose_name='Merchant Category Code')),
+                ('merchant_city', models.CharField(help_text='City of merchant', max_length=64, null=True)),
+                ('billing_amount', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Billing amount')),
+                ('billing_currency', models.CharField(max_length=12, verbose_name='Billing Currency')),
+                ('transaction_amount', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Transaction amount')),
+                ('transaction_currency', models.CharField(max_length=12, verbose_name='Transaction Currency')),
+                ('settlement_amount', models.DecimalField(decimal_places=2, max_digits=12, null=True, verbose_name='Settlement amount')),
+                ('settlement_currency', models.CharField(max_length=12, null=True, verbose_name='Settlement Currency')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+            ],
+            options={
+                'verbose_name': 'Archived Scheme Message',
+                'verbose_name_plural': 'Archived Scheme Messages',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('updated_at', models.DateTimeField(auto_now_add=True, verbose_name='Updated at')),
+                ('amount', models.DecimalField(blank=True, decimal_places=4, max_digits=24, null=True)),
+                ('external_transaction_id', models.CharField(max_length=12, null=True, verbose_name='Scheme transaction id')),
+                ('status', models.SmallIntegerField(choices=[(-1, 'Canceled'), (0, 'Drafted'), (1, 'Processed')], verbose_name='Transfer Status')),
+                ('expires_at', models.DateTimeField(blank=True, null=True, verbose_name='Expires at')),
+            ],
+            options={
+                'verbose_name': 'Archived Transaction',
+                'verbose_name_plural': 'Archived Transactions',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12, null=True, verbose_name='Amount')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('updated_at', models.DateTimeField(auto_now_add=True, verbose_name='Updated at')),
+                ('balance_available', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True, verbose_name='Available balance after')),
+                ('balance_ledger', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True, verbose_name='Ledger balance after')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_transfers', to='issuer.Account')),
+                ('transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='transfers', to='issuer.ArchivedTransaction', verbose_name='Transactions')),
+            ],
+            options={
+                'verbose_name': 'Archived Transfer',
+                'verbose_name_plural': 'Archived Transfers',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['external_transaction_id', 'status'], name='issuer_arch_externa_528d30_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['status', 'created_at'], name='issuer_arch_status_e9a2e5_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedschememessage',
+            name='clearing',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='archived_messages', to='issuer.ClearingBatch', verbose_name='Clearing batch'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransfer',
+            index=models.Index(fields=['account', 'created_at', 'id'], name='issuer_arch_account_6ec354_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedschememessage',
+            index=models.Index(fields=['type', 'transaction_id'], name='issuer_arch_type_c1c20a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedschememessage',
+            index=models.Index(fields=['created_at'], name='issuer_arch_created_239253_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 20:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0009_history_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerAudit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(auto_now_add=True, verbose_name='Started at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished at')),
+                ('incremental', models.BooleanField(default=False, verbose_name='Incremental')),
+                ('since_transfer_id', models.PositiveIntegerField(default=0, verbose_name='Audited after transfer')),
+                ('last_transfer_id', models.PositiveIntegerField(default=0, verbose_name='Last transfer audited')),
+                ('problems', models.PositiveIntegerField(default=0, verbose_name='Problems found')),
+            ],
+            options={
+                'verbose_name': 'Ledger Audit',
+                'verbose_name_plural': 'Ledger Audits',
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import F, OuterRef, Subquery
+
+
+ASSET = 1
+
+
+def sign_with_balance_changes(apps, schema_editor):
+    """
+    Transfers used to be signed by the type of the account the money went to:
+    a posting to a liability or equity account wrote +amount on the from side
+    and -amount on the to side, a posting to an asset account the opposite.
+    Transfers now carry the balance change of their account (-amount from,
+    +amount to), so the transfers of transactions whose to side (the transfer
+    written last) is not an asset change sign. Running the same rewrite again
+    restores the old signs, it is its own reverse.
+    """
+    for transaction_model, transfer_model in (('Transaction', 'Transfer'),
+                                              ('ArchivedTransaction', 'ArchivedTransfer')):
+        Transaction = apps.get_model('issuer', transaction_model)
+        Transfer = apps.get_model('issuer', transfer_model)
+        to_account_type = Transfer.objects.filter(transaction=OuterRef('pk')).order_by('-pk').values('account__type')
+        flipped = Transaction.objects.annotate(to_account_type=Subquery(to_account_type[:1])).exclude(
+            to_account_type=ASSET).exclude(to_account_type=None).values('pk')
+        Transfer.objects.filter(transaction_id__in=flipped).update(amount=F('amount') * -1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuer', '0010_ledger_audit'),
+    ]
+
+    operations = [
+        migrations.RunPython(sign_with_balance_changes, sign_with_balance_changes),
+    ]
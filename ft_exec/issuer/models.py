@@ -3,12 +3,13 @@ from __future__ import unicode_literals
 
 from decimal import Decimal
 from django.db import models
-from django.db.models import Sum, Q, Avg
+from django.db.models import Sum, F, Func
 from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from issuer.constants import TRANSACTION_STATUSES, TRANSFER_TYPES, BALANCE_TYPES, \
-    ACCOUNT_TYPES, MESSAGE_TYPES, TRANSACTION_BALANCE_MAPPING
+    ACCOUNT_TYPES, MESSAGE_TYPES, TRANSACTION_BALANCE_MAPPING, CLEARING_STATUSES
 
 
 class Account(models.Model):
@@ -46,55 +47,137 @@ class Account(models.Model):
     def get_balance(self, dt=None, balance_type=BALANCE_TYPES.AVAILABLE):
         """
         Return the balance for this account
+
+        Without ``dt``, or for a ``dt`` not in the past, it is the stored balance,
+        which also reflects changes made outside the ledger (the accounts API,
+        the admin). Point-in-time balances are the running balance of the last
+        transfer made before ``dt``. Transfers written before running balances
+        existed fall back to the nearest checkpoint (see ``BalanceCheckpoint``)
+        and only sum the transfers between that checkpoint and ``dt``.
         """
-        transfers = self.transfers
         balance = getattr(self, 'amount_%s'% balance_type, 'amount_available')
 
-        transaction_status = TRANSACTION_BALANCE_MAPPING[balance_type]
-        if dt:
-            transfers = transfers.filter(transaction__created_at__gte=dt,
-                                         transaction__status=transaction_status)
-            balance_delta = transfers.aggregate(summ=Coalesce(Sum('amount'), 0))['summ']
-            balance += balance_delta * -self.sign
+        if dt is not None and timezone.is_naive(dt):
+            dt = timezone.make_aware(dt)
+        if dt and dt < timezone.now():
+            running_balance = self.get_running_balance(balance_type, dt)
+            if running_balance is not None:
+                return '%s %s' % (running_balance, self.currency)
+
+            checkpoint = self.checkpoints.filter(balance_at__lte=dt).order_by('-balance_at').first()
+            if checkpoint is not None:
+                balance = getattr(checkpoint, 'amount_%s' % balance_type)
+                balance += self.get_transfers_sum(balance_type, checkpoint.balance_at, dt)
+            else:
+                checkpoint = self.checkpoints.filter(balance_at__gt=dt).order_by('balance_at').first()
+                if checkpoint is not None:
+                    balance = getattr(checkpoint, 'amount_%s' % balance_type)
+                    balance -= self.get_transfers_sum(balance_type, dt, checkpoint.balance_at)
+                else:
+                    balance -= self.get_transfers_sum(balance_type, dt)
 
         return '%s %s' % (balance, self.currency)
 
+    def get_running_balance(self, balance_type, dt):
+        """
+        ``balance_type`` running balance of the last transfer made before ``dt``, or None
+        """
+        from issuer import archive
+
+        transfer_sets = [self.transfers]
+        if archive.needs_archive(dt):
+            transfer_sets.append(self.archived_transfers)
+        latest = [
+            transfers.filter(created_at__lt=dt).order_by('-created_at', '-id').values_list(
+                'created_at', 'id', 'balance_%s' % balance_type).first()
+            for transfers in transfer_sets
+        ]
+        latest = max([transfer for transfer in latest if transfer is not None] or [None])
+        return latest[2] if latest is not None else None
+
+    def get_balance_transfers(self, balance_type, since, until=None, archived=False):
+        """
+        Transfers counted in ``balance_type`` made in [since, until), from the archive with ``archived``
+        """
+        transfers = self.archived_transfers if archived else self.transfers
+        # On the transfer's own created_at, a range scan of the (account, created_at, id) index
+        transfers = transfers.filter(created_at__gte=since,
+                                     transaction__status__in=TRANSACTION_BALANCE_MAPPING[balance_type])
+        if until is not None:
+            transfers = transfers.filter(created_at__lt=until)
+        return transfers
+
+    def get_transfers_sum(self, balance_type, since, until=None):
+        from issuer import archive
+
+        transfers = self.get_balance_transfers(balance_type, since, until)
+        summ = transfers.aggregate(summ=Coalesce(Sum('amount'), 0))['summ']
+        if archive.needs_archive(since):
+            transfers = self.get_balance_transfers(balance_type, since, until, archived=True)
+            summ += transfers.aggregate(summ=Coalesce(Sum('amount'), 0))['summ']
+        return summ
 
     def transfer_to(self, to_account, amount, **transaction_kwargs):
         """
         Transfer money to another account
         """
-        if to_account.sign == 1:
-            direction = -1
-        else:
-            direction = 1
-
-        transaction = Transaction.objects.create(**transaction_kwargs)
-        Transfer.objects.create(transaction=transaction, account=self, amount=-amount * direction)
-        Transfer.objects.create(transaction=transaction, account=to_account, amount=amount * direction)
-        transaction.save()
+        from issuer.ledger import Posting, post
 
         transaction_status = transaction_kwargs['status']
+        transaction, = post([Posting(from_account=self, to_account=to_account, amount=amount,
+                                     status=transaction_status,
+                                     external_transaction_id=transaction_kwargs.get('external_transaction_id'))])
+
         self.amount_available -= amount
         to_account.amount_available += amount
         if transaction_status in (TRANSACTION_STATUSES.PROCESSED, ):
             self.amount_ledger -= amount
             to_account.amount_ledger += amount
-        self.save()
-        to_account.save()
 
         return transaction
 
-    def get_transactions(self, dt=None):
-        # TODO: implement for endpoint
-        result = [tr.transaction for tr in self.transfers.all()]
-        return result
+    def get_statement(self, date_from=None, date_to=None, archived=False):
+        """
+        Transfers of this account with their transactions in [date_from, date_to),
+        oldest first and ordered on (created_at, id) for keyset pagination.
+        Archived transfers with ``archived``, see ``issuer.archive.merge``.
+        """
+        transfers = self.archived_transfers if archived else self.transfers
+        transfers = transfers.select_related('transaction').order_by('created_at', 'id')
+        if date_from:
+            transfers = transfers.filter(created_at__gte=date_from)
+        if date_to:
+            transfers = transfers.filter(created_at__lt=date_to)
+        return transfers
 
     def get_transfers_by_transaction_external_id(self, external_id):
         return self.transfers.filter(transaction__external_transaction_id=external_id)
 
 
-class Transaction(models.Model):
+class BalanceCheckpoint(models.Model):
+    """
+    Balances of an account as they were right before ``balance_at``
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='checkpoints')
+    balance_at = models.DateTimeField(_("Balance at"))
+    amount_available = models.DecimalField(_("Available Amount"), decimal_places=2, max_digits=12)
+    amount_ledger = models.DecimalField(_("Ledger Amount"), decimal_places=2, max_digits=12)
+
+    class Meta:
+        ordering = ['-balance_at']
+        verbose_name = _("Balance Checkpoint")
+        verbose_name_plural = _("Balance Checkpoints")
+
+        unique_together = ('account', 'balance_at')
+
+    def __str__(self):
+        return '{0} at {1}'.format(self.account, self.balance_at)
+
+
+class BaseTransaction(models.Model):
+    """
+    Fields of a transaction, shared with its archived copy
+    """
     STATUS_CHOICES = (
         (TRANSACTION_STATUSES.CANCELED, 'Canceled'),
         (TRANSACTION_STATUSES.HOLD, 'Drafted'),
@@ -108,29 +191,70 @@ class Transaction(models.Model):
                                  blank=True, null=True)
     external_transaction_id = models.CharField(_('Scheme transaction id'), max_length=12, null=True)
     status = models.SmallIntegerField(_("Transfer Status"), choices=STATUS_CHOICES)
+    # Set on authorisation holds until they are presented or released, see issuer.holds
+    expires_at = models.DateTimeField(_("Expires at"), null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+
+class Transaction(BaseTransaction):
 
     class Meta:
         ordering = ['-created_at']
         verbose_name = _("Transaction")
         verbose_name_plural = _("Transactions")
 
+        indexes = [
+            # holds.held_amounts: holds of a scheme transaction
+            models.Index(fields=['external_transaction_id', 'status']),
+            # get_balance: transfers of one status made after a point in time
+            models.Index(fields=['status', 'created_at']),
+            # expire_holds: open holds past their expiry
+            models.Index(fields=['expires_at']),
+        ]
+
     def __str__(self):
         return "Transaction at {created_at}".format(created_at=self.created_at)
 
-    def save(self, *args, **kwargs):
-        # TODO: amount
-        self.amount = self.transfers.aggregate(amount__avg=Avg('amount'))['amount__avg']
-        super(Transaction, self).save(*args, **kwargs)
+    @classmethod
+    def gross_amount_expression(cls):
+        """
+        Amount moved by a transaction derived from its transfers, used to back-fill ``amount``
+        """
+        return Sum(Func(F('amount'), function='ABS')) / 2
 
 
-class Transfer(models.Model):
-    account = models.ForeignKey(Account, related_name='transfers')
+class BaseTransfer(models.Model):
+    """
+    Fields of a transfer, shared with its archived copy
+    """
     amount = models.DecimalField(_("Amount"),
                                  decimal_places=2, max_digits=12,
                                  null=True)
 
     created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
     updated_at = models.DateTimeField(_("Updated at"), auto_now_add=True)
+
+    # Balances of the account right after this transfer, written by the posting engine
+    balance_available = models.DecimalField(_("Available balance after"), decimal_places=2, max_digits=12,
+                                            null=True, blank=True)
+    balance_ledger = models.DecimalField(_("Ledger balance after"), decimal_places=2, max_digits=12,
+                                         null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+    @property
+    def type(self):
+        if self.amount < 0:
+            return TRANSFER_TYPES.DEBIT
+        elif self.amount > 0:
+            return TRANSFER_TYPES.CREDIT
+
+
+class Transfer(BaseTransfer):
+    account = models.ForeignKey(Account, related_name='transfers')
     transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, null=True, blank=True,
                                     related_name='transfers', verbose_name=_('Transactions'))
 
@@ -139,18 +263,77 @@ class Transfer(models.Model):
         verbose_name = _("Transfer")
         verbose_name_plural = _("Transfers")
 
+        indexes = [
+            models.Index(fields=['account', 'transaction']),
+            # statements: keyset pagination on (created_at, id). Named, Django 1.11
+            # cannot name indexes on 'id' of models with an abstract base itself.
+            models.Index(fields=['account', 'created_at', 'id'], name='issuer_tran_account_26b57d_idx'),
+        ]
+
     def __str__(self):
         return 'Transfer: {0} {1} [{2}]'.format(self.id, self.account, self.amount)
 
+
+class ClearingBatch(models.Model):
+    """
+    One clearing run and the presentments it settled.
+
+    Runs are jobs picked up by the ``clearing_worker`` command. It settles the
+    presentments received up to ``until_message_id`` in chunks, each chunk in
+    its own DB transaction, and moves ``last_message_id`` forward with every
+    chunk so an interrupted run resumes where it stopped.
+    """
+    STATUS_CHOICES = (
+        (CLEARING_STATUSES.PENDING, 'Pending'),
+        (CLEARING_STATUSES.RUNNING, 'Running'),
+        (CLEARING_STATUSES.DONE, 'Done'),
+        (CLEARING_STATUSES.FAILED, 'Failed'),
+    )
+
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
+    billing_amount = models.DecimalField(_("Billing amount"), decimal_places=2, max_digits=12,
+                                         default=Decimal("0.00"))
+    settlement_amount = models.DecimalField(_("Settlement amount"), decimal_places=2, max_digits=12,
+                                            default=Decimal("0.00"))
+
+    status = models.CharField(_("Status"), choices=STATUS_CHOICES, max_length=12,
+                              default=CLEARING_STATUSES.PENDING)
+    until_message_id = models.PositiveIntegerField(_("Last presentment to clear"), default=0)
+    last_message_id = models.PositiveIntegerField(_("Last presentment processed"), default=0)
+    total_messages = models.PositiveIntegerField(_("Presentments to clear"), default=0)
+    cleared_messages = models.PositiveIntegerField(_("Presentments cleared"), default=0)
+    started_at = models.DateTimeField(_("Started at"), null=True, blank=True)
+    finished_at = models.DateTimeField(_("Finished at"), null=True, blank=True)
+    error = models.TextField(_("Error"), blank=True, default='')
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = _("Clearing Batch")
+        verbose_name_plural = _("Clearing Batches")
+
+        indexes = [
+            # clearing_worker: jobs waiting to run
+            models.Index(fields=['status', 'id']),
+        ]
+
+    def __str__(self):
+        return 'Clearing {0} at {1}'.format(self.id, self.created_at)
+
     @property
-    def type(self):
-        if self.amount < 0:
-            return TRANSFER_TYPES.DEBIT
-        elif self.amount > 0:
-            return TRANSFER_TYPES.CREDIT
+    def external_transaction_id(self):
+        return 'CLR%d' % self.id
+
+    @property
+    def progress(self):
+        if not self.total_messages:
+            return 1.0 if self.status == CLEARING_STATUSES.DONE else 0.0
+        return float(self.cleared_messages) / self.total_messages
 
 
-class SchemeMessage(models.Model):
+class BaseSchemeMessage(models.Model):
+    """
+    Fields of a scheme message, shared with its archived copy
+    """
     MESSAGE_TYPES_CHOICES = (
         (MESSAGE_TYPES.AUTHORISATION, MESSAGE_TYPES.AUTHORISATION),
         (MESSAGE_TYPES.PRESENTMENT, MESSAGE_TYPES.PRESENTMENT)
@@ -173,9 +356,103 @@ class SchemeMessage(models.Model):
 
     created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
 
+    class Meta:
+        abstract = True
+
+
+class SchemeMessage(BaseSchemeMessage):
+    clearing = models.ForeignKey(ClearingBatch, on_delete=models.PROTECT, null=True, blank=True,
+                                 related_name='messages', verbose_name=_('Clearing batch'))
+
     class Meta:
         ordering = ['-created_at']
         verbose_name = _("Scheme Message")
         verbose_name_plural = _("Scheme Messages")
 
         unique_together = ('type', 'transaction_id')
+
+
+class LedgerAudit(models.Model):
+    """
+    One run of the ``audit_ledger`` command, see ``issuer.audit``.
+
+    Incremental runs only check what changed after ``last_transfer_id`` of the
+    last run which finished without problems.
+    """
+    started_at = models.DateTimeField(_("Started at"), auto_now_add=True)
+    finished_at = models.DateTimeField(_("Finished at"), null=True, blank=True)
+    incremental = models.BooleanField(_("Incremental"), default=False)
+    since_transfer_id = models.PositiveIntegerField(_("Audited after transfer"), default=0)
+    last_transfer_id = models.PositiveIntegerField(_("Last transfer audited"), default=0)
+    problems = models.PositiveIntegerField(_("Problems found"), default=0)
+
+    class Meta:
+        ordering = ['-started_at']
+        verbose_name = _("Ledger Audit")
+        verbose_name_plural = _("Ledger Audits")
+
+    def __str__(self):
+        return 'Ledger audit {0} at {1}'.format(self.id, self.started_at)
+
+
+class ArchivedPeriod(models.Model):
+    """
+    A month of transactions, transfers and scheme messages moved to the archive
+    tables by the ``archive_history`` command, see ``issuer.archive``
+    """
+    month = models.DateField(_("Month"), unique=True)
+    archived_at = models.DateTimeField(_("Archived at"), auto_now_add=True)
+    transactions = models.PositiveIntegerField(_("Transactions"), default=0)
+    transfers = models.PositiveIntegerField(_("Transfers"), default=0)
+    messages = models.PositiveIntegerField(_("Scheme messages"), default=0)
+
+    class Meta:
+        ordering = ['-month']
+        verbose_name = _("Archived Period")
+        verbose_name_plural = _("Archived Periods")
+
+    def __str__(self):
+        return 'Archive of {0:%Y-%m}'.format(self.month)
+
+
+class ArchivedTransaction(BaseTransaction):
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = _("Archived Transaction")
+        verbose_name_plural = _("Archived Transactions")
+
+        indexes = [
+            models.Index(fields=['external_transaction_id', 'status']),
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+
+class ArchivedTransfer(BaseTransfer):
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='archived_transfers')
+    transaction = models.ForeignKey(ArchivedTransaction, on_delete=models.CASCADE, null=True, blank=True,
+                                    related_name='transfers', verbose_name=_('Transactions'))
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = _("Archived Transfer")
+        verbose_name_plural = _("Archived Transfers")
+
+        indexes = [
+            models.Index(fields=['account', 'created_at', 'id'], name='issuer_arch_account_6ec354_idx'),
+        ]
+
+
+class ArchivedSchemeMessage(BaseSchemeMessage):
+    clearing = models.ForeignKey(ClearingBatch, on_delete=models.PROTECT, null=True, blank=True,
+                                 related_name='archived_messages', verbose_name=_('Clearing batch'))
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = _("Archived Scheme Message")
+        verbose_name_plural = _("Archived Scheme Messages")
+
+        indexes = [
+            models.Index(fields=['type', 'transaction_id']),
+            models.Index(fields=['created_at']),
+        ]
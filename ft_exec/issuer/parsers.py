@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.utils import six
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+from issuer import fastjson
+from issuer.renderers import FastJSONRenderer
+
+
+class FastJSONParser(JSONParser):
+    """
+    JSONParser decoding through ``issuer.fastjson``
+    """
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return fastjson.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % six.text_type(exc))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Read-replica routing.
+
+Everything goes to the primary (``default``) except reads made inside
+``replica_reads()``, which the read-only views (balance, statement, account
+listing) wrap themselves in. Those go to one of ``REPLICA_DATABASES``.
+
+Replicas lag behind, so an account written in the last
+``REPLICA_STICKINESS`` seconds keeps the rest of the request on the
+primary and its owner reads their own writes. The ledger marks the accounts
+it posts to, in the ``REPLICA_STICKINESS_CACHE`` cache.
+"""
+from __future__ import unicode_literals
+
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+
+
+_local = threading.local()
+
+
+def _key(account_id):
+    return 'replica-sticky:%s' % account_id
+
+
+def _cache():
+    return caches[settings.REPLICA_STICKINESS_CACHE]
+
+
+def read_alias():
+    """
+    Database alias reads are routed to right now
+    """
+    return getattr(_local, 'alias', None) or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def replica_reads():
+    """
+    Route the reads made inside the block to a replica
+    """
+    _local.alias = random.choice(settings.REPLICA_DATABASES) if settings.REPLICA_DATABASES else None
+    try:
+        yield
+    finally:
+        _local.alias = None
+
+
+def read_your_writes(account_id):
+    """
+    Keep the rest of the request on the primary when ``account_id`` was written lately
+    """
+    if getattr(_local, 'alias', None) and _cache().get(_key(account_id)):
+        _local.alias = None
+
+
+def mark_written(account_ids):
+    if settings.REPLICA_DATABASES:
+        _cache().set_many(dict((_key(account_id), True) for account_id in account_ids),
+                          settings.REPLICA_STICKINESS)
+
+
+def mark_account_written(sender, instance, **kwargs):
+    """
+    post_save receiver for accounts changed outside the ledger (admin, accounts API)
+    """
+    mark_written([instance.pk])
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        return getattr(_local, 'alias', None)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema by replication
+        return db == DEFAULT_DB_ALIAS
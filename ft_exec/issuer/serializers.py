@@ -3,7 +3,8 @@ from rest_framework import serializers
 from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_403_FORBIDDEN, HTTP_409_CONFLICT
 
 from issuer.constants import BALANCE_TYPES, MESSAGE_TYPES
-from issuer.models import Transfer, Transaction, SchemeMessage, Account
+from issuer.models import Transfer, Transaction, SchemeMessage, Account, ClearingBatch
+from issuer.utils import decode_statement_cursor
 from app.settings import ACCOUNTS_MAPPING
 
 
@@ -26,6 +27,15 @@ class TransactionSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class ClearingBatchSerializer(serializers.ModelSerializer):
+    progress = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = ClearingBatch
+        fields = ('id', 'status', 'progress', 'total_messages', 'cleared_messages', 'billing_amount',
+                  'settlement_amount', 'created_at', 'started_at', 'finished_at', 'error')
+
+
 
 class CardIdMixin(object):
     card_id = serializers.CharField(help_text='Card id for chosen account')
@@ -67,6 +77,16 @@ class AuthMessageSerializer(BaseMessageSerializer):
         exclude = ('merchant_city', 'settlement_amount', 'settlement_currency')
 
 
+class AuthMessageBatchSerializer(AuthMessageSerializer):
+    """
+    Authorisation message inside a batch. Duplicates are reported per message
+    by the batch endpoint instead of failing validation of the whole batch.
+    """
+
+    class Meta(AuthMessageSerializer.Meta):
+        validators = []
+
+
 class PresentmentMessageSerializer(BaseMessageSerializer):
     type = serializers.CharField(help_text='presentment')
     merchant_city = serializers.CharField(help_text='City of merchant', max_length=64)
@@ -101,4 +121,25 @@ class BalanceSerializer(CardIdMixin, serializers.Serializer):
         (BALANCE_TYPES.LEDGER, BALANCE_TYPES.LEDGER),
         (BALANCE_TYPES.AVAILABLE, BALANCE_TYPES.AVAILABLE)
     )
-    balance_type = serializers.ChoiceField(choices=_choices, required=False)
\ No newline at end of file
+    balance_type = serializers.ChoiceField(choices=_choices, required=False)
+
+
+class StatementSerializer(CardIdMixin, serializers.Serializer):
+    card_id = serializers.CharField(help_text='Card id for chosen account')
+    date_from = serializers.DateTimeField(required=False, help_text='Start of the period, inclusive')
+    date_to = serializers.DateTimeField(required=False, help_text='End of the period, exclusive')
+    cursor = serializers.CharField(required=False, help_text='next_cursor of the previous page')
+    limit = serializers.IntegerField(required=False, default=100, min_value=1, max_value=1000,
+                                     help_text='Page size')
+    _export_choices = (
+        ('ndjson', 'ndjson'),
+        ('csv', 'csv'),
+    )
+    export = serializers.ChoiceField(choices=_export_choices, required=False,
+                                     help_text='Stream the whole period in this format instead of a page')
+
+    def validate_cursor(self, value):
+        try:
+            return decode_statement_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError("Wrong cursor")
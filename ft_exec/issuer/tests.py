@@ -1,7 +1,1272 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import base64
+import csv
+import io
+import json
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import skipUnless
 
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command, CommandError
+from django.db import connection, connections
+from django.db.models import F, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
+from django.utils.six import StringIO
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.renderers import JSONRenderer
 
-# TODO: just do it
\ No newline at end of file
+from issuer import clearing, holds, ledger, messages, utils
+from issuer.constants import TRANSACTION_STATUSES, BALANCE_TYPES, MESSAGE_TYPES, TRANSACTION_BALANCE_MAPPING
+from issuer.exceptions import QueryBudgetExceeded
+from issuer.instrumentation import registry
+from issuer.ledger import Posting
+from issuer.models import Account, SchemeMessage, Transaction, Transfer, ClearingBatch, ArchivedPeriod, \
+    ArchivedTransfer, BalanceCheckpoint, LedgerAudit
+from issuer.parsers import FastJSONParser
+from issuer.renderers import FastJSONRenderer
+from issuer.serializers import AuthMessageSerializer, PresentmentMessageSerializer
+from issuer.utils import invalidate_account_cache
+
+
+AUTH_HEADERS = {'HTTP_API_AUTH_KEY': 'lZ400y5AcQLukN6BI5qZCIMhiGHWJmup'}
+
+
+def auth_message(transaction_id, billing_amount, card_id='4321LOBO'):
+    return {
+        'type': 'authorisation',
+        'card_id': card_id,
+        'transaction_id': transaction_id,
+        'merchant_name': 'SNEAKERS R US',
+        'merchant_country': 'US',
+        'merchant_mcc': 5139,
+        'billing_amount': billing_amount,
+        'billing_currency': 'EUR',
+        'transaction_amount': billing_amount,
+        'transaction_currency': 'EUR',
+    }
+
+
+def presentment_message(transaction_id, billing_amount, settlement_amount, card_id='4321LOBO'):
+    message = auth_message(transaction_id, billing_amount, card_id)
+    message.update({
+        'type': 'presentment',
+        'merchant_city': 'New York',
+        'settlement_amount': settlement_amount,
+        'settlement_currency': 'EUR',
+    })
+    return message
+
+
+def run_in_threads(target, count):
+    """
+    Run ``target(i)`` for i in range(count) on separate threads and connections
+    """
+    errors = []
+
+    def worker(i):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=(i, )) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+class CleanCachesMixin(object):
+    """
+    Start every test without the account lookups, idempotent responses and balances cached by the ones before
+    """
+
+    def setUp(self):
+        super(CleanCachesMixin, self).setUp()
+        invalidate_account_cache()
+        caches['idempotency'].clear()
+        caches[settings.BALANCE_CACHE].clear()
+
+
+class ConcurrentPostingTest(TransactionTestCase):
+    fixtures = ['initial_data.json']
+
+    def test_concurrent_authorisations_never_overdraw(self):
+        account = Account.objects.get(name='Lora [Liability]')
+        bank = Account.objects.get(pk=3)
+        statuses = []
+
+        def authorise(i):
+            response = self.client_class().post('/api/v1/operations/auth/',
+                                                auth_message('STRESS%d' % i, '30.00'), **AUTH_HEADERS)
+            statuses.append(response.status_code)
+
+        self.assertEqual(run_in_threads(authorise, 25), [])
+
+        approved = statuses.count(200)
+        # 500.00 covers sixteen holds of 30.00 with something left, never seventeen
+        self.assertEqual(approved, 16)
+        self.assertEqual(statuses.count(403), 9)
+
+        account.refresh_from_db()
+        self.assertEqual(account.amount_available, Decimal('500.00') - 30 * approved)
+        self.assertEqual(account.amount_ledger, Decimal('500.00'))
+        bank.refresh_from_db()
+        self.assertEqual(bank.amount_available, Decimal('1000.00') + 30 * approved)
+        self.assertEqual(SchemeMessage.objects.count(), approved)
+        self.assertEqual(Transfer.objects.filter(account=account).count(), approved)
+
+    def test_concurrent_transfers_lose_no_updates(self):
+        lora = Account.objects.get(name='Lora [Liability]')
+        bob = Account.objects.get(name='BOB [Liability]')
+
+        def shuffle(i):
+            source, target = (lora, bob) if i % 2 else (bob, lora)
+            for _ in range(5):
+                Account.objects.get(pk=source.pk).transfer_to(Account.objects.get(pk=target.pk), Decimal('1.50'),
+                                                               status=TRANSACTION_STATUSES.PROCESSED)
+
+        self.assertEqual(run_in_threads(shuffle, 10), [])
+
+        lora.refresh_from_db()
+        bob.refresh_from_db()
+        self.assertEqual(lora.amount_available, Decimal('500.00'))
+        self.assertEqual(bob.amount_available, Decimal('500.00'))
+        self.assertEqual(lora.amount_ledger + bob.amount_ledger, Decimal('1000.00'))
+        self.assertEqual(Transfer.objects.count(), 2 * 10 * 5)
+
+        # Running balances were taken under the row locks, so they chain up to the stored balances
+        for account in (lora, bob):
+            balance = Decimal('500.00')
+            for transfer in account.transfers.order_by('created_at', 'id'):
+                from_side = transfer.pk == transfer.transaction.transfers.order_by('pk').first().pk
+                balance += Decimal('-1.50') if from_side else Decimal('1.50')
+                self.assertEqual((transfer.balance_available, transfer.balance_ledger), (balance, balance))
+            self.assertEqual(balance, account.amount_available)
+
+
+class PostingLockOrderTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def test_accounts_are_updated_in_id_order(self):
+        lora, bob, bank = [Account.objects.get(pk=pk) for pk in (1, 2, 3)]
+        with CaptureQueriesContext(connection) as queries:
+            ledger.post([
+                Posting(bank, bob, Decimal('5.00'), TRANSACTION_STATUSES.PROCESSED, None),
+                Posting(lora, bank, Decimal('7.00'), TRANSACTION_STATUSES.PROCESSED, None, guard=BALANCE_TYPES.LEDGER),
+                # Nets to nothing for bob, whose row is still locked in its turn
+                Posting(bob, lora, Decimal('5.00'), TRANSACTION_STATUSES.PROCESSED, None),
+            ])
+        locked = [query['sql'] for query in queries.captured_queries
+                  if query['sql'].startswith(('UPDATE "issuer_account"', 'SELECT (1)'))]
+        self.assertEqual(len(locked), 3)
+        self.assertEqual([int(re.search(r'"issuer_account"\."id" = (\d+)', sql).group(1)) for sql in locked],
+                         [1, 2, 3])
+
+    def test_transfers_carry_balance_changes(self):
+        lora, bank = Account.objects.get(pk=1), Account.objects.get(pk=3)
+        hold, load = ledger.post([
+            Posting(lora, bank, Decimal('10.00'), TRANSACTION_STATUSES.HOLD, None),
+            Posting(bank, lora, Decimal('3.00'), TRANSACTION_STATUSES.PROCESSED, None),
+        ])
+        self.assertEqual(sorted(hold.transfers.values_list('account_id', 'amount')),
+                         [(1, Decimal('-10.00')), (3, Decimal('10.00'))])
+        self.assertEqual(sorted(load.transfers.values_list('account_id', 'amount')),
+                         [(1, Decimal('3.00')), (3, Decimal('-3.00'))])
+
+        lora.refresh_from_db()
+        self.assertEqual((lora.amount_available, lora.amount_ledger), (Decimal('493.00'), Decimal('503.00')))
+
+    def test_transfers_signed_by_the_old_convention_are_migrated(self):
+        from importlib import import_module
+        from django.apps import apps
+
+        migration = import_module('issuer.migrations.0011_transfer_amount_signs')
+        lora, bob, bank = [Account.objects.get(pk=pk) for pk in (1, 2, 3)]
+        # (from, to, from amount, to amount) as the postings used to write them
+        old_transfers = [(lora, bank, '-10.00', '10.00'), (bank, lora, '3.00', '-3.00'), (lora, bob, '2.00', '-2.00')]
+        transactions = []
+        for from_account, to_account, from_amount, to_amount in old_transfers:
+            posted = Transaction.objects.create(status=TRANSACTION_STATUSES.PROCESSED)
+            Transfer.objects.create(transaction=posted, account=from_account, amount=Decimal(from_amount))
+            Transfer.objects.create(transaction=posted, account=to_account, amount=Decimal(to_amount))
+            transactions.append(posted)
+
+        migration.sign_with_balance_changes(apps, None)
+        self.assertEqual([list(posted.transfers.order_by('pk').values_list('amount', flat=True))
+                          for posted in transactions],
+                         [[Decimal('-10.00'), Decimal('10.00')], [Decimal('-3.00'), Decimal('3.00')],
+                          [Decimal('-2.00'), Decimal('2.00')]])
+
+
+class RunningBalanceTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def test_transfers_carry_balances_after_posting(self):
+        account = Account.objects.get(name='Lora [Liability]')
+        self.client.post('/api/v1/operations/auth/', auth_message('RUNNING1', '10.00'), **AUTH_HEADERS)
+        after_auth = timezone.now()
+        self.client.post('/api/v1/operations/presentment/', presentment_message('RUNNING1', '10.00', '9.50'),
+                         **AUTH_HEADERS)
+
+        account.refresh_from_db()
+        balances = list(account.get_statement().values_list('balance_available', 'balance_ledger'))
+        self.assertEqual(balances[0], (Decimal('490.00'), Decimal('500.00')))
+        self.assertEqual(balances[-1], (account.amount_available, account.amount_ledger))
+
+        self.assertEqual(account.get_balance(after_auth, BALANCE_TYPES.LEDGER), '500.00 EUR')
+        self.assertEqual(account.get_balance(timezone.now(), BALANCE_TYPES.LEDGER),
+                         '%s EUR' % account.amount_ledger)
+
+        response = self.client.get('/api/v1/operations/statement/', {'card_id': '4321LOBO'}, **AUTH_HEADERS)
+        lines = response.data['detail']['results']
+        self.assertEqual((lines[-1]['balance_available'], lines[-1]['balance_ledger']),
+                         (str(account.amount_available), str(account.amount_ledger)))
+
+
+class BalanceCheckpointTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def test_checkpointed_balances_match_the_sum_of_transfers(self):
+        account = Account.objects.get(name='Lora [Liability]')
+        bank = Account.objects.get(pk=3)
+        for i in range(3):
+            self.client.post('/api/v1/operations/auth/', auth_message('CHECK%d' % i, '10.00'), **AUTH_HEADERS)
+        self.client.post('/api/v1/operations/presentment/', presentment_message('CHECK0', '10.00', '9.50'),
+                         **AUTH_HEADERS)
+        account.transfer_to(bank, Decimal('5.00'), status=TRANSACTION_STATUSES.PROCESSED)
+        bank.transfer_to(account, Decimal('2.50'), status=TRANSACTION_STATUSES.PROCESSED)
+        # Spread over the last days, one transaction a day
+        today = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        for days, posted in enumerate(Transaction.objects.order_by('-pk'), 1):
+            Transaction.objects.filter(pk=posted.pk).update(created_at=today - timedelta(days=days))
+            Transfer.objects.filter(transaction=posted).update(created_at=today - timedelta(days=days))
+
+        call_command('balance_checkpoints', stdout=StringIO())
+        self.assertGreater(account.checkpoints.count(), 1)
+        # Only the checkpoints are left to answer point-in-time balances
+        Transfer.objects.update(balance_available=None, balance_ledger=None)
+
+        account.refresh_from_db()
+        for days in range(9):
+            point_in_time = today - timedelta(days=days, hours=6)
+            for balance_type in (BALANCE_TYPES.AVAILABLE, BALANCE_TYPES.LEDGER):
+                transfers = account.transfers.filter(created_at__lt=point_in_time,
+                                                     transaction__status__in=TRANSACTION_BALANCE_MAPPING[balance_type])
+                expected = Decimal('500.00') + (transfers.aggregate(total=Sum('amount'))['total'] or 0)
+                self.assertEqual(account.get_balance(point_in_time, balance_type), '%s EUR' % expected,
+                                 (days, balance_type))
+
+
+class AuthorisationBatchTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def authorise(self, batch):
+        response = self.client.post('/api/v1/operations/auth/batch/', json.dumps(batch),
+                                    content_type='application/json', **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        return [(result['transaction_id'], result['status_code'])
+                for result in json.loads(response.content.decode('utf-8'))['detail']]
+
+    def balances(self, pk):
+        account = Account.objects.get(pk=pk)
+        return account.amount_available, account.amount_ledger
+
+    def test_every_message_gets_its_result(self):
+        self.client.post('/api/v1/operations/auth/', auth_message('BATCH0', '10.00'), **AUTH_HEADERS)
+        results = self.authorise([
+            auth_message('BATCH1', '20.00'),
+            auth_message('BATCH0', '10.00'),
+            auth_message('BATCH2', '900.00', card_id='1111FOO'),
+            auth_message('BATCH3', '30.00', card_id='1111FOO'),
+        ])
+        self.assertEqual(results, [('BATCH1', 200), ('BATCH0', 409), ('BATCH2', 403), ('BATCH3', 200)])
+        self.assertEqual(self.balances(1), (Decimal('470.00'), Decimal('500.00')))
+        self.assertEqual(self.balances(2), (Decimal('470.00'), Decimal('500.00')))
+        self.assertEqual(set(SchemeMessage.objects.values_list('transaction_id', flat=True)),
+                         {'BATCH0', 'BATCH1', 'BATCH3'})
+
+        # Approved messages retried on their own get the same answer
+        response = self.client.post('/api/v1/operations/auth/', auth_message('BATCH3', '30.00', card_id='1111FOO'),
+                                    **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.balances(2), (Decimal('470.00'), Decimal('500.00')))
+
+    def test_duplicates_within_the_batch(self):
+        results = self.authorise([auth_message('BATCH4', '10.00'), auth_message('BATCH4', '10.00')])
+        self.assertEqual(results, [('BATCH4', 200), ('BATCH4', 409)])
+        self.assertEqual(self.balances(1), (Decimal('490.00'), Decimal('500.00')))
+        self.assertEqual(Transaction.objects.filter(external_transaction_id='BATCH4').count(), 1)
+
+    def test_funds_run_out_partway(self):
+        results = self.authorise([auth_message('BATCH%d' % i, amount)
+                                  for i, amount in enumerate(('200.00', '200.00', '200.00', '50.00'), 5)])
+        self.assertEqual(results, [('BATCH5', 200), ('BATCH6', 200), ('BATCH7', 403), ('BATCH8', 200)])
+        self.assertEqual(self.balances(1), (Decimal('50.00'), Decimal('500.00')))
+        self.assertEqual(Transaction.objects.filter(status=TRANSACTION_STATUSES.HOLD).count(), 3)
+
+    def test_invalid_messages_fail_the_whole_batch(self):
+        response = self.client.post('/api/v1/operations/auth/batch/', json.dumps([
+            auth_message('BATCH9', '10.00'), auth_message('BATCH10', '10.00', card_id='NOPE'),
+        ]), content_type='application/json', **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 400)
+        errors = json.loads(response.content.decode('utf-8'))['detail']
+        self.assertEqual((errors[0], list(errors[1])), ({}, ['card_id']))
+        self.assertEqual(self.balances(1), (Decimal('500.00'), Decimal('500.00')))
+
+        response = self.client.post('/api/v1/operations/auth/batch/', json.dumps([
+            auth_message('BATCH9', '10.00'), [1, 2], 'x', 5,
+        ]), content_type='application/json', **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 400)
+        errors = json.loads(response.content.decode('utf-8'))['detail']
+        self.assertEqual(errors[0], {})
+        for error in errors[1:]:
+            self.assertIn('Expected a dictionary', error['non_field_errors'][0])
+
+
+class IdempotentRetryTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def rows(self):
+        return Transaction.objects.count(), Transfer.objects.count(), SchemeMessage.objects.count()
+
+    def assertRetryAnsweredWithoutWrites(self, path, message):
+        response = self.client.post(path, message, **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        original, rows = json.loads(response.content.decode('utf-8')), self.rows()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(path, message, **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), original)
+        self.assertEqual(self.rows(), rows)
+        self.assertEqual([query['sql'] for query in queries.captured_queries
+                          if not query['sql'].startswith('SELECT')], [])
+
+    def test_retried_messages_get_the_original_response(self):
+        self.assertRetryAnsweredWithoutWrites('/api/v1/operations/auth/', auth_message('RETRY1', '10.00'))
+        self.assertRetryAnsweredWithoutWrites('/api/v1/operations/presentment/',
+                                              presentment_message('RETRY1', '10.00', '9.50'))
+        account = Account.objects.get(name='Lora [Liability]')
+        self.assertEqual((account.amount_available, account.amount_ledger), (Decimal('490.00'), Decimal('490.00')))
+
+    def test_retries_the_cache_does_not_know_are_duplicates(self):
+        self.client.post('/api/v1/operations/auth/', auth_message('RETRY2', '10.00'), **AUTH_HEADERS)
+        rows = self.rows()
+        # Another worker, or the same one after a restart
+        caches['idempotency'].clear()
+        response = self.client.post('/api/v1/operations/auth/', auth_message('RETRY2', '10.00'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.rows(), rows)
+
+
+class ClearingJobTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        super(ClearingJobTest, self).setUp()
+        for i in range(5):
+            self.client.post('/api/v1/operations/auth/', auth_message('CLEAR%d' % i, '10.00'), **AUTH_HEADERS)
+            self.client.post('/api/v1/operations/presentment/', presentment_message('CLEAR%d' % i, '10.00', '9.50'),
+                             **AUTH_HEADERS)
+
+    def test_clearing_runs_in_chunks_and_resumes(self):
+        response = self.client.post('/api/v1/operations/clearing/', {}, **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 202)
+        job = response.data['detail']
+        self.assertEqual((job['status'], job['total_messages'], job['progress']), ('pending', 5, 0.0))
+
+        # A worker that stopped after the first chunk of two
+        self.assertTrue(clearing.process_chunk(job['id'], 2))
+        progress = self.client.get(response['Location'], **AUTH_HEADERS).data['detail']
+        self.assertEqual((progress['cleared_messages'], progress['progress']), (2, 0.4))
+
+        call_command('clearing_worker', once=True, chunk_size=2, stdout=StringIO())
+
+        progress = self.client.get(response['Location'], **AUTH_HEADERS).data['detail']
+        self.assertEqual((progress['status'], progress['cleared_messages']), ('done', 5))
+        self.assertEqual((progress['billing_amount'], progress['settlement_amount']), ('50.00', '47.50'))
+        self.assertFalse(clearing.uncleared_presentments().exists())
+        # Two postings per chunk of 2 + 2 + 1 presentments
+        self.assertEqual(Transaction.objects.filter(external_transaction_id='CLR%d' % job['id']).count(), 6)
+        self.assertEqual(Account.objects.get(pk=6).amount_ledger, Decimal('47.50'))
+
+
+class LoadMoneyTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def test_bulk_loads_are_applied_in_batches(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as loads_file:
+            loads_file.write('cardholder,amount,currency\n' + 'Lora,1.50,EUR\nBOB,2.00\n' * 5 + 'Nobody,1.00\n')
+            loads_file.flush()
+            output = StringIO()
+            call_command('load_money', file=loads_file.name, batch_size=4, stdout=output)
+
+        self.assertIn('10 loads, 1 rejected', output.getvalue())
+        balances = dict(Account.objects.values_list('pk', 'amount_ledger'))
+        self.assertEqual((balances[1], balances[2], balances[3]),
+                         (Decimal('507.50'), Decimal('510.00'), Decimal('982.50')))
+        # One transaction per load, bank to card
+        self.assertEqual(Transaction.objects.filter(status=TRANSACTION_STATUSES.PROCESSED).count(), 10)
+        self.assertEqual(Transfer.objects.filter(account_id=3).aggregate(total=Sum('amount'))['total'],
+                         Decimal('-17.50'))
+
+
+class BackfillTransactionAmountsTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def test_amounts_are_recomputed_from_transfers(self):
+        lora, bank = Account.objects.get(pk=1), Account.objects.get(pk=3)
+        posted = lora.transfer_to(bank, Decimal('12.50'), status=TRANSACTION_STATUSES.PROCESSED)
+        empty = Transaction.objects.create(status=TRANSACTION_STATUSES.CANCELED)
+        Transaction.objects.update(amount=None)
+
+        call_command('backfill_transaction_amounts', chunk_size=1, stdout=StringIO())
+        amounts = dict(Transaction.objects.values_list('pk', 'amount'))
+        self.assertEqual(amounts, {posted.pk: Decimal('12.50'), empty.pk: Decimal('0')})
+
+
+class HoldExpiryTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def authorise(self, transaction_id, merchant_mcc=5139):
+        message = dict(auth_message(transaction_id, '10.00'), merchant_mcc=merchant_mcc)
+        response = self.client.post('/api/v1/operations/auth/', message, **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        return Transaction.objects.get(external_transaction_id=transaction_id, status=TRANSACTION_STATUSES.HOLD)
+
+    def test_expiry_depends_on_merchant(self):
+        hold = self.authorise('EXPIRY1')
+        self.assertAlmostEqual(hold.expires_at, hold.created_at + timedelta(days=settings.HOLD_EXPIRY_DAYS),
+                               delta=timedelta(seconds=5))
+        hotel_hold = self.authorise('EXPIRY2', merchant_mcc=7011)
+        self.assertAlmostEqual(hotel_hold.expires_at, hotel_hold.created_at + timedelta(days=31),
+                               delta=timedelta(seconds=5))
+
+    def test_expired_holds_are_released_once(self):
+        account = Account.objects.get(name='Lora [Liability]')
+        expired = self.authorise('EXPIRY3')
+        self.authorise('EXPIRY4')
+        presented = self.authorise('EXPIRY5')
+        response = self.client.post('/api/v1/operations/presentment/',
+                                    presentment_message('EXPIRY5', '10.00', '9.50'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        presented.refresh_from_db()
+        self.assertIsNone(presented.expires_at)
+        # A week later
+        Transaction.objects.filter(pk__in=(expired.pk, presented.pk), expires_at__isnull=False).update(
+            expires_at=timezone.now() - timedelta(minutes=1))
+        account.refresh_from_db()
+        available, ledger_balance = account.amount_available, account.amount_ledger
+
+        # Only the still open hold which expired, not the presented one
+        out = StringIO()
+        call_command('expire_holds', stdout=out)
+        self.assertIn('released 1 expired holds', out.getvalue())
+        self.assertEqual(holds.release_expired(100), 0)
+        account.refresh_from_db()
+        self.assertEqual(account.amount_available, available + 10)
+        self.assertEqual(account.amount_ledger, ledger_balance)
+        expired.refresh_from_db()
+        self.assertIsNone(expired.expires_at)
+
+        # A late presentment is charged but does not release the hold a second time
+        response = self.client.post('/api/v1/operations/presentment/',
+                                    presentment_message('EXPIRY3', '10.00', '9.50'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        account.refresh_from_db()
+        self.assertEqual(account.amount_available, available)
+        self.assertEqual(account.amount_ledger, ledger_balance - 10)
+
+    def test_released_holds_give_back_what_they_held(self):
+        account = Account.objects.get(name='Lora [Liability]')
+        self.authorise('EXPIRY6')
+        self.authorise('EXPIRY7')
+        account.refresh_from_db()
+        self.assertEqual((account.amount_available, account.amount_ledger), (Decimal('480.00'), Decimal('500.00')))
+
+        # Released by the presentment
+        response = self.client.post('/api/v1/operations/presentment/',
+                                    presentment_message('EXPIRY6', '10.00', '9.50'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        account.refresh_from_db()
+        self.assertEqual((account.amount_available, account.amount_ledger), (Decimal('480.00'), Decimal('490.00')))
+
+        # Released by the sweeper
+        Transaction.objects.filter(external_transaction_id='EXPIRY7').update(
+            expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(holds.release_expired(100), 1)
+        account.refresh_from_db()
+        self.assertEqual(account.amount_available, account.amount_ledger)
+
+
+class IngestPresentmentsTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        super(IngestPresentmentsTest, self).setUp()
+        for i in range(4):
+            self.client.post('/api/v1/operations/auth/', auth_message('INGEST%d' % i, '10.00'), **AUTH_HEADERS)
+
+    def test_file_postings_match_the_webhook(self):
+        self.client.post('/api/v1/operations/presentment/', presentment_message('INGEST0', '10.00', '9.50'),
+                         **AUTH_HEADERS)
+        account = Account.objects.get(name='Lora [Liability]')
+        webhook_change = (Decimal('500.00') - account.amount_ledger, Decimal('460.00') - account.amount_available)
+
+        messages = [presentment_message('INGEST%d' % i, '10.00', '9.50') for i in (0, 1, 2, 3, 3)]
+        messages.append(presentment_message('UNKNOWN', '10.00', '9.50'))
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as presentments_file:
+            presentments_file.write(''.join(json.dumps(message) + '\n' for message in messages))
+            presentments_file.flush()
+            call_command('ingest_presentments', presentments_file.name, chunk_size=2,
+                         stdout=StringIO(), stderr=StringIO())
+
+        account.refresh_from_db()
+        self.assertEqual(account.amount_ledger, Decimal('500.00') - 4 * webhook_change[0])
+        self.assertEqual(account.amount_available, Decimal('460.00') - 4 * webhook_change[1])
+        self.assertEqual(SchemeMessage.objects.filter(type=MESSAGE_TYPES.PRESENTMENT).count(), 4)
+        # Scheme retries of ingested presentments are answered from the idempotency cache
+        response = self.client.post('/api/v1/operations/presentment/',
+                                    presentment_message('INGEST2', '10.00', '9.50'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+
+    def test_rejected_presentments_keep_their_holds_open(self):
+        messages = [presentment_message('INGEST0', '10.00', '9.50'), presentment_message('INGEST1', '600.00', '9.50')]
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as presentments_file:
+            presentments_file.write(''.join(json.dumps(message) + '\n' for message in messages))
+            presentments_file.flush()
+            call_command('ingest_presentments', presentments_file.name, stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(set(holds.open_holds(['INGEST%d' % i for i in range(4)])
+                             .values_list('external_transaction_id', flat=True)), {'INGEST1', 'INGEST2', 'INGEST3'})
+
+
+class FastJSONTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def test_fast_renderer_and_parser_match_stock_ones(self):
+        message = SchemeMessage(id=1, created_at=timezone.now(), **presentment_message('JSON1', '10.00', '9.50'))
+        payload = {'message': PresentmentMessageSerializer(message).data, 'total': Decimal('10.10'),
+                   'city': 'Zürich \u2028'}
+
+        rendered = FastJSONRenderer().render(payload)
+        self.assertEqual(json.loads(rendered.decode('utf-8')),
+                         dict(json.loads(JSONRenderer().render(payload).decode('utf-8')), total='10.10'))
+        self.assertNotIn('\u2028'.encode('utf-8'), rendered)
+        self.assertEqual(FastJSONParser().parse(io.BytesIO(rendered)),
+                         json.loads(rendered.decode('utf-8')))
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b'{"billing_amount": NaN}'))
+
+    def test_webhooks_accept_json_bodies(self):
+        response = self.client.post('/api/v1/operations/auth/', json.dumps(auth_message('JSON2', '10.00')),
+                                    content_type='application/json', **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['detail'], 'Authorization success')
+
+
+@skipUnless('replica' in settings.DATABASES, 'No replica database configured')
+class ReplicaRoutingTest(CleanCachesMixin, TransactionTestCase):
+    """
+    Balance reads go to the replica unless the card was just written, the webhooks never do
+    """
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        super(ReplicaRoutingTest, self).setUp()
+        caches[settings.REPLICA_STICKINESS_CACHE].clear()
+
+    def get_balance(self):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get('/api/v1/operations/balance/', {'card_id': '4321LOBO'}, **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        return len(primary), len(replica)
+
+    def test_reads_go_to_the_replica_unless_the_card_was_written(self):
+        primary, replica = self.get_balance()
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+        with CaptureQueriesContext(connections['replica']) as replica_writes:
+            response = self.client.post('/api/v1/operations/auth/', auth_message('REPLICA1', '10.00'),
+                                        **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(replica_writes), 0)
+
+        # Read your writes: the replica may not have the hold yet
+        primary, replica = self.get_balance()
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+        response = self.client.get('/api/v1/operations/balance/', {'card_id': '4321LOBO'}, **AUTH_HEADERS)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['detail'], '490.00 EUR')
+
+        caches[settings.REPLICA_STICKINESS_CACHE].clear()
+        caches[settings.BALANCE_CACHE].clear()
+        primary, replica = self.get_balance()
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+
+@override_settings(REPLICA_DATABASES=())
+class AccountCacheTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def test_repeat_lookups_are_served_from_the_cache(self):
+        with self.assertNumQueries(1):
+            account = utils.get_account_by_card_id('4321LOBO')
+        self.assertEqual((account.pk, account.name, account.currency), (1, 'Lora [Liability]', 'EUR'))
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_account_by_card_id('4321LOBO').pk, 1)
+            self.assertEqual(utils.get_account_by_cardholder_name('Lora').pk, 1)
+            self.assertEqual(utils.get_account_by_card_id('4321LOBO').name, 'Lora [Liability]')
+        # Another lookup key is cached on its own
+        with self.assertNumQueries(1):
+            self.assertEqual(utils.get_bank_acount().pk, 3)
+        with self.assertNumQueries(0):
+            utils.get_bank_acount()
+
+    def test_entries_are_reloaded_once_expired(self):
+        utils.get_account_by_card_id('4321LOBO')
+        # Not through save(), the signal does not see it and the cached entry is still fresh
+        Account.objects.filter(pk=1).update(currency='USD')
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_account_by_card_id('4321LOBO').currency, 'EUR')
+
+        with override_settings(ACCOUNT_CACHE_TTL=-1):
+            invalidate_account_cache()
+            with self.assertNumQueries(1):
+                self.assertEqual(utils.get_account_by_card_id('4321LOBO').currency, 'USD')
+            Account.objects.filter(pk=1).update(currency='EUR')
+            # Stored already expired, the next lookup goes to the database again
+            with self.assertNumQueries(1):
+                self.assertEqual(utils.get_account_by_card_id('4321LOBO').currency, 'EUR')
+
+    def test_saving_an_account_drops_the_cache(self):
+        self.assertEqual(utils.get_account_by_card_id('4321LOBO').currency, 'EUR')
+        self.assertEqual(utils.get_bank_acount().currency, 'EUR')
+        account = Account.objects.get(pk=1)
+        account.currency = 'USD'
+        account.save()
+        with self.assertNumQueries(2):
+            self.assertEqual(utils.get_account_by_card_id('4321LOBO').currency, 'USD')
+            self.assertEqual(utils.get_bank_acount().currency, 'EUR')
+
+        Account.objects.get(pk=1).delete()
+        with self.assertRaises(Account.DoesNotExist):
+            utils.get_account_by_card_id('4321LOBO')
+
+    def test_balances_are_never_cached(self):
+        cached = utils.get_account_by_card_id('4321LOBO')
+        self.assertEqual(set(cached.get_deferred_fields()), {'amount_available', 'amount_ledger'})
+        response = self.client.post('/api/v1/operations/auth/', auth_message('ACCOUNTS1', '10.00'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(0):
+            account = utils.get_account_by_card_id('4321LOBO')
+        # Loaded on first access, after the posting
+        with self.assertNumQueries(1):
+            self.assertEqual(account.amount_available, Decimal('490.00'))
+        self.assertEqual(account.amount_ledger, Decimal('500.00'))
+        Account.objects.filter(pk=1).update(amount_available=Decimal('480.00'))
+        self.assertEqual(utils.get_account_by_card_id('4321LOBO').amount_available, Decimal('480.00'))
+
+
+@override_settings(REPLICA_DATABASES=())
+class BalanceCacheTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def get_balance(self, **headers):
+        return self.client.get('/api/v1/operations/balance/', {'card_id': '4321LOBO'},
+                               **dict(AUTH_HEADERS, **headers))
+
+    def test_unchanged_balances_cost_no_queries(self):
+        response = self.get_balance()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.get_balance()
+            self.assertEqual((response.status_code, response['ETag']), (200, etag))
+            self.assertEqual(json.loads(response.content.decode('utf-8'))['detail'], '500.00 EUR')
+            response = self.get_balance(HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+
+        ledger_response = self.client.get('/api/v1/operations/balance/', {
+            'card_id': '4321LOBO', 'balance_type': 'ledger'}, **AUTH_HEADERS)
+        self.assertNotEqual(ledger_response['ETag'], etag)
+
+    def test_postings_invalidate_cached_balances(self):
+        etag = self.get_balance()['ETag']
+        response = self.client.post('/api/v1/operations/auth/', auth_message('CACHE1', '10.00'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.get_balance(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['detail'], '490.00 EUR')
+
+    def test_balances_changed_outside_the_ledger(self):
+        self.client.post('/api/v1/operations/auth/', auth_message('CACHE2', '10.00'), **AUTH_HEADERS)
+        after_auth = timezone.now()
+        self.assertEqual(json.loads(self.get_balance().content.decode('utf-8'))['detail'], '490.00 EUR')
+
+        response = self.client.patch('/api/v1/accounts/1/', json.dumps({'amount_available': '700.00'}),
+                                     content_type='application/json', **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(self.get_balance().content.decode('utf-8'))['detail'], '700.00 EUR')
+
+        account = Account.objects.get(pk=1)
+        account.amount_available = Decimal('650.00')
+        account.save()
+        self.assertEqual(json.loads(self.get_balance().content.decode('utf-8'))['detail'], '650.00 EUR')
+        self.assertEqual(account.get_balance(timezone.now() + timedelta(days=1)), '650.00 EUR')
+        # Point-in-time balances are still the running balances of the ledger
+        self.assertEqual(account.get_balance(after_auth), '490.00 EUR')
+
+
+@override_settings(REPLICA_DATABASES=())
+class ArchiveTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        self.account = Account.objects.get(name='Lora [Liability]')
+        self.old = timezone.now() - timedelta(days=settings.ARCHIVE_AFTER_DAYS + 62)
+
+        response = self.client.post('/api/v1/operations/auth/', auth_message('ARCHIVE1', '10.00'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        for _ in range(3):
+            self.account.transfer_to(Account.objects.get(pk=3), Decimal('5.00'),
+                                     status=TRANSACTION_STATUSES.PROCESSED)
+        for minutes, posted in enumerate(Transaction.objects.order_by('pk')):
+            Transaction.objects.filter(pk=posted.pk).update(created_at=self.old + timedelta(minutes=minutes))
+            Transfer.objects.filter(transaction=posted).update(created_at=self.old + timedelta(minutes=minutes))
+        SchemeMessage.objects.update(created_at=self.old)
+        # And one of this month
+        self.account.transfer_to(Account.objects.get(pk=3), Decimal('5.00'), status=TRANSACTION_STATUSES.PROCESSED)
+
+    def statement(self, **params):
+        lines, cursor = [], None
+        while True:
+            query = dict(params, card_id='4321LOBO', limit=2, **({'cursor': cursor} if cursor else {}))
+            response = self.client.get('/api/v1/operations/statement/', query, **AUTH_HEADERS)
+            detail = json.loads(response.content.decode('utf-8'))['detail']
+            lines.extend(line['id'] for line in detail['results'])
+            cursor = detail['next_cursor']
+            if not cursor:
+                return lines
+
+    def test_archived_history_reads_the_same(self):
+        point_in_time = self.old + timedelta(minutes=2, seconds=30)
+        balances = [self.account.get_balance(point_in_time, balance_type) for balance_type in
+                    (BALANCE_TYPES.AVAILABLE, BALANCE_TYPES.LEDGER)]
+        statement = self.statement()
+        self.assertEqual(len(statement), 5)
+
+        call_command('archive_history', stdout=StringIO())
+
+        # The open hold and its authorisation stay, a presentment may still come for them
+        self.assertEqual(list(Transaction.objects.values_list('status', flat=True).order_by('pk')),
+                         [TRANSACTION_STATUSES.HOLD, TRANSACTION_STATUSES.PROCESSED])
+        self.assertEqual(SchemeMessage.objects.count(), 1)
+        self.assertEqual(ArchivedTransfer.objects.count(), 6)
+        self.assertEqual(sum(ArchivedPeriod.objects.values_list('transactions', flat=True)), 3)
+
+        self.assertEqual(self.statement(), statement)
+        self.assertEqual(self.statement(date_from=timezone.now() - timedelta(days=1)), statement[-1:])
+        self.assertEqual([self.account.get_balance(point_in_time, balance_type) for balance_type in
+                          (BALANCE_TYPES.AVAILABLE, BALANCE_TYPES.LEDGER)], balances)
+
+        # Recent history does not look at the archive at all
+        with self.assertNumQueries(1):
+            self.account.get_balance(timezone.now() - timedelta(days=1))
+
+    def test_archived_messages_and_transfers_still_count(self):
+        Transaction.objects.filter(external_transaction_id='ARCHIVE1').update(
+            expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(holds.release_expired(100), 1)
+        call_command('balance_checkpoints', stdout=StringIO())
+        checkpoints = list(self.account.checkpoints.values_list('balance_at', 'amount_available', 'amount_ledger'))
+
+        call_command('archive_history', stdout=StringIO())
+        self.assertEqual(SchemeMessage.objects.count(), 0)
+
+        # The authorisation is in the archive only, long after its response left the idempotency cache
+        caches['idempotency'].clear()
+        response = self.client.post('/api/v1/operations/auth/', auth_message('ARCHIVE1', '10.00'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/v1/operations/presentment/',
+                                    presentment_message('ARCHIVE1', '10.00', '9.50'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+
+        # Checkpoints rebuilt after archiving sum the archived transfers too
+        self.account.checkpoints.all().delete()
+        call_command('balance_checkpoints', account_ids=[self.account.pk], stdout=StringIO())
+        self.assertEqual(list(self.account.checkpoints.values_list('balance_at', 'amount_available', 'amount_ledger')),
+                         checkpoints)
+
+
+class StatementTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        super(StatementTest, self).setUp()
+        self.account = Account.objects.get(name='Lora [Liability]')
+        bank = Account.objects.get(pk=3)
+        for i in range(3):
+            self.client.post('/api/v1/operations/auth/', auth_message('STATEMENT%d' % i, '10.00'), **AUTH_HEADERS)
+        self.client.post('/api/v1/operations/presentment/', presentment_message('STATEMENT0', '10.00', '9.50'),
+                         **AUTH_HEADERS)
+        bank.transfer_to(self.account, Decimal('2.50'), status=TRANSACTION_STATUSES.PROCESSED)
+        self.ids = list(self.account.transfers.order_by('created_at', 'id').values_list('pk', flat=True))
+
+    def get(self, **params):
+        return self.client.get('/api/v1/operations/statement/', dict(params, card_id='4321LOBO'), **AUTH_HEADERS)
+
+    def pages(self, **params):
+        pages, cursor = [], None
+        while True:
+            response = self.get(**dict(params, **({'cursor': cursor} if cursor else {})))
+            self.assertEqual(response.status_code, 200)
+            detail = json.loads(response.content.decode('utf-8'))['detail']
+            pages.append(detail['results'])
+            cursor = detail['next_cursor']
+            if not cursor:
+                return pages
+
+    def test_pages_follow_the_cursor(self):
+        pages = self.pages(limit=2)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2])
+        lines = [line for page in pages for line in page]
+        self.assertEqual([line['id'] for line in lines], self.ids)
+        self.account.refresh_from_db()
+        self.assertEqual((lines[-1]['amount'], lines[-1]['balance_available'], lines[-1]['balance_ledger']),
+                         ('2.50', str(self.account.amount_available), str(self.account.amount_ledger)))
+        self.assertEqual([line['id'] for page in self.pages(limit=4) for line in page], self.ids)
+
+    def test_invalid_cursors(self):
+        for cursor in ('garbage', base64.urlsafe_b64encode(b'yesterday,1').decode('ascii'),
+                       base64.urlsafe_b64encode(b'2026-01-01T00:00:00+00:00,x').decode('ascii'),
+                       base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii')):
+            response = self.get(cursor=cursor)
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(json.loads(response.content.decode('utf-8'))['detail'], {'cursor': ['Wrong cursor']})
+
+    def test_exports(self):
+        lines = [line for page in self.pages() for line in page]
+
+        response = self.get(export='ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        body = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual([json.loads(line) for line in body.splitlines()], lines)
+
+        response = self.get(export='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="statement.csv"')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+        self.assertEqual(rows[0], ['id', 'created_at', 'amount', 'external_transaction_id', 'status',
+                                   'balance_available', 'balance_ledger'])
+        self.assertEqual(rows[1:], [[six.text_type(line[field]) if line[field] is not None else ''
+                                     for field in rows[0]] for line in lines])
+
+    def test_period_spanning_archived_months(self):
+        old = timezone.now() - timedelta(days=settings.ARCHIVE_AFTER_DAYS + 62)
+        # The presentment and the load happened months ago, the holds still open stay in the hot tables
+        archived = Transaction.objects.exclude(status=TRANSACTION_STATUSES.HOLD, expires_at__isnull=False)
+        for minutes, posted in enumerate(archived.order_by('pk')):
+            Transaction.objects.filter(pk=posted.pk).update(created_at=old + timedelta(minutes=minutes))
+            Transfer.objects.filter(transaction=posted).update(created_at=old + timedelta(minutes=minutes))
+        SchemeMessage.objects.filter(type=MESSAGE_TYPES.PRESENTMENT).update(clearing=ClearingBatch.objects.create())
+        call_command('archive_history', stdout=StringIO())
+        self.assertEqual(self.account.archived_transfers.count(), 4)
+
+        ids = list(self.account.archived_transfers.order_by('created_at', 'id').values_list('pk', flat=True)) + \
+            list(self.account.transfers.order_by('created_at', 'id').values_list('pk', flat=True))
+        self.assertEqual(sorted(ids), sorted(self.ids))
+        since = (old - timedelta(days=1)).isoformat()
+        self.assertEqual([line['id'] for page in self.pages(limit=2, date_from=since) for line in page], ids)
+        body = b''.join(self.get(export='ndjson', date_from=since).streaming_content).decode('utf-8')
+        self.assertEqual([json.loads(line)['id'] for line in body.splitlines()], ids)
+        # Periods within the hot tables only
+        recent = (timezone.now() - timedelta(days=1)).isoformat()
+        self.assertEqual([line['id'] for page in self.pages(date_from=recent) for line in page], ids[4:])
+
+
+class LedgerAuditTest(CleanCachesMixin, TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        super(LedgerAuditTest, self).setUp()
+        # The opening balances of the fixture accounts
+        call_command('balance_checkpoints', stdout=StringIO())
+        self.account = Account.objects.get(name='Lora [Liability]')
+        response = self.client.post('/api/v1/operations/auth/', auth_message('AUDIT1', '10.00'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/api/v1/operations/presentment/',
+                                    presentment_message('AUDIT1', '10.00', '9.50'), **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+
+    def audit(self, **options):
+        out = StringIO()
+        call_command('audit_ledger', processes=1, chunk_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def test_clean_ledger(self):
+        out = self.audit(trial_balance=True)
+        self.assertIn('Successfully audited the ledger up to transfer %s' % Transfer.objects.latest('pk').pk, out)
+        self.assertIn('Account %s: debit' % self.account.pk, out)
+
+        audit = LedgerAudit.objects.get()
+        self.assertEqual((audit.since_transfer_id, audit.problems), (0, 0))
+        self.assertIsNotNone(audit.finished_at)
+
+    def test_tampering_is_found(self):
+        transfer = Transfer.objects.filter(account=self.account).latest('pk')
+        Transfer.objects.filter(pk=transfer.pk).update(amount=transfer.amount + 1)
+        Account.objects.filter(pk=self.account.pk).update(amount_available=F('amount_available') + 1)
+
+        with self.assertRaises(CommandError):
+            self.audit(trial_balance=True)
+        audit = LedgerAudit.objects.get()
+        # The transaction, the balance of the card and the trial balance
+        self.assertEqual(audit.problems, 3)
+
+    def test_balances_changed_without_transfers_drift(self):
+        self.assertEqual(self.audit().count('ERROR'), 0)
+        response = self.client.patch('/api/v1/accounts/%s/' % self.account.pk,
+                                     json.dumps({'amount_available': '700.00'}),
+                                     content_type='application/json', **AUTH_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        with self.assertRaises(CommandError):
+            self.audit()
+        self.assertEqual(LedgerAudit.objects.first().problems, 1)
+
+    def test_accounts_without_checkpoints(self):
+        BalanceCheckpoint.objects.all().delete()
+        # The seeded balances of the fixture accounts have no transfers behind them
+        out = self.audit()
+        self.assertIn('Successfully audited the ledger', out)
+        self.assertIn('no checkpoint %s: stored 490.00/490.00, transfers -10.00/-10.00' % self.account.pk, out)
+        self.assertEqual(LedgerAudit.objects.get().problems, 0)
+
+        call_command('balance_checkpoints', stdout=StringIO())
+        out = self.audit()
+        self.assertNotIn('no checkpoint', out)
+        Account.objects.filter(pk=self.account.pk).update(amount_available=F('amount_available') + 1)
+        with self.assertRaises(CommandError):
+            self.audit()
+        self.assertEqual(LedgerAudit.objects.first().problems, 1)
+
+    def test_incremental_audit(self):
+        self.audit()
+        last_transfer_id = Transfer.objects.latest('pk').pk
+        # Transfers audited already are not checked again
+        Transfer.objects.filter(pk=last_transfer_id).update(amount=0)
+        self.audit(incremental=True)
+
+        bob = Account.objects.get(name='BOB [Liability]')
+        bob.transfer_to(Account.objects.get(pk=6), Decimal('5.00'), status=TRANSACTION_STATUSES.PROCESSED)
+        Account.objects.filter(pk=bob.pk).update(amount_ledger=F('amount_ledger') + 1)
+        with self.assertRaises(CommandError):
+            self.audit(incremental=True)
+        audit = LedgerAudit.objects.first()
+        self.assertEqual((audit.since_transfer_id, audit.problems), (last_transfer_id, 1))
+
+
+@skipUnless(six.PY3, 'ASGI needs Python 3')
+class ASGITest(CleanCachesMixin, TransactionTestCase):
+    """
+    The webhooks served by the ASGI application, its thread pool writes to the database outside the test transaction
+    """
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        from issuer.asgi import ASGIHandler
+
+        super(ASGITest, self).setUp()
+        self.application = ASGIHandler(threads=1)
+
+    def tearDown(self):
+        self.application.executor.submit(connections.close_all).result()
+        self.application.executor.shutdown()
+
+    def request(self, method, path, data=None, query_string='', headers=AUTH_HEADERS):
+        import asyncio
+        from issuer.asgi import call
+
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        headers = [(name[5:].replace('_', '-'), value) for name, value in headers.items()]
+        headers += [('Host', 'testserver'), ('Content-Type', 'application/json')]
+        path = '%s?%s' % (path, query_string) if query_string else path
+        response_status, response_headers, content = asyncio.get_event_loop().run_until_complete(
+            call(self.application, method, path, body, headers))
+        return response_status, response_headers, json.loads(content.decode('utf-8')) if content else None
+
+    def test_webhooks(self):
+        response_status, headers, payload = self.request('POST', '/api/v1/operations/auth/',
+                                                         auth_message('ASGI1', '10.00'))
+        self.assertEqual((response_status, payload['detail']), (200, 'Authorization success'))
+        self.assertIn('queries', headers['server-timing'])
+        self.assertTrue(Transaction.objects.filter(external_transaction_id='ASGI1',
+                                                   status=TRANSACTION_STATUSES.HOLD).exists())
+        # A retry gets the original response
+        self.assertEqual(self.request('POST', '/api/v1/operations/auth/', auth_message('ASGI1', '10.00'))[2],
+                         payload)
+        response_status, _, payload = self.request('POST', '/api/v1/operations/auth/',
+                                                   dict(auth_message('ASGI2', '10.00'), billing_amount='x'))
+        self.assertEqual((response_status, list(payload['detail'])), (400, ['billing_amount']))
+        self.assertEqual(self.request('POST', '/api/v1/operations/auth/', auth_message('ASGI2', '10.00'),
+                                      headers={})[0], 403)
+
+        response_status, _, payload = self.request('POST', '/api/v1/operations/presentment/',
+                                                   presentment_message('ASGI1', '10.00', '9.50'))
+        self.assertEqual((response_status, payload['success']), (200, True))
+        self.assertEqual(SchemeMessage.objects.filter(transaction_id='ASGI1').count(), 2)
+
+    def test_balance(self):
+        response_status, headers, payload = self.request('GET', '/api/v1/operations/balance/',
+                                                         query_string='card_id=4321LOBO&balance_type=ledger')
+        response = self.client.get('/api/v1/operations/balance/', {'card_id': '4321LOBO', 'balance_type': 'ledger'},
+                                   **AUTH_HEADERS)
+        self.assertEqual((response_status, payload), (200, json.loads(response.content.decode('utf-8'))))
+        not_modified = self.request('GET', '/api/v1/operations/balance/',
+                                    query_string='card_id=4321LOBO&balance_type=ledger',
+                                    headers=dict(AUTH_HEADERS, HTTP_IF_NONE_MATCH=headers['etag']))
+        self.assertEqual((not_modified[0], not_modified[2]), (304, None))
+        self.assertEqual(self.request('GET', '/api/v1/operations/balance/',
+                                      query_string='card_id=4321LOBO&balance_type=x')[0], 400)
+
+    def test_other_requests_go_through_django(self):
+        response_status, _, payload = self.request('POST', '/api/v1/operations/clearing/', {})
+        self.assertEqual(response_status, 202)
+        self.assertTrue(ClearingBatch.objects.filter(pk=payload['detail']['id']).exists())
+
+
+class DatabaseSettingsTest(TestCase):
+    """
+    The suite runs on SQLite and on PostgreSQL (FT_EXEC_DB_ENGINE=postgresql), this checks the tuning of either
+    """
+
+    def test_connections_are_persistent(self):
+        connection.ensure_connection()
+        self.assertEqual(connection.settings_dict['CONN_MAX_AGE'], settings.CONN_MAX_AGE)
+        self.assertGreater(connection.close_at, time.time())
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite only')
+    def test_sqlite_runs_in_wal_mode(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL only')
+    def test_postgresql_reads_committed_balances(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SHOW transaction_isolation')
+            self.assertEqual(cursor.fetchone()[0], 'read committed')
+
+
+class MessageSchemaTest(TestCase):
+    """
+    issuer.messages accepts and rejects scheme messages like the serializers it replaced
+    """
+    fixtures = ['initial_data.json']
+
+    def assertSameValidation(self, schema, serializer_class, data):
+        serializer = serializer_class(data=data)
+        if serializer.is_valid():
+            self.assertEqual(schema.validate(data), dict(serializer.validated_data))
+        else:
+            with self.assertRaises(ValidationError) as raised:
+                schema.validate(data)
+            self.assertEqual(raised.exception.detail, serializer.errors)
+
+    def test_authorisations(self):
+        self.client.post('/api/v1/operations/auth/', auth_message('SCHEMA0', '10.00'), **AUTH_HEADERS)
+        for changes in ({}, {'billing_amount': '1.234'}, {'billing_amount': 'x', 'merchant_mcc': '5.5'},
+                        {'card_id': 'NOCARD', 'type': 'presentment'}, {'merchant_name': ''},
+                        {'transaction_id': 'SCHEMA0'}):
+            self.assertSameValidation(messages.AUTHORISATION, AuthMessageSerializer,
+                                      dict(auth_message('SCHEMA1', '10.00'), **changes))
+        message = auth_message('SCHEMA1', '10.00')
+        del message['billing_currency']
+        self.assertSameValidation(messages.AUTHORISATION, AuthMessageSerializer, message)
+
+    def test_presentments(self):
+        self.client.post('/api/v1/operations/auth/', auth_message('SCHEMA2', '10.00'), **AUTH_HEADERS)
+        for changes in ({}, {'transaction_id': 'NOAUTH'}, {'settlement_amount': '123456789012.00'},
+                        {'merchant_city': ''}):
+            self.assertSameValidation(messages.PRESENTMENT, PresentmentMessageSerializer,
+                                      dict(presentment_message('SCHEMA2', '10.00', '9.50'), **changes))
+
+    def test_bodies_which_are_not_objects(self):
+        for path in ('/api/v1/operations/auth/', '/api/v1/operations/presentment/'):
+            for body in ('[1, 2]', '"x"', '5'):
+                response = self.client.post(path, body, content_type='application/json', **AUTH_HEADERS)
+                self.assertEqual(response.status_code, 400, (path, body))
+                detail = json.loads(response.content.decode('utf-8'))['detail']
+                self.assertIn('Expected a dictionary', detail['non_field_errors'][0])
+
+
+class LedgerIndexTest(TestCase):
+    """
+    The hot ledger queries must be answered from indexes, not table scans,
+    on a ledger of a million transactions.
+    """
+    fixtures = ['initial_data.json']
+    rows = 1000000
+    hot_tables = ('issuer_transaction', 'issuer_transfer', 'issuer_schememessage')
+
+    # Generates 1..n on the database side, seeding through the ORM would take minutes
+    series = 'WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < %s) '
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        cleared = ClearingBatch.objects.create()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO issuer_transaction (created_at, updated_at, amount, external_transaction_id, status) ' +
+                cls.series + "SELECT %s, %s, 0, 'T' || n, n %% 3 - 1 FROM seq",
+                [cls.rows, now - timedelta(days=30), now])
+            for account_id in ('CASE WHEN id %% 2 = 0 THEN 1 ELSE 2 END', '3'):
+                cursor.execute(
+                    'INSERT INTO issuer_transfer (account_id, amount, created_at, updated_at, transaction_id) '
+                    'SELECT ' + account_id + ', 1, created_at, updated_at, id FROM issuer_transaction', [])
+            cursor.execute(
+                'INSERT INTO issuer_schememessage (type, card_id, transaction_id, merchant_name, merchant_country, '
+                'merchant_mcc, billing_amount, billing_currency, transaction_amount, transaction_currency, '
+                'created_at, clearing_id) ' + cls.series +
+                "SELECT CASE WHEN n %% 2 = 0 THEN %s ELSE %s END, '4321LOBO', 'T' || n, 'SHOP', 'FI', 5411, "
+                "1, 'EUR', 1, 'EUR', %s, CASE WHEN n > 100 THEN %s END FROM seq",
+                [cls.rows, MESSAGE_TYPES.PRESENTMENT, MESSAGE_TYPES.AUTHORISATION, now, cleared.pk])
+            cursor.execute('ANALYZE')
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                return [row[-1] for row in cursor.fetchall()]
+            cursor.execute('EXPLAIN ' + sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def assertUsesIndexes(self, queryset, ranges=()):
+        """
+        No full scan of the hot tables, and the (table, column) ``ranges`` are
+        searched in an index, not filtered row by row after an index prefix.
+        """
+        plan = self.query_plan(queryset)
+        for line in plan:
+            for table in self.hot_tables:
+                full_scan = (
+                    line.startswith('SCAN') and table in line and 'INDEX' not in line or  # SQLite
+                    'Seq Scan on %s' % table in line  # PostgreSQL
+                )
+                self.assertFalse(full_scan, 'Full scan of %s:\n%s' % (table, '\n'.join(plan)))
+        for table, column in ranges:
+            self.assertTrue(any(column in condition for condition in self.index_conditions(plan, table)),
+                            'No index range on %s.%s:\n%s' % (table, column, '\n'.join(plan)))
+
+    def index_conditions(self, plan, table):
+        """
+        Index conditions of the plan nodes searching ``table``
+        """
+        for i, line in enumerate(plan):
+            # SQLite: SEARCH issuer_transfer USING INDEX issuer_tran_account_26b57d_idx (account_id=? AND created_at>?)
+            match = re.match(r'SEARCH (?:TABLE )?%s .*USING (?:COVERING )?INDEX \S+ \((.*)\)' % table, line)
+            if match:
+                yield match.group(1)
+            # PostgreSQL: Index Scan using ... on issuer_transfer, then "Index Cond: (...)" until the next node
+            elif re.search(r'Index (?:Only )?Scan (?:Backward )?using \S+ on %s\b' % table, line):
+                for condition in plan[i + 1:]:
+                    if '->' in condition:
+                        break
+                    if 'Index Cond:' in condition:
+                        yield condition
+
+    def test_hold_lookup_uses_indexes(self):
+        account = Account.objects.get(pk=1)
+        transfers = account.get_transfers_by_transaction_external_id('T42').filter(
+            transaction__status=TRANSACTION_STATUSES.HOLD)
+        self.assertUsesIndexes(transfers)
+
+    def test_point_in_time_balance_uses_indexes(self):
+        account = Account.objects.get(pk=1)
+        for balance_type in (BALANCE_TYPES.AVAILABLE, BALANCE_TYPES.LEDGER):
+            since = timezone.now() - timedelta(hours=1)
+            for transfers in (account.get_balance_transfers(balance_type, since),
+                              account.get_balance_transfers(balance_type, since - timedelta(hours=1), since)):
+                self.assertUsesIndexes(transfers, ranges=[('issuer_transfer', 'created_at')])
+        self.assertUsesIndexes(account.transfers.filter(created_at__lt=timezone.now()).order_by('-created_at', '-id'),
+                               ranges=[('issuer_transfer', 'created_at')])
+
+    def test_account_prefix_alone_is_not_a_range(self):
+        account = Account.objects.get(pk=1)
+        transfers = account.transfers.filter(transaction__created_at__gte=timezone.now() - timedelta(hours=1))
+        with six.assertRaisesRegex(self, AssertionError, 'No index range on issuer_transfer.created_at'):
+            self.assertUsesIndexes(transfers, ranges=[('issuer_transfer', 'created_at')])
+
+    def test_uncleared_presentments_lookup_uses_indexes(self):
+        self.assertUsesIndexes(SchemeMessage.objects.filter(type=MESSAGE_TYPES.PRESENTMENT, clearing__isnull=True))
+
+    def test_transaction_id_validation_uses_indexes(self):
+        self.assertUsesIndexes(messages.known_messages(type=MESSAGE_TYPES.AUTHORISATION, transaction_id='T42'))
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class QueryBudgetTest(CleanCachesMixin, TransactionTestCase):
+    """
+    Webhooks stay within their QUERY_BUDGETS once the per-worker caches are warm, as measured by
+    bench_webhooks. Not in a test transaction, which would turn the transactions of the views into savepoints.
+    """
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        super(QueryBudgetTest, self).setUp()
+        # The first requests of a worker also look up the accounts
+        with override_settings(QUERY_BUDGET_STRICT=False):
+            self.client.post('/api/v1/operations/auth/', auth_message('WARMUP', '1.00'), **AUTH_HEADERS)
+            self.client.post('/api/v1/operations/presentment/', presentment_message('WARMUP', '1.00', '0.95'),
+                             **AUTH_HEADERS)
+        registry.reset()
+
+    def test_webhooks_stay_within_budget(self):
+        responses = [
+            self.client.post('/api/v1/operations/auth/', auth_message('BUDGET1', '10.00'), **AUTH_HEADERS),
+            self.client.post('/api/v1/operations/presentment/',
+                             presentment_message('BUDGET1', '10.00', '9.50'), **AUTH_HEADERS),
+            self.client.post('/api/v1/operations/clearing/', {}, **AUTH_HEADERS),
+            self.client.get('/api/v1/operations/balance/', {'card_id': '4321LOBO', 'balance_type': 'ledger',
+                                                             'date_time': '2017-12-20T10:00:00Z'},
+                            **AUTH_HEADERS),
+        ]
+        self.assertEqual([response.status_code for response in responses], [200, 200, 202, 200])
+        for response in responses:
+            self.assertIn('db;dur=', response['Server-Timing'])
+
+        metrics = self.client.get('/metrics/').content.decode('utf-8')
+        self.assertIn('ft_exec_requests_total{view="AuthorisationMessageView"} 1', metrics)
+        self.assertIn('ft_exec_phase_seconds_total{view="PresentmentMessageView",phase="ledger"}', metrics)
+
+    @override_settings(QUERY_BUDGETS={'AuthorisationMessageView': 2})
+    def test_exceeding_budget_fails_in_strict_mode(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.post('/api/v1/operations/auth/', auth_message('BUDGET2', '10.00'), **AUTH_HEADERS)
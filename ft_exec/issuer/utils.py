@@ -1,35 +1,94 @@
 # -*- coding: utf-8 -*-
 
 # That's helpers very simple and pretend true way getting accounts any type
-from issuer.constants import TRANSACTION_STATUSES
+import base64
+import time
+
+from django.conf import settings
+from django.db import router
+from django.utils.dateparse import parse_datetime
+
+from issuer import routers
 from issuer.models import Account
 from app.settings import ACCOUNTS_MAPPING
 
 
+# Account lookups are cached per process as {key: (expires at, field values)}.
+# Only the fields that never change on the posting path are kept, balances stay
+# deferred on the returned instances and are read from the DB on first access.
+CACHED_ACCOUNT_FIELDS = ('id', 'name', 'type', 'currency')
+_account_cache = {}
+
+
+def _get_cached_account(key, **lookup):
+    entry = _account_cache.get(key)
+    if entry is None or entry[0] < time.time():
+        values = Account.objects.filter(**lookup).values_list(*CACHED_ACCOUNT_FIELDS).get()
+        entry = (time.time() + settings.ACCOUNT_CACHE_TTL, values)
+        _account_cache[key] = entry
+    # Deferred balances are loaded from where reads go, which depends on the account
+    routers.read_your_writes(entry[1][0])
+    return Account.from_db(router.db_for_read(Account), CACHED_ACCOUNT_FIELDS, entry[1])
+
+
+def invalidate_account_cache(**kwargs):
+    """
+    Drop every cached account lookup, connected to Account save/delete signals
+    """
+    _account_cache.clear()
+
+
 def get_account_by_card_id(card_id):
     account_name = ACCOUNTS_MAPPING['card_id'].get(card_id)
-    account = Account.objects.get(name=account_name)
-    return account
+    return _get_cached_account(('name', account_name), name=account_name)
+
+
+def get_accounts_by_card_ids(card_ids, for_update=False):
+    """
+    Map several card ids to their accounts with a single query
+    """
+    names = dict((card_id, ACCOUNTS_MAPPING['card_id'].get(card_id)) for card_id in card_ids)
+    queryset = Account.objects.filter(name__in=set(names.values()))
+    if for_update:
+        queryset = queryset.select_for_update()
+    accounts = dict((account.name, account) for account in queryset)
+    return dict((card_id, accounts[name]) for card_id, name in names.items())
+
 
 def get_account_by_cardholder_name(cardholder_name):
     account_name = ACCOUNTS_MAPPING['cardholder'].get(cardholder_name)
-    account = Account.objects.get(name=account_name)
-    return account
+    return _get_cached_account(('name', account_name), name=account_name)
 
 
 def get_scheme_account():
-    return Account.objects.get(id=6)
+    return _get_cached_account(('id', 6), id=6)
 
 
 def get_bank_acount():
-    return Account.objects.get(id=3)
+    return _get_cached_account(('id', 3), id=3)
 
 def get_equity_account():
-    return Account.objects.get(id=5)
+    return _get_cached_account(('id', 5), id=5)
+
+
+def encode_statement_cursor(transfer):
+    """
+    Opaque keyset cursor pointing right after ``transfer`` in a statement
+    """
+    value = '%s,%d' % (transfer.created_at.isoformat(), transfer.id)
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode('ascii')
 
 
-def get_hold_amount(account, transaction_id):
-    account_transfers_qs = account.get_transfers_by_transaction_external_id(transaction_id)
-    account_transfer = account_transfers_qs.filter(transaction__status=TRANSACTION_STATUSES.HOLD).first()
-    hold_amount = getattr(account_transfer, 'amount', 0)
-    return hold_amount
+def decode_statement_cursor(cursor):
+    """
+    (created_at, id) of a cursor made by encode_statement_cursor, ValueError if it is not one
+    """
+    try:
+        created_at, transfer_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split(',')
+        created_at = parse_datetime(created_at)
+        transfer_id = int(transfer_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if created_at is None:
+        raise ValueError('Invalid cursor')
+    return created_at, transfer_id
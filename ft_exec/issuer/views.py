@@ -1,27 +1,35 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import time
-from datetime import datetime
-from decimal import Decimal
+import csv
+from itertools import islice
 
 from django.conf import settings
 from django.db import IntegrityError, transaction
-from django.db.models import Sum
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
 from drf_openapi.utils import view_config
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import BasePermission
-from rest_framework.renderers import JSONRenderer
+from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 
+from issuer import archive, clearing, fastjson, holds, idempotency, instrumentation, ledger, messages, routers, \
+    webhooks
 from issuer.constants import BALANCE_TYPES, TRANSACTION_STATUSES, MESSAGE_TYPES
-from issuer.models import Account, SchemeMessage
+from issuer.exceptions import InsufficientFunds
+from issuer.ledger import Posting
+from issuer.models import Account, SchemeMessage, ClearingBatch
 from issuer.serializers import AuthMessageSerializer, PresentmentMessageSerializer, ResponseSerializer, \
-    BalanceSerializer, AccountSerializer
-from issuer.utils import get_account_by_card_id, get_bank_acount, get_scheme_account, get_hold_amount, \
-    get_equity_account
+    BalanceSerializer, AccountSerializer, AuthMessageBatchSerializer, StatementSerializer, ClearingBatchSerializer
+from issuer.utils import get_account_by_card_id, get_bank_acount, get_accounts_by_card_ids, encode_statement_cursor
 
 
 class HasHeaderPermission(BasePermission):
@@ -41,158 +49,259 @@ class HasHeaderPermission(BasePermission):
 
 class BaseViewMixin(object):
     permission_classes = (HasHeaderPermission,)
-    renderer_classes = (JSONRenderer, )
+    renderer_classes = (import_string(settings.API_JSON_RENDERER), )
+    parser_classes = (import_string(settings.API_JSON_PARSER), FormParser, MultiPartParser)
+
+
+class ReplicaReadMixin(object):
+    """
+    Serves safe requests from a read replica, see ``issuer.routers``
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            return super(ReplicaReadMixin, self).dispatch(request, *args, **kwargs)
+        with routers.replica_reads():
+            if 'pk' in kwargs:
+                routers.read_your_writes(kwargs['pk'])
+            return super(ReplicaReadMixin, self).dispatch(request, *args, **kwargs)
+
+
+class IdempotentMessageMixin(object):
+    """
+    Answers scheme retries of an already processed message
+    with the original response, before any validation or ledger work.
+    """
+    message_type = None
+
+    def get_original_response(self, request):
+        if not isinstance(request.data, dict):
+            return None
+        original = idempotency.get_response(self.message_type, request.data.get('transaction_id'))
+        if original is not None:
+            data, status_code = original
+            return Response(data, status=status_code)
 
 
 class ClearingView(BaseViewMixin, APIView):
     """
     A scheme-clearing endpoint for POST request.
+
+    Only queues a clearing job for the presentments received so far, the
+    ``clearing_worker`` command settles them in the background.
     """
 
     def post(self, request):
-        presented_messages = SchemeMessage.objects.filter(type=MESSAGE_TYPES.PRESENTMENT)
-        aggrgate_summ = presented_messages.aggregate(biliable_sum=Sum('billing_amount'),
-                                                     settlement_sum=Sum('settlement_amount'))
-        amount_liability = aggrgate_summ['settlement_sum']
-        amount_equity = aggrgate_summ['biliable_sum'] - aggrgate_summ['settlement_sum']
+        job = clearing.enqueue()
 
-        fintech_ltd = get_equity_account()
-        bank = get_bank_acount()
-        scheme = get_scheme_account()
-        now_timestamp = time.time()
+        response_status = status.HTTP_202_ACCEPTED
+        response = Response({"success": True,
+                             'status_code': response_status,
+                             'detail': ClearingBatchSerializer(job).data
+                             }, status=response_status)
+        response['Location'] = reverse('clearing-job', args=[job.pk])
+        return response
 
-        bank.transfer_to(scheme, amount=amount_liability, status=TRANSACTION_STATUSES.PROCESSED,
-                         external_transaction_id=now_timestamp)
-        bank.transfer_to(fintech_ltd, amount=amount_equity, status=TRANSACTION_STATUSES.PROCESSED,
-                         external_transaction_id=now_timestamp)
+
+class ClearingJobView(BaseViewMixin, APIView):
+    """
+    Status and progress of a clearing job
+    """
+
+    def get(self, request, pk):
+        job = get_object_or_404(ClearingBatch, pk=pk)
 
         response_status = status.HTTP_200_OK
         return Response({"success": True,
                          'status_code': response_status,
-                         'detail': ['liability: %s EUR' % amount_liability,'equity: %s EUR'% amount_equity]
+                         'detail': ClearingBatchSerializer(job).data
                          }, status=response_status)
 
 
-class AuthorisationMessageView(BaseViewMixin, GenericAPIView):
+class AuthorisationMessageView(IdempotentMessageMixin, BaseViewMixin, GenericAPIView):
     """
     A scheme's webhook endpoint
     for authorisation message POST request.
     """
 
+    # Documents the API schema, requests are validated by issuer.messages
     serializer_class = AuthMessageSerializer
+    message_type = MESSAGE_TYPES.AUTHORISATION
 
     def post(self, request):
         """
         Webhook for authorisation type of messages from scheme
         ---
         """
-        serializer = self.get_serializer(data=request.data)
-        if not serializer.is_valid():
+        original_response = self.get_original_response(request)
+        if original_response is not None:
+            return original_response
+
+        try:
+            with instrumentation.timed('serializer'):
+                message = messages.AUTHORISATION.validate(request.data)
+        except ValidationError as e:
             return Response({'success': False,
                              'status_code': status.HTTP_400_BAD_REQUEST,
-                             'detail': serializer.errors
+                             'detail': e.detail
                              },
                             status=status.HTTP_400_BAD_REQUEST)
 
-        data = serializer.initial_data
+        response_data, response_status = webhooks.authorise(message)
+        return Response(response_data, status=response_status)
 
-        card_id = data.get('card_id')
-        external_transaction_id = data.get('transaction_id')
-        billing_amount = Decimal(data.get('billing_amount'))
 
-        account = get_account_by_card_id(card_id)
-        bank = get_bank_acount()
+class AuthorisationBatchView(BaseViewMixin, GenericAPIView):
+    """
+    A scheme's webhook endpoint
+    for a batch of authorisation messages in one POST request.
+    """
 
-        if billing_amount >= account.amount_available:
-            response_status = status.HTTP_403_FORBIDDEN
+    serializer_class = AuthMessageBatchSerializer
 
+    def post(self, request):
+        """
+        Webhook for a list of authorisation messages from scheme.
+        All holds are applied in one DB transaction and every message gets its own result.
+        ---
+        """
+        with instrumentation.timed('serializer'):
+            batch, errors = self.validate_batch(request.data)
+        if errors:
             return Response({'success': False,
-                             'status_code': response_status,
-                             'detail': 'Need more gold'
+                             'status_code': status.HTTP_400_BAD_REQUEST,
+                             'detail': errors
                              },
-                            status=response_status)
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        transaction_ids = [message['transaction_id'] for message in batch]
+        seen_transaction_ids = set(transaction_id for _, transaction_id in messages.known_messages(
+            type=MESSAGE_TYPES.AUTHORISATION, transaction_id__in=transaction_ids
+        ))
+
+        bank = get_bank_acount()
+        now = timezone.now()
+        results = []
+        postings = []
+        approved_messages = []
         try:
             with transaction.atomic():
-                account.transfer_to(bank, amount=billing_amount, external_transaction_id=external_transaction_id,
-                                    status=TRANSACTION_STATUSES.HOLD)
-                serializer.save()
-            response_status = status.HTTP_200_OK
-            detail = 'Authorization success'
-        except IntegrityError:
+                accounts = get_accounts_by_card_ids(set(message['card_id'] for message in batch),
+                                                    for_update=True)
+                available = dict((account.pk, account.amount_available) for account in accounts.values())
+
+                for message in batch:
+                    external_transaction_id = message['transaction_id']
+                    account = accounts[message['card_id']]
+                    billing_amount = message['billing_amount']
+
+                    if external_transaction_id in seen_transaction_ids:
+                        results.append(self._result(external_transaction_id, status.HTTP_409_CONFLICT,
+                                                    'Duplicated data'))
+                        continue
+                    seen_transaction_ids.add(external_transaction_id)
+
+                    if billing_amount >= available[account.pk]:
+                        results.append(self._result(external_transaction_id, status.HTTP_403_FORBIDDEN,
+                                                    'Need more gold'))
+                        continue
+                    available[account.pk] -= billing_amount
+
+                    postings.append(Posting(account, bank, billing_amount, TRANSACTION_STATUSES.HOLD,
+                                            external_transaction_id, guard=BALANCE_TYPES.AVAILABLE,
+                                            expires_at=holds.expires_at(message['merchant_mcc'], now)))
+                    approved_messages.append(SchemeMessage(**message))
+                    results.append(self._result(external_transaction_id, status.HTTP_200_OK,
+                                                'Authorization success'))
+
+                ledger.post(postings)
+                SchemeMessage.objects.bulk_create(approved_messages)
+        except (IntegrityError, InsufficientFunds):
+            # Another request got in between for one of the cards or transaction ids,
+            # nothing of this batch is stored and the scheme can simply retry it.
             response_status = status.HTTP_409_CONFLICT
-            detail = 'Duplicated data'
+            return Response({'success': False,
+                             'status_code': response_status,
+                             'detail': 'Conflicting concurrent data, retry the batch'
+                             },
+                            status=response_status)
+
+        idempotency.remember_responses(MESSAGE_TYPES.AUTHORISATION, dict(
+            (result['transaction_id'], ({'success': True,
+                                         'status_code': result['status_code'],
+                                         'detail': result['detail']}, result['status_code']))
+            for result in results if result['success']
+        ))
 
+        response_status = status.HTTP_200_OK
         return Response({"success": True,
                          'status_code': response_status,
-                         'detail': detail},
+                         'detail': results},
                         status=response_status)
 
-
-class PresentmentMessageView(BaseViewMixin, GenericAPIView):
+    def validate_batch(self, data):
+        """
+        (messages, None) or (None, errors) with the errors of every message in its position
+        """
+        if not isinstance(data, list):
+            return None, {'non_field_errors': ['Expected a list of items but got type "%s".' % type(data).__name__]}
+        batch, errors = [], []
+        for item in data:
+            try:
+                batch.append(messages.AUTHORISATION.validate(item, check_database=False))
+                errors.append({})
+            except ValidationError as e:
+                errors.append(e.detail)
+        if any(errors):
+            return None, errors
+        return batch, None
+
+    def _result(self, transaction_id, status_code, detail):
+        return {'transaction_id': transaction_id,
+                'success': status_code == status.HTTP_200_OK,
+                'status_code': status_code,
+                'detail': detail}
+
+
+class PresentmentMessageView(IdempotentMessageMixin, BaseViewMixin, GenericAPIView):
     """
     A scheme's webhook endpoint
     for presentment message POST request.
     """
 
     serializer_class = PresentmentMessageSerializer
+    message_type = MESSAGE_TYPES.PRESENTMENT
 
   #  @view_config(request_serializer=PresentmentMessageSerializer, response_serializer=ResponseSerializer)
     def post(self, request):
+        original_response = self.get_original_response(request)
+        if original_response is not None:
+            return original_response
 
-        serializer = self.get_serializer(data=request.data)
-        if not serializer.is_valid():
+        try:
+            with instrumentation.timed('serializer'):
+                message = messages.PRESENTMENT.validate(request.data)
+        except ValidationError as e:
             return Response({
                 'success': False,
                 'status_code': status.HTTP_400_BAD_REQUEST,
-                'detail': serializer.errors
+                'detail': e.detail
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        data = serializer.initial_data
-        card_id = data.get('card_id')
-        billing_amount = Decimal(data.get('billing_amount'))
-
-        transaction_id = data.get('transaction_id')
-        account = get_account_by_card_id(card_id)
-        bank = get_bank_acount()
-
-        if billing_amount >= account.amount_ledger:
-            response_status = status.HTTP_403_FORBIDDEN
-
-            return Response({'success': False,
-                             'status_code': response_status,
-                             'detail': 'Need more gold'
-                             },
-                            status=response_status)
-        try:
-            with transaction.atomic():
-                hold_amount = get_hold_amount(account, transaction_id)
-                bank.transfer_to(account, hold_amount, status=TRANSACTION_STATUSES.CANCELED,
-                                 external_transaction_id=transaction_id)
-                account.transfer_to(bank, amount=billing_amount, status=TRANSACTION_STATUSES.PROCESSED,
-                                    external_transaction_id=transaction_id)
-                serializer.save()
-            response_status = status.HTTP_200_OK
-            detail = 'Authorization success'
-            success = True
-        except IntegrityError:
-            success = False
-            response_status = status.HTTP_409_CONFLICT
-            detail = 'Duplicated data'
-
-        return Response({"success": success,
-                         'status_code': response_status,
-                         'detail': detail},
-                        status=response_status)
+        response_data, response_status = webhooks.present(message)
+        return Response(response_data, status=response_status)
 
 
-class CardholderBalanceView(BaseViewMixin, GenericAPIView):
+class CardholderBalanceView(ReplicaReadMixin, BaseViewMixin, GenericAPIView):
     serializer_class = BalanceSerializer
 
     @view_config(request_serializer=BalanceSerializer, response_serializer=ResponseSerializer)
     def get(self, request, version):
         serializer = self.get_serializer(data=request.query_params)
 
-        if not serializer.is_valid():
+        with instrumentation.timed('serializer'):
+            is_valid = serializer.is_valid()
+        if not is_valid:
             return Response({
                 'success': False,
                 'status_code': status.HTTP_400_BAD_REQUEST,
@@ -200,18 +309,108 @@ class CardholderBalanceView(BaseViewMixin, GenericAPIView):
             }, status=status.HTTP_400_BAD_REQUEST)
 
         data = serializer.initial_data
-        dt = data.get('date_time', datetime.today())
-        balance_type = data.get('balance_type', BALANCE_TYPES.AVAILABLE)
+        response_data, response_status, etag = webhooks.balance(
+            data['card_id'], data.get('balance_type', BALANCE_TYPES.AVAILABLE),
+            serializer.validated_data.get('date_time'), request.META.get('HTTP_IF_NONE_MATCH'))
+        return Response(response_data, status=response_status, headers={'ETag': etag})
+
+
+class StatementView(ReplicaReadMixin, BaseViewMixin, GenericAPIView):
+    """
+    Statement of a cardholder account for a period.
+
+    Pages are cursor based on (created_at, id), ``export=ndjson`` or
+    ``export=csv`` streams the whole period instead without holding it in memory.
+    """
+    serializer_class = StatementSerializer
+    line_fields = ('id', 'created_at', 'amount', 'external_transaction_id', 'status',
+                   'balance_available', 'balance_ledger')
+    content_types = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv',
+    }
+
+    def get(self, request):
+        serializer = self.get_serializer(data=request.query_params)
+        with instrumentation.timed('serializer'):
+            is_valid = serializer.is_valid()
+        if not is_valid:
+            return Response({
+                'success': False,
+                'status_code': status.HTTP_400_BAD_REQUEST,
+                'detail': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
         account = get_account_by_card_id(data['card_id'])
-        res = account.get_balance(dt=dt, balance_type=balance_type)
+        since = data['cursor'][0] if data.get('cursor') else data.get('date_from')
+        # The archived part of the period first, both ordered on (created_at, id)
+        statements = [account.get_statement(data.get('date_from'), data.get('date_to'), archived=True)
+                      ] if archive.needs_archive(since) else []
+        statements.append(account.get_statement(data.get('date_from'), data.get('date_to')))
+
+        if data.get('cursor'):
+            created_at, transfer_id = data['cursor']
+            statements = [transfers.filter(Q(created_at__gt=created_at) |
+                                           Q(created_at=created_at, id__gt=transfer_id))
+                          for transfers in statements]
+
+        export = data.get('export')
+        if export:
+            # Streaming goes on after dispatch has left the replica block, stay on the same database
+            statements = [transfers.using(transfers.db) for transfers in statements]
+            lines = (self.get_line(transfer) for transfer in archive.merge(*statements))
+            content = self.stream_csv(lines) if export == 'csv' else self.stream_ndjson(lines)
+            response = StreamingHttpResponse(content, content_type=self.content_types[export])
+            response['Content-Disposition'] = 'attachment; filename="statement.%s"' % export
+            return response
+
+        limit = data['limit']
+        transfers = list(islice(archive.merge(*[transfers[:limit + 1] for transfers in statements]), limit + 1))
+        next_cursor = encode_statement_cursor(transfers[limit - 1]) if len(transfers) > limit else None
 
         return Response({"success": True,
                          "status_code": status.HTTP_200_OK,
-                         "detail": res
-                         }, status=status.HTTP_200_OK)
+                         "detail": {
+                             'results': [self.get_line(transfer) for transfer in transfers[:limit]],
+                             'next_cursor': next_cursor,
+                         }}, status=status.HTTP_200_OK)
+
+    def get_line(self, transfer):
+        return {
+            'id': transfer.id,
+            'created_at': transfer.created_at.isoformat(),
+            'amount': str(transfer.amount),
+            'external_transaction_id': transfer.transaction.external_transaction_id,
+            'status': transfer.transaction.status,
+            'balance_available': self.format_balance(transfer.balance_available),
+            'balance_ledger': self.format_balance(transfer.balance_ledger),
+        }
+
+    def format_balance(self, balance):
+        return str(balance) if balance is not None else None
+
+    def stream_ndjson(self, lines):
+        for line in lines:
+            yield fastjson.dumps(line) + b'\n'
+
+    def stream_csv(self, lines):
+        writer = csv.writer(_EchoBuffer())
+        yield writer.writerow(self.line_fields)
+        for line in lines:
+            yield writer.writerow([line[field] for field in self.line_fields])
+
+
+class _EchoBuffer(object):
+    """
+    File-like object handing every written row straight back to csv.writer's caller
+    """
+
+    def write(self, value):
+        return value
 
 
-class AccountViewSet(BaseViewMixin, ModelViewSet):
+class AccountViewSet(ReplicaReadMixin, BaseViewMixin, ModelViewSet):
     """
     A simple ViewSet for viewing and editing accounts.
     """
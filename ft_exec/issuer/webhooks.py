@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Database work of the scheme webhooks, shared by the DRF views and the ASGI
+views of ``issuer.asgi``.
+
+Every function takes a message validated by ``issuer.messages`` (or the
+validated balance query) and returns the response payload and status code.
+Parsing the request and rendering the response is left to the caller.
+"""
+from __future__ import unicode_literals
+
+from django.db import IntegrityError, transaction
+from django.utils.http import parse_etags
+from rest_framework import status
+
+from issuer import balance_cache, holds, idempotency, ledger
+from issuer.constants import BALANCE_TYPES, TRANSACTION_STATUSES, MESSAGE_TYPES
+from issuer.exceptions import InsufficientFunds
+from issuer.ledger import Posting
+from issuer.models import SchemeMessage
+from issuer.utils import get_account_by_card_id, get_bank_acount
+
+
+def _payload(success, status_code, detail):
+    return {'success': success,
+            'status_code': status_code,
+            'detail': detail}
+
+
+def authorise(message):
+    """
+    Hold the billing amount of an authorisation message
+    """
+    external_transaction_id = message['transaction_id']
+    account = get_account_by_card_id(message['card_id'])
+    bank = get_bank_acount()
+
+    try:
+        with transaction.atomic():
+            ledger.post([Posting(account, bank, message['billing_amount'], TRANSACTION_STATUSES.HOLD,
+                                 external_transaction_id, guard=BALANCE_TYPES.AVAILABLE,
+                                 expires_at=holds.expires_at(message['merchant_mcc']))])
+            SchemeMessage.objects.create(**message)
+    except InsufficientFunds:
+        return _payload(False, status.HTTP_403_FORBIDDEN, 'Need more gold'), status.HTTP_403_FORBIDDEN
+    except IntegrityError:
+        return _payload(True, status.HTTP_409_CONFLICT, 'Duplicated data'), status.HTTP_409_CONFLICT
+
+    payload = _payload(True, status.HTTP_200_OK, 'Authorization success')
+    idempotency.remember_response(MESSAGE_TYPES.AUTHORISATION, external_transaction_id, payload, status.HTTP_200_OK)
+    return payload, status.HTTP_200_OK
+
+
+def present(message):
+    """
+    Release the hold of a presentment message and charge its billing amount
+    """
+    transaction_id = message['transaction_id']
+    account = get_account_by_card_id(message['card_id'])
+    bank = get_bank_acount()
+    hold_amount = holds.held_amounts(account.get_transfers_by_transaction_external_id(transaction_id)).get(
+        (transaction_id, account.pk), 0)
+
+    try:
+        with transaction.atomic():
+            if holds.settle([transaction_id]):
+                # Expired and released already
+                hold_amount = 0
+            ledger.post([
+                Posting(bank, account, hold_amount, TRANSACTION_STATUSES.CANCELED, transaction_id),
+                Posting(account, bank, message['billing_amount'], TRANSACTION_STATUSES.PROCESSED, transaction_id,
+                        guard=BALANCE_TYPES.LEDGER),
+            ])
+            SchemeMessage.objects.create(**message)
+    except InsufficientFunds:
+        return _payload(False, status.HTTP_403_FORBIDDEN, 'Need more gold'), status.HTTP_403_FORBIDDEN
+    except IntegrityError:
+        return _payload(False, status.HTTP_409_CONFLICT, 'Duplicated data'), status.HTTP_409_CONFLICT
+
+    payload = _payload(True, status.HTTP_200_OK, 'Authorization success')
+    idempotency.remember_response(MESSAGE_TYPES.PRESENTMENT, transaction_id, payload, status.HTTP_200_OK)
+    return payload, status.HTTP_200_OK
+
+
+def balance(card_id, balance_type, point_in_time, if_none_match=None):
+    """
+    (payload, status code, ETag) of a balance, the payload is None for 304 Not Modified.
+
+    ``point_in_time`` is the validated date_time of the query or None for now.
+    """
+    account = get_account_by_card_id(card_id)
+    cache_key = point_in_time.isoformat() if point_in_time else 'now'
+    cached = balance_cache.lookup(account.pk, balance_type, cache_key)
+    if if_none_match and (if_none_match.strip() == '*' or cached.etag in parse_etags(if_none_match)):
+        return None, status.HTTP_304_NOT_MODIFIED, cached.etag
+
+    payload = cached.data
+    if payload is None:
+        payload = _payload(True, status.HTTP_200_OK, account.get_balance(dt=point_in_time, balance_type=balance_type))
+        balance_cache.store(account.pk, balance_type, cache_key, cached.version, payload)
+    return payload, status.HTTP_200_OK, cached.etag